@@ -0,0 +1,90 @@
+"""
+Benchmark for the html rendering of the web browser I/O adapter (HttpIo.convert_to_html).
+
+Lets 500 connected players look around in a handful of locations, and measures the time to
+render all of their 'look' output to html. The room descriptions are the same for all players
+in a location, so the cached html conversion should render them only once.
+It also shows the time without the cache and without the fast path that skips smartypants.
+
+Run it from the root of the source tree:   python benchmarks/html_benchmark.py
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import pathlib
+import sys
+import timeit
+from typing import List
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from tale import mud_context
+from tale.base import Location, Living, Item
+from tale.player import Player, PlayerConnection
+from tale.story import StoryConfig
+from tale.tio import iobase, if_browser_io
+from tale.tio.if_browser_io import HttpIo
+from tests.supportstuff import FakeDriver
+
+PLAYERS = 500
+LOCATIONS = 10
+REPEATS = 5
+
+DESCRIPTION = "The old town square is paved with worn cobblestones. A fountain -- long dry -- stands in the middle, " \
+              "and the statue on top of it has seen better days. Someone scratched \"Tale was here\" on its base. " \
+              "The market stalls that line the square are closed for the night; only the smell of fish remains."
+
+
+def make_players() -> List[PlayerConnection]:
+    connections = []
+    locations = []
+    for number in range(LOCATIONS):
+        location = Location("Town square %d" % number, DESCRIPTION)
+        location.init_inventory([Item("fountain", "dry fountain"), Item("statue", "weathered statue"),
+                                 Item("stall", "market stall"), Living("merchant", "m"), Living("cat", "f")])
+        locations.append(location)
+    for number in range(PLAYERS):
+        player = Player("player%d" % number, "n")
+        player.move(locations[number % LOCATIONS], silent=True)
+        conn = PlayerConnection(player)
+        conn.io = HttpIo(conn, None)
+        player.known_locations.add(player.location)   # the first look should be the same as all others
+        connections.append(conn)
+    return connections
+
+
+def look_all(connections: List[PlayerConnection]) -> None:
+    for conn in connections:
+        conn.player.look(short=False)
+        conn.write_output()
+        conn.io.get_html_to_browser()
+
+
+def bench(title: str, connections: List[PlayerConnection]) -> None:
+    duration = min(timeit.repeat(lambda: look_all(connections), number=1, repeat=REPEATS))
+    print("  %-40s %7.1f msec for %d players, %6.0f looks/sec" % (title, duration * 1000, PLAYERS, PLAYERS / duration))
+
+
+def main() -> None:
+    mud_context.driver = FakeDriver()
+    mud_context.config = StoryConfig()
+    mud_context.resources = mud_context.driver.resources
+    connections = make_players()
+    if_browser_io.convert_to_html.cache_clear()
+    print("\nrendering 'look' to html for %d players in %d locations:" % (PLAYERS, LOCATIONS))
+    bench("cached conversion", connections)
+    cached_convert = if_browser_io.convert_to_html
+    if_browser_io.convert_to_html = cached_convert.__wrapped__    # type: ignore
+    bench("uncached conversion", connections)
+    smartquotes_needed = iobase.smartquotes_needed
+    iobase.smartquotes_needed = lambda text: True     # type: ignore
+    bench("uncached, always smartypants", connections)
+    iobase.smartquotes_needed = smartquotes_needed
+    if_browser_io.convert_to_html = cached_convert
+    print("  cache:", cached_convert.cache_info())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Microbenchmark for the command parser (Soul.parse) in crowded locations.
+
+Populates a location with objects from the demo story and from the Circle story,
+and measures the parse time of a few commands as the number of livings and items grows.
+With the name indexes maintained by the locations and livings, the time per command
+should stay (roughly) the same regardless of how crowded the room is.
+
+Run it from the root of the source tree:   python benchmarks/parse_benchmark.py
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import contextlib
+import io
+import pathlib
+import random
+import sys
+import timeit
+from typing import Callable, List, Tuple
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from tale import mud_context, errors
+from tale.base import Location, Living, Item
+from tale.player import Player
+from tale.story import StoryConfig
+from tests.supportstuff import FakeDriver
+
+COMMANDS = ["smile at the cat warmly", "examine red gem", "give red gem to cat", "kick lantern", "drop the lantern"]
+CROWD_SIZES = [0, 10, 100, 1000]
+REPEATS = 2000
+
+
+def load_story(name: str) -> None:
+    for module in list(sys.modules):
+        if module.startswith("zones") or module == "story":
+            del sys.modules[module]
+    sys.path.insert(0, str(ROOT / "stories" / name))
+
+
+def demo_objects() -> Callable[[int], Tuple[List[Living], List[Item]]]:
+    load_story("demo")
+    import zones.town
+    import zones.wizardtower
+    import zones.shoppe
+    modules = [zones.town, zones.wizardtower, zones.shoppe]
+    livings = [type(o) for m in modules for o in vars(m).values() if isinstance(o, Living) and not isinstance(o, Player)]
+    items = [type(o) for m in modules for o in vars(m).values() if isinstance(o, Item)]
+
+    def make(count: int) -> Tuple[List[Living], List[Item]]:
+        return ([random.choice(livings)("npc%d" % i, "n") for i in range(count)],
+                [random.choice(items)("item%d" % i) for i in range(count)])
+    return make
+
+
+def circle_objects() -> Callable[[int], Tuple[List[Living], List[Item]]]:
+    load_story("circle")
+    from zones.circledata import circle_mobs, circle_items
+    with contextlib.redirect_stdout(io.StringIO()):
+        circle_mobs.init_circle_mobs()
+        circle_items.init_circle_items()
+    mob_vnums = sorted(circle_mobs.mobs)
+    # boards and banks need persistent storage files, leave those out
+    item_vnums = sorted(set(circle_items.objs) - set(circle_items.circle_bulletin_boards) - set(circle_items.circle_banks))
+
+    def make(count: int) -> Tuple[List[Living], List[Item]]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ([circle_mobs.make_mob(random.choice(mob_vnums)) for _ in range(count)],
+                    [circle_items.make_item(random.choice(item_vnums)) for _ in range(count)])
+    return make
+
+
+def bench(story: str, make_objects: Callable[[int], Tuple[List[Living], List[Item]]]) -> None:
+    print("\n%s story:" % story)
+    for crowd in CROWD_SIZES:
+        room = Location("benchmark room")
+        player = Player("julie", "f")
+        cat = Living("cat", "f")
+        gem = Item("gem")
+        gem.aliases = {"red gem"}
+        lantern = Item("lantern")
+        room.init_inventory([player, cat, gem])
+        player.insert(lantern, player)
+        livings, items = make_objects(crowd)
+        for obj in livings + items:
+            room.insert(obj, None)
+
+        def parse_commands() -> None:
+            for cmd in COMMANDS:
+                try:
+                    player.soul.parse(player, cmd, external_verbs={"examine", "give", "drop"})
+                except errors.ParseError:
+                    pass
+        duration = min(timeit.repeat(parse_commands, number=REPEATS // len(COMMANDS), repeat=3))
+        print("  %5d livings + %5d items: %6.1f usec per command" % (crowd, crowd, duration * 1e6 / REPEATS))
+
+
+def main() -> None:
+    random.seed(42)
+    mud_context.driver = FakeDriver()
+    mud_context.config = StoryConfig()
+    mud_context.resources = mud_context.driver.resources
+    bench("demo", demo_objects())
+    bench("circle", circle_objects())
+
+
+if __name__ == "__main__":
+    main()
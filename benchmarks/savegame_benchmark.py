@@ -0,0 +1,116 @@
+"""
+Benchmark for saving and loading the game state with the two savegame formats (serpent text, and binary).
+
+Builds a world of a few thousand locations, with exits between them and items and livings in them,
+and measures the time to serialize it to savegame data (TaleSerializer.serialize) and to read that
+back into the structure the objects are recreated from (TaleDeserializer.deserialize).
+It also shows the size of the savegame data, and the time it takes to make a snapshot of the state
+for the background save thread (the first one, and the next ones that reuse the state of the unchanged objects),
+and the time it takes to (de)obfuscate a save file of 10 megabyte, compared to xor-ing it byte by byte.
+
+Run it from the root of the source tree:   python benchmarks/savegame_benchmark.py
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import datetime
+import gzip
+import pathlib
+import random
+import sys
+import timeit
+from typing import Any, Tuple
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from tale import mud_context
+from tale.base import Location, Living, Item, Container, Exit
+from tale.driver import Deferred
+from tale.player import Player
+from tale.savegames import TaleSerializer, TaleDeserializer
+from tale.story import StoryConfig
+from tale.util import GameDateTime
+from tests.supportstuff import FakeDriver
+
+LOCATIONS = 2000
+REPEATS = 3
+OBFUSCATED_SIZE = 10 * 1024 * 1024
+
+
+def make_world() -> Tuple[Any, ...]:
+    locations = []
+    exits = []
+    items = []
+    livings = []
+    for number in range(LOCATIONS):
+        location = Location("Room %d" % number, "A room in the maze of twisty little passages, all alike. It is number %d." % number)
+        if locations:
+            exits.extend(Exit.connect(location, "west", "A passage leads west.", None,
+                                      locations[-1], "east", "A passage leads east.", None))
+        chest = Container("chest", "wooden chest", descr="An old wooden chest with iron bands.")
+        chest.init_inventory([Item("coin", "gold coin"), Item("gem", "red gem")])
+        lamp = Item("lamp", "brass lamp", descr="A brass lamp, it seems to work.")
+        lamp.story_data = {"fuel": number % 100, "lit": False}
+        location.init_inventory([chest, lamp])
+        items.extend([chest, lamp] + list(chest.inventory))
+        if number % 4 == 0:
+            rat = Living("rat", "m", race="rodent", descr="A big rat.")
+            rat.aliases = {"rodent", "vermin"}
+            rat.move(location, silent=True)
+            livings.append(rat)
+        locations.append(location)
+    player = Player("julie", "f", descr="The player.")
+    player.move(locations[0], silent=True)
+    deferreds = [Deferred(datetime.datetime.now(), rat.init, [], None, periodical=(10.0, 20.0)) for rat in livings]
+    clock = GameDateTime(datetime.datetime.now())
+    return StoryConfig(), player, items, livings, locations, exits, deferreds, clock
+
+
+def bench(savegame_format: str, world: Tuple[Any, ...]) -> None:
+    serializer = TaleSerializer(savegame_format)
+    saved = serializer.serialize(*world)
+    save_duration = min(timeit.repeat(lambda: serializer.serialize(*world), number=1, repeat=REPEATS))
+    load_duration = min(timeit.repeat(lambda: TaleDeserializer().deserialize(saved), number=1, repeat=REPEATS))
+    print("  %-8s  save %7.1f msec   load %7.1f msec   size %6d kb" %
+          (savegame_format, save_duration * 1000, load_duration * 1000, len(saved) // 1024))
+
+
+def bench_snapshot(world: Tuple[Any, ...]) -> None:
+    serializer = TaleSerializer()
+    full_duration = min(timeit.repeat(lambda: serializer.snapshot(serializer.savegame_state(*world), {}), number=1, repeat=REPEATS))
+    previous = {}
+    serializer.snapshot(serializer.savegame_state(*world), previous)
+    next_duration = min(timeit.repeat(lambda: serializer.snapshot(serializer.savegame_state(*world), previous), number=1, repeat=REPEATS))
+    print("  snapshot  first %7.1f msec   next %7.1f msec" % (full_duration * 1000, next_duration * 1000))
+
+
+def bench_obfuscation() -> None:
+    # random data doesn't compress, so the compressed data (that is xor-ed) is about as big as the data itself
+    data = random.Random(42).getrandbits(OBFUSCATED_SIZE * 8).to_bytes(OBFUSCATED_SIZE, "little")
+    compressed = gzip.compress(data, compresslevel=6)
+    xor_duration = min(timeit.repeat(lambda: compressed.translate(TaleSerializer.xor_table), number=1, repeat=REPEATS))
+    loop_duration = timeit.timeit(lambda: bytes(b ^ TaleSerializer.xor_key for b in compressed), number=1)
+    saved = TaleSerializer().obfuscate(data)
+    save_duration = min(timeit.repeat(lambda: TaleSerializer().obfuscate(data), number=1, repeat=REPEATS))
+    load_duration = min(timeit.repeat(lambda: TaleDeserializer().deobfuscate(saved), number=1, repeat=REPEATS))
+    print("\n(de)obfuscating a save file of %d kb:" % (len(saved) // 1024))
+    print("  xor      translate %7.1f msec   byte by byte %7.1f msec" % (xor_duration * 1000, loop_duration * 1000))
+    print("  gzip+xor obfuscate %7.1f msec   deobfuscate  %7.1f msec" % (save_duration * 1000, load_duration * 1000))
+
+
+def main() -> None:
+    mud_context.driver = FakeDriver()
+    mud_context.config = StoryConfig()
+    mud_context.resources = mud_context.driver.resources
+    world = make_world()
+    print("\nsaving and loading a world of %d locations, %d items and %d livings:" % (LOCATIONS, len(world[2]), len(world[3])))
+    bench("serpent", world)
+    bench("binary", world)
+    bench_snapshot(world)
+    bench_obfuscation()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,7 @@ Package containing the zones of the game.
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
-from collections import deque
-from typing import MutableSequence, List
+from typing import List
 from tale.driver import Driver
 from tale.base import Door, Container, Item
 from tale.util import Context
@@ -118,32 +117,15 @@ def init_zones(driver: Driver) -> None:
     print("Spawned: %d mobs (%d specials), %d items, %d shops" % (num_mobs, len(mobs_with_special), num_items, num_shops))
     print(len(unconverted_objs()), "unused item defs.")
 
-    # divide all the special mobs over the 5 mobs buckets (via their hash number)
+    # the driver's periodic group spreads the special mobs over the server ticks,
     # this prevents all 300+ special mobs doing something every 10 seconds at the same time
-    global _special_mobs_buckets
-    assert len(_special_mobs_buckets) == 5
     for mob in mobs_with_special:
-        _special_mobs_buckets[(hash(mob) // 10) % 5].append(mob)
+        driver.register_grouped_periodical(10.0, mob.do_special)
     mobs_with_special.clear()
     # set up the periodical pulse events
-    mobile_timer = 10.0 / len(_special_mobs_buckets)
-    driver.defer((1.6, mobile_timer, mobile_timer), pulse_mobile)
     driver.defer((4.5, 10.0, 10.0), pulse_zone)
 
 
-_special_mobs_buckets = deque([[], [], [], [], []])   # type: MutableSequence[list]
-
-
-def pulse_mobile(ctx: Context=None) -> None:
-    """
-    Called every so often to handle mob activity (other than combat).
-    Via round robin scheduling every mob gets called once every 10 seconds, but not all at the same time.
-    """
-    for mob in _special_mobs_buckets[0]:
-        mob.do_special(ctx)
-    _special_mobs_buckets.rotate()
-
-
 def pulse_zone(ctx: Context=None) -> None:
     """Called every 10 seconds to handle zone activity"""
     pass   # @todo zone pulse
@@ -5,13 +5,18 @@ Player account code.
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
+import binascii
+import copy
 import datetime
 import hashlib
-import random
+import hmac
+import os
 import re
 import sqlite3
+import threading
 import time
 import json
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Set, Tuple, List, Dict, Any, Optional
 import serpent
 
@@ -21,7 +26,8 @@ from . import mud_context
 from . import player
 from . import util
 
-__all__ = ["Account", "MudAccounts"]
+__all__ = ["Account", "MudAccounts", "AccountService", "PasswordHasher", "LegacySha1Hasher", "Pbkdf2Hasher", "ScryptHasher",
+           "password_hashers", "hasher_for"]
 
 
 class Account:
@@ -43,6 +49,118 @@ class Account:
         self.story_data = story_data
 
 
+class PasswordHasher:
+    """
+    Base class for the password hashing algorithms. The stored hash contains the name of the algorithm and
+    its cost parameters as well:  algorithm$parameters$hash   so that every account can be verified with the
+    parameters it was hashed with, and be rehashed (on login) when the configured algorithm or cost has changed.
+    """
+    algorithm = ""
+
+    def params(self) -> str:
+        raise NotImplementedError("implement this in subclass")
+
+    @classmethod
+    def from_params(cls, params: str) -> 'PasswordHasher':
+        raise NotImplementedError("implement this in subclass")
+
+    def derive(self, password: str, salt: str) -> bytes:
+        raise NotImplementedError("implement this in subclass")
+
+    def hash(self, password: str, salt: str) -> str:
+        key = binascii.hexlify(self.derive(password, salt)).decode("ascii")
+        return "%s$%s$%s" % (self.algorithm, self.params(), key)
+
+    def verify(self, password: str, salt: str, stored_hash: str) -> bool:
+        return hmac.compare_digest(self.hash(password, salt), stored_hash)
+
+    def needs_rehash(self, stored_hash: str) -> bool:
+        """Was the stored hash made with another algorithm or other cost parameters than this hasher's?"""
+        return not stored_hash.startswith("%s$%s$" % (self.algorithm, self.params()))
+
+    @staticmethod
+    def make_salt() -> str:
+        return binascii.hexlify(os.urandom(16)).decode("ascii")
+
+
+class LegacySha1Hasher(PasswordHasher):
+    """The single salted sha-1 hash of older versions. It is only used to verify (and then rehash) old accounts."""
+    algorithm = "sha1"
+
+    def params(self) -> str:
+        return ""
+
+    @classmethod
+    def from_params(cls, params: str) -> PasswordHasher:
+        return cls()
+
+    def derive(self, password: str, salt: str) -> bytes:
+        return hashlib.sha1((salt + password).encode("utf-8")).digest()
+
+    def hash(self, password: str, salt: str) -> str:
+        return hashlib.sha1((salt + password).encode("utf-8")).hexdigest()   # stored without the algorithm prefix
+
+    def needs_rehash(self, stored_hash: str) -> bool:
+        return True
+
+
+class Pbkdf2Hasher(PasswordHasher):
+    """PBKDF2 with HMAC-SHA256, the default. The cost is the number of iterations."""
+    algorithm = "pbkdf2_sha256"
+
+    def __init__(self, iterations: int=100000) -> None:
+        if iterations < 1:
+            raise ValueError("iterations must be >= 1")
+        self.iterations = iterations
+
+    def params(self) -> str:
+        return str(self.iterations)
+
+    @classmethod
+    def from_params(cls, params: str) -> PasswordHasher:
+        return cls(int(params))
+
+    def derive(self, password: str, salt: str) -> bytes:
+        return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("utf-8"), self.iterations)
+
+
+class ScryptHasher(PasswordHasher):
+    """The scrypt memory hard function (requires hashlib.scrypt, which needs Python 3.6+ with OpenSSL 1.1+)"""
+    algorithm = "scrypt"
+
+    def __init__(self, n: int=2**14, r: int=8, p: int=1) -> None:
+        if not hasattr(hashlib, "scrypt"):
+            raise RuntimeError("scrypt is not available in this Python installation")
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def params(self) -> str:
+        return "%d,%d,%d" % (self.n, self.r, self.p)
+
+    @classmethod
+    def from_params(cls, params: str) -> PasswordHasher:
+        n, r, p = params.split(",")
+        return cls(int(n), int(r), int(p))
+
+    def derive(self, password: str, salt: str) -> bytes:
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt.encode("utf-8"), n=self.n, r=self.r, p=self.p,    # type: ignore
+                              maxmem=256 * self.n * self.r + 1024 * 1024, dklen=32)
+
+
+password_hashers = {cls.algorithm: cls for cls in [LegacySha1Hasher, Pbkdf2Hasher, ScryptHasher]}
+
+
+def hasher_for(stored_hash: str) -> PasswordHasher:
+    """Returns the hasher (with the cost parameters) that made the stored password hash."""
+    if "$" not in stored_hash:
+        return LegacySha1Hasher()
+    algorithm, params, _ = stored_hash.split("$", 2)
+    if algorithm not in password_hashers:
+        raise ValueError("unknown password hashing algorithm: " + algorithm)
+    return password_hashers[algorithm].from_params(params)
+
+
 class MudAccounts:
     """
     Handles the accounts (login, creation, etc) of mud users
@@ -51,19 +169,83 @@ class MudAccounts:
         account(name, email, pw_hash, pw_salt, created, logged_in, locked)
         privilege(account, privilege)
         charstat(account, gender, stat1, stat2,...)
+
+    Passwords are hashed with the given hasher (by default PBKDF2), accounts that still have a hash
+    made with another algorithm or cost get rehashed when they log in.
+
+    The story data and logged in timestamps are written behind: they're kept in memory (and appended to
+    a small journal file next to the database, that is replayed after a crash) and repeated writes for the
+    same account are coalesced. flush() writes them all in one transaction, it should be called
+    regularly (see flush_due) and at shutdown. Reading an account sees the pending writes.
+
+    Every thread uses its own long lived database connection (the database is in WAL journal mode,
+    so readers don't block the writer). Note that this means that an in-memory database (":memory:")
+    is a different database for each thread.
     """
 
-    def __init__(self, databasefile: str) -> None:
+    def __init__(self, databasefile: str, hasher: PasswordHasher=None, flush_interval: float=5.0) -> None:
         self.sqlite_dbpath = databasefile
+        self.hasher = hasher or Pbkdf2Hasher()
+        self.flush_interval = flush_interval
+        self._pending = {}   # type: Dict[str, Dict[str, Any]]  # account name -> column -> value, waiting to be written
+        self._pending_lock = threading.Lock()
+        self._account_ids = {}   # type: Dict[str, int]
+        self._last_flush = time.time()
+        self._write_metrics = {"writes": 0, "coalesced": 0, "flushes": 0, "flushed_accounts": 0, "last_flush_duration": 0.0}
+        self._journal = None
+        in_memory = databasefile == ":memory:" or databasefile.startswith("file:")
+        self.journal_path = None if in_memory else databasefile + ".writebehind"
+        self._local = threading.local()
+        self._connections = []   # type: List[Tuple[threading.Thread, sqlite3.Connection]]
+        self._connections_lock = threading.Lock()
+        self._has_wizard = None   # type: Optional[bool]
         self._create_database()
+        with self._sqlite_connect() as conn:
+            stat_columns = [column["name"] for column in conn.execute("PRAGMA table_info(CharStat)")]
+        stat_columns = [column for column in stat_columns if column not in ("id", "account")]
+        self._account_query = "SELECT a.id, a.name, a.email, a.pw_hash, a.pw_salt, a.created, a.logged_in, a.banned, " \
+                              "(SELECT group_concat(p.privilege, ',') FROM Privilege p WHERE p.account=a.id) AS privileges, " \
+                              "d.format AS storydata_format, d.data AS storydata, c.id AS charstat, " + \
+                              ", ".join("c.%s AS stat_%s" % (column, column) for column in stat_columns) + \
+                              " FROM Account a LEFT JOIN CharStat c ON c.account=a.id LEFT JOIN StoryData d ON d.account=a.id "
+        self._replay_journal()
 
     def _sqlite_connect(self) -> sqlite3.Connection:
-        urimode = self.sqlite_dbpath.startswith("file:")
-        conn = sqlite3.connect(self.sqlite_dbpath, detect_types=sqlite3.PARSE_DECLTYPES, timeout=5, uri=urimode)
-        conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA foreign_keys=ON;")
+        """The database connection of the current thread (it is kept open)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            urimode = self.sqlite_dbpath.startswith("file:")
+            conn = sqlite3.connect(self.sqlite_dbpath, detect_types=sqlite3.PARSE_DECLTYPES, timeout=5, uri=urimode,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA foreign_keys=ON;")
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")   # safe in WAL mode
+            self._local.conn = conn
+            with self._connections_lock:
+                # close the connections of threads that have ended
+                for thread, old_conn in self._connections:
+                    if not thread.is_alive():
+                        old_conn.close()
+                self._connections = [(t, c) for t, c in self._connections if t.is_alive()]
+                self._connections.append((threading.current_thread(), conn))
         return conn
 
+    def close(self) -> None:
+        """Write the pending data and close all database connections."""
+        self.flush()
+        with self._pending_lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+                if os.path.exists(self.journal_path):
+                    os.remove(self.journal_path)
+        with self._connections_lock:
+            for _, conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
     def _create_database(self) -> None:
         try:
             with self._sqlite_connect() as conn:
@@ -129,72 +311,83 @@ class MudAccounts:
 
     def get(self, name: str) -> Account:
         with self._sqlite_connect() as conn:
-            result = conn.execute("SELECT id FROM Account WHERE name=?", (name,)).fetchone()
+            result = conn.execute(self._account_query + "WHERE a.name=?", (name,)).fetchone()
             if not result:
                 raise LookupError(name)
-            return self._fetch_account(conn, result["id"])
-
-    def _fetch_account(self, conn: sqlite3.Connection, account_id: int) -> Account:
-        acc = conn.execute("SELECT * FROM Account WHERE id=?", (account_id,)).fetchone()
-        priv_result = conn.execute("SELECT privilege FROM Privilege WHERE account=?", (account_id,)).fetchall()
-        privileges = {pr["privilege"] for pr in priv_result}
-        storydata_result = conn.execute("SELECT format, data FROM StoryData WHERE account=?", (account_id,)).fetchone()
-        if storydata_result:
-            if storydata_result["format"] == "json":
-                storydata = json.loads(storydata_result["data"], encoding="utf-8")
-            elif storydata_result["format"] == "serpent":
-                storydata = serpent.loads(storydata_result["data"])
+            return self._make_account(result)
+
+    def _make_account(self, row: sqlite3.Row) -> Account:
+        # creates the account from a result row of the joined account query, and applies the pending writes
+        privileges = set(row["privileges"].split(",")) if row["privileges"] else set()
+        with self._pending_lock:
+            pending = dict(self._pending.get(row["name"], {}))
+        storydata_format, storydata = pending.get("story_data", (row["storydata_format"], row["storydata"]))
+        if storydata_format:
+            if storydata_format == "json":
+                storydata = json.loads(storydata)
+            elif storydata_format == "serpent":
+                storydata = serpent.loads(storydata)
             else:
-                raise ValueError("invalid storydata format in database: " + storydata_result["format"])
+                raise ValueError("invalid storydata format in database: " + storydata_format)
             if not isinstance(storydata, dict):
                 raise TypeError("storydata should be a dict")
         else:
             storydata = {}
-        stats_result = dict(conn.execute("SELECT * FROM CharStat WHERE account=?", (account_id,)).fetchone() or {})
-        del stats_result["id"]
-        del stats_result["account"]
         stats = base.Stats()
-        for key, value in stats_result.items():
-            if hasattr(stats, key):
-                setattr(stats, key, value)
-            else:
-                raise AttributeError("stats doesn't have attribute: " + key)
+        if row["charstat"] is not None:
+            for key in row.keys():
+                if key.startswith("stat_"):
+                    if hasattr(stats, key[5:]):
+                        setattr(stats, key[5:], row[key])
+                    else:
+                        raise AttributeError("stats doesn't have attribute: " + key[5:])
         stats.set_stats_from_race()   # initialize static stats from races table
-        return Account(acc["name"], acc["email"], acc["pw_hash"], acc["pw_salt"], privileges,
-                       acc["created"], acc["logged_in"], bool(acc["banned"]), stats, storydata)
+        return Account(row["name"], row["email"], row["pw_hash"], row["pw_salt"], privileges,
+                       row["created"], pending.get("logged_in", row["logged_in"]), bool(row["banned"]), stats, storydata)
 
     def all_accounts(self, having_privilege: str="") -> List[Account]:
         with self._sqlite_connect() as conn:
             if having_privilege:
-                result = conn.execute("SELECT a.id FROM Account a INNER JOIN Privilege p ON p.account=a.id AND p.privilege=? "
-                                      "ORDER BY a.name",  (having_privilege,)).fetchall()
+                result = conn.execute(self._account_query + "WHERE a.id IN (SELECT account FROM Privilege WHERE privilege=?) "
+                                      "ORDER BY a.name", (having_privilege,)).fetchall()
             else:
-                result = conn.execute("SELECT id FROM Account ORDER BY name").fetchall()
-            account_ids = [ar["id"] for ar in result]
-            accounts = [self._fetch_account(conn, account_id) for account_id in account_ids]
-            return accounts
+                result = conn.execute(self._account_query + "ORDER BY a.name").fetchall()
+            return [self._make_account(row) for row in result]
+
+    def has_wizard(self) -> bool:
+        """Is there at least one account with wizard privilege? (cached)"""
+        if self._has_wizard is None:
+            with self._sqlite_connect() as conn:
+                self._has_wizard = conn.execute("SELECT 1 FROM Privilege WHERE privilege='wizard' LIMIT 1").fetchone() is not None
+        return self._has_wizard
 
     def logged_in(self, name: str) -> None:
         timestamp = datetime.datetime.now().replace(microsecond=0)
-        with self._sqlite_connect() as conn:
-            conn.execute("UPDATE Account SET logged_in=? WHERE name=?", (timestamp, name))
+        self._write_behind(name, "logged_in", timestamp)
 
     def valid_password(self, name: str, password: str) -> None:
         with self._sqlite_connect() as conn:
             result = conn.execute("SELECT pw_hash, pw_salt FROM Account WHERE name=?", (name,)).fetchone()
         if result:
             stored_hash, stored_salt = result["pw_hash"], result["pw_salt"]
-            pwhash, _ = self._pwhash(password, stored_salt)
-            if pwhash == stored_hash:
+            if hasher_for(stored_hash).verify(password, stored_salt, stored_hash):
+                if self.hasher.needs_rehash(stored_hash):
+                    # migrate the account to the current hashing algorithm and cost
+                    pwhash, salt = self._pwhash(password, hasher=self.hasher)
+                    with self._sqlite_connect() as conn:
+                        conn.execute("UPDATE Account SET pw_hash=?, pw_salt=? WHERE name=? AND pw_hash=?",
+                                     (pwhash, salt, name, stored_hash))
                 return
+        else:
+            self._pwhash(password, hasher=self.hasher)    # takes as long as a valid name, to not give that away
         raise ValueError("Invalid name or password.")
 
     @staticmethod
-    def _pwhash(password: str, salt: str="") -> Tuple[str, str]:
+    def _pwhash(password: str, salt: str="", hasher: PasswordHasher=None) -> Tuple[str, str]:
+        hasher = hasher or Pbkdf2Hasher()
         if not salt:
-            salt = str(random.random() * time.time() + id(password)).replace('.', '')
-        pwhash = hashlib.sha1((salt + password).encode("utf-8")).hexdigest()
-        return pwhash, salt
+            salt = hasher.make_salt()
+        return hasher.hash(password, salt), salt
 
     @staticmethod
     def accept_password(password: str) -> str:
@@ -236,7 +429,7 @@ class MudAccounts:
         for p in privileges:
             self.accept_privilege(p)
         created = datetime.datetime.now().replace(microsecond=0)
-        pwhash, salt = self._pwhash(password)
+        pwhash, salt = self._pwhash(password, hasher=self.hasher)
         with self._sqlite_connect() as conn:
             result = conn.execute("SELECT COUNT(*) FROM Account WHERE name=?", (name,)).fetchone()[0]
             if result > 0:
@@ -246,6 +439,7 @@ class MudAccounts:
             for privilege in privileges:
                 conn.execute("INSERT INTO Privilege(account, privilege) VALUES (?,?)", (result.lastrowid, privilege))
             self._store_stats(conn, result.lastrowid, stats)
+        self._has_wizard = None
         return Account(name, email, pwhash, salt, privileges, created, None, False, stats, {})
 
     def _store_stats(self, conn: sqlite3.Connection, account_id: int, stats: base.Stats) -> None:
@@ -273,7 +467,7 @@ class MudAccounts:
                 raise LookupError("Unknown name.")
             account_id = result["id"]
             if new_password:
-                pwhash, salt = self._pwhash(new_password)
+                pwhash, salt = self._pwhash(new_password, hasher=self.hasher)
                 conn.execute("UPDATE Account SET pw_hash=?, pw_salt=? WHERE id=?", (pwhash, salt, account_id))
             if new_email:
                 conn.execute("UPDATE Account SET email=? WHERE id=?", (new_email, account_id))
@@ -281,16 +475,111 @@ class MudAccounts:
     def save_story_data(self, name: str, story_data: Dict[Any, Any]) -> None:
         if not isinstance(story_data, dict):
             raise TypeError("story data should be a dict")
-        with self._sqlite_connect() as conn:
-            result = conn.execute("SELECT id FROM Account WHERE name=?", (name,)).fetchone()
+        if name not in self._account_ids:
+            with self._sqlite_connect() as conn:
+                result = conn.execute("SELECT id FROM Account WHERE name=?", (name,)).fetchone()
             if not result:
                 raise LookupError("Unknown name.")
-            account_id = result["id"]
-            data = serpent.dumps(story_data)
-            result = conn.execute("UPDATE StoryData SET format=?, data=? WHERE id=?", ("serpent", data, account_id))
-            if result.rowcount == 0:
-                # there's no storydata yet, insert it
-                conn.execute("INSERT INTO StoryData(account, format, data) VALUES (?,?,?)", (account_id, "serpent", data))
+            self._account_ids[name] = result["id"]
+        # serialized right away, so the data is written as it is now
+        self._write_behind(name, "story_data", ("serpent", serpent.dumps(story_data)))
+
+    def _write_behind(self, name: str, column: str, value: Any) -> None:
+        with self._pending_lock:
+            pending = self._pending.setdefault(name, {})
+            self._write_metrics["writes"] += 1
+            if column in pending:
+                self._write_metrics["coalesced"] += 1
+            pending[column] = value
+            if self.journal_path:
+                if not self._journal:
+                    self._journal = open(self.journal_path, "a+b")
+                if column == "logged_in":
+                    value = value.strftime("%Y-%m-%d %H:%M:%S")
+                elif column == "story_data":
+                    value = [value[0], value[1].decode("utf-8")]
+                self._journal.write(json.dumps([name, column, value]).encode("utf-8") + b"\n")
+                self._journal.flush()
+
+    def _replay_journal(self) -> None:
+        # apply the writes of the journal that were not yet flushed to the database (the server crashed)
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb") as journal:
+            lines = journal.readlines()
+        for line in lines:
+            try:
+                name, column, value = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue    # the last line may be incomplete
+            if column == "logged_in":
+                value = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            elif column == "story_data":
+                value = (value[0], value[1].encode("utf-8"))
+            self._pending.setdefault(name, {})[column] = value
+        if self._pending:
+            print("%s: Writing %d pending account updates from the journal." % (mud_context.config.name, len(self._pending)))
+            self.flush()
+        os.remove(self.journal_path)
+
+    def flush_due(self, now: float=None) -> bool:
+        """Are there pending writes, and is it time to flush them?"""
+        return bool(self._pending) and (now or time.time()) >= self._last_flush + self.flush_interval
+
+    def flush(self) -> int:
+        """Writes all pending account data to the database in one transaction. Returns the number of accounts written."""
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = {}
+            journal_position = self._journal.tell() if self._journal else 0
+        start = time.time()
+        self._last_flush = start
+        if not pending:
+            return 0
+        try:
+            with self._sqlite_connect() as conn:
+                for name, columns in pending.items():
+                    if "logged_in" in columns:
+                        conn.execute("UPDATE Account SET logged_in=? WHERE name=?", (columns["logged_in"], name))
+                    if "story_data" in columns:
+                        result = conn.execute("SELECT id FROM Account WHERE name=?", (name,)).fetchone()
+                        if not result:
+                            continue
+                        account_id = result["id"]
+                        storydata_format, data = columns["story_data"]
+                        result = conn.execute("UPDATE StoryData SET format=?, data=? WHERE account=?", (storydata_format, data, account_id))
+                        if result.rowcount == 0:
+                            # there's no storydata yet, insert it
+                            conn.execute("INSERT INTO StoryData(account, format, data) VALUES (?,?,?)",
+                                         (account_id, storydata_format, data))
+        except Exception:
+            with self._pending_lock:
+                # put the writes back, under the ones that were made in the meantime
+                for name, columns in pending.items():
+                    columns.update(self._pending.get(name, {}))
+                    self._pending[name] = columns
+            raise
+        with self._pending_lock:
+            if self._journal:
+                # the journal only needs to keep what was written after the flush started
+                self._journal.seek(journal_position)
+                remaining = self._journal.read()
+                self._journal.seek(0)
+                self._journal.truncate()
+                self._journal.write(remaining)
+                self._journal.flush()
+            self._write_metrics["flushes"] += 1
+            self._write_metrics["flushed_accounts"] += len(pending)
+            self._write_metrics["last_flush_duration"] = time.time() - start
+        return len(pending)
+
+    def write_metrics(self) -> Dict[str, Any]:
+        """Statistics of the write behind buffer. 'dirty' is the number of accounts with pending writes."""
+        with self._pending_lock:
+            metrics = dict(self._write_metrics)
+            metrics["dirty"] = len(self._pending)
+            metrics["journal_size"] = self._journal.tell() if self._journal else 0
+        return metrics
 
     @util.authorized("wizard")
     def update_privileges(self, name: str, privileges: Set[str], actor: player.Player) -> Set[str]:
@@ -305,6 +594,7 @@ class MudAccounts:
             conn.execute("DELETE FROM Privilege WHERE account=?", (account_id,))
             for privilege in privileges:
                 conn.execute("INSERT INTO Privilege(account, privilege) VALUES (?,?)", (account_id, privilege))
+        self._has_wizard = None
         return privileges
 
     @util.authorized("wizard")
@@ -379,3 +669,40 @@ bitch
 motherfucker
 fucker
 """.split()
+
+
+class AccountService:
+    """
+    Does the (potentially slow) database work and password hashing of the accounts in a pool of worker threads,
+    so that it doesn't stall the driver's main loop (the hash functions release the GIL while they run).
+    Every method returns a Future for the result.
+    A dialog in the driver can wait for it with:  result = yield "await-result", future
+    """
+    def __init__(self, accounts: MudAccounts, workers: int=2) -> None:
+        self.accounts = accounts
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def get(self, name: str) -> Future:
+        return self.executor.submit(self.accounts.get, name)
+
+    def valid_password(self, name: str, password: str) -> Future:
+        return self.executor.submit(self.accounts.valid_password, name, password)
+
+    def create(self, name: str, password: str, email: str, stats: base.Stats, privileges: Set[str]=set()) -> Future:
+        return self.executor.submit(self.accounts.create, name, password, email, stats, privileges)
+
+    def change_password_email(self, name: str, old_password: str, new_password: str="", new_email: str="") -> Future:
+        return self.executor.submit(self.accounts.change_password_email, name, old_password, new_password, new_email)
+
+    def logged_in(self, name: str) -> Future:
+        return self.executor.submit(self.accounts.logged_in, name)
+
+    def save_story_data(self, name: str, story_data: Dict[Any, Any]) -> Future:
+        # the data is copied because the caller may keep changing it while it is being saved
+        return self.executor.submit(self.accounts.save_story_data, name, copy.deepcopy(story_data))
+
+    def flush(self) -> Future:
+        return self.executor.submit(self.accounts.flush)
+
+    def shutdown(self, wait: bool=True) -> None:
+        self.executor.shutdown(wait)
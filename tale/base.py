@@ -37,13 +37,15 @@ Use its enter/leave methods instead.
 
 import builtins
 import copy
+import itertools
 import random
 import re
-from weakref import WeakValueDictionary
+from weakref import WeakValueDictionary, WeakSet
 from collections import OrderedDict
 from textwrap import dedent
 from types import ModuleType
-from typing import Iterable, Any, Sequence, Optional, Set, Dict, Union, FrozenSet, Tuple, List, Type, no_type_check
+from typing import Iterable, Iterator, Any, Sequence, Optional, Set, AbstractSet, Dict, Union, FrozenSet, Tuple, List, Type, \
+    no_type_check
 
 from . import lang
 from . import mud_context
@@ -157,6 +159,228 @@ class ParseResult:
         return "\n".join(s)
 
 
+class _VerbsDict(dict):
+    """
+    The custom verbs dict of a MudObject (verb -> help text).
+    Changes are reported to the object, so that the verb index of the location or living it's in, stays up to date.
+    """
+    def __init__(self, owner: 'MudObject', verbs: Dict[str, str]) -> None:
+        super().__init__(verbs)
+        self.owner = owner
+
+    def __deepcopy__(self, memo: Dict) -> '_VerbsDict':
+        return _VerbsDict(copy.deepcopy(self.owner, memo), copy.deepcopy(dict(self), memo))
+
+    def _changed(self) -> None:
+        self.owner._dirty = True
+        self.owner._verbs_changed()
+
+    def __setitem__(self, verb: str, helptext: str) -> None:
+        super().__setitem__(verb, helptext)
+        self._changed()
+
+    def __delitem__(self, verb: str) -> None:
+        super().__delitem__(verb)
+        self._changed()
+
+    def clear(self) -> None:
+        super().clear()
+        self._changed()
+
+    def pop(self, *args: Any) -> Any:
+        result = super().pop(*args)
+        self._changed()
+        return result
+
+    def popitem(self) -> Tuple[str, str]:
+        result = super().popitem()
+        self._changed()
+        return result
+
+    def setdefault(self, verb: str, helptext: str="") -> str:
+        result = super().setdefault(verb, helptext)
+        self._changed()
+        return result
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        super().update(*args, **kwargs)
+        self._changed()
+
+
+class _VerbIndex:
+    """
+    Incrementally maintained index of the custom verbs of the objects in a location or living's inventory.
+    Objects are (re)indexed when they are inserted or when their verbs change, and removed when they leave.
+    """
+    def __init__(self) -> None:
+        self.verbs = {}     # type: Dict[str, Dict[MudObject, str]]  # verb -> {object: help text}
+        self.objects = {}   # type: Dict[MudObject, Tuple[str, ...]]  # object -> the verbs that were indexed for it
+
+    def add(self, obj: 'MudObject') -> None:
+        if obj in self.objects:
+            self.remove(obj)
+        if obj.verbs:
+            self.objects[obj] = tuple(obj.verbs)
+            for verb, helptext in obj.verbs.items():
+                self.verbs.setdefault(verb, {})[obj] = helptext
+
+    def remove(self, obj: 'MudObject') -> None:
+        for verb in self.objects.pop(obj, ()):
+            providers = self.verbs[verb]
+            del providers[obj]
+            if not providers:
+                del self.verbs[verb]
+
+    def clear(self) -> None:
+        self.verbs.clear()
+        self.objects.clear()
+
+    def helptexts(self) -> Dict[str, str]:
+        return {verb: next(iter(providers.values())) for verb, providers in self.verbs.items()}
+
+
+class _AliasSet(set):
+    """
+    The set of aliases of a MudObject.
+    Changes are reported to the object, so that the name index of the location or living it's in, stays up to date.
+    """
+    def __init__(self, owner: 'MudObject', aliases: Iterable[str]) -> None:
+        super().__init__(aliases)
+        self.owner = owner
+
+    def __deepcopy__(self, memo: Dict) -> '_AliasSet':
+        return _AliasSet(copy.deepcopy(self.owner, memo), set(self))
+
+    def _changed(self, result: Any=None) -> Any:
+        self.owner._dirty = True
+        self.owner._names_changed()
+        return result
+
+    def add(self, alias: str) -> None:
+        self._changed(super().add(alias))
+
+    def remove(self, alias: str) -> None:
+        self._changed(super().remove(alias))
+
+    def discard(self, alias: str) -> None:
+        self._changed(super().discard(alias))
+
+    def pop(self) -> str:
+        return self._changed(super().pop())
+
+    def clear(self) -> None:
+        self._changed(super().clear())
+
+    def update(self, *others: Iterable[str]) -> None:
+        self._changed(super().update(*others))
+
+    def difference_update(self, *others: Iterable[str]) -> None:
+        self._changed(super().difference_update(*others))
+
+    def intersection_update(self, *others: Iterable[str]) -> None:
+        self._changed(super().intersection_update(*others))
+
+    def symmetric_difference_update(self, other: Iterable[str]) -> None:
+        self._changed(super().symmetric_difference_update(other))
+
+    def __ior__(self, other: AbstractSet[str]) -> '_AliasSet':
+        return self._changed(super().__ior__(other))
+
+    def __iand__(self, other: AbstractSet[str]) -> '_AliasSet':
+        return self._changed(super().__iand__(other))
+
+    def __isub__(self, other: AbstractSet[str]) -> '_AliasSet':
+        return self._changed(super().__isub__(other))
+
+    def __ixor__(self, other: AbstractSet[str]) -> '_AliasSet':
+        return self._changed(super().__ixor__(other))
+
+
+class _NameIndex:
+    """
+    Incrementally maintained index of the names and aliases of the livings or items in a location or living's inventory.
+    Objects are (re)indexed when they are inserted or when they are renamed, and removed when they leave.
+    All names are also put in a trie of their words, so names consisting of multiple words
+    can be matched against the words of a sentence without building candidate strings.
+    """
+    def __init__(self) -> None:
+        self.source = None  # type: Any  # the collection that the index was last rebuilt from
+        self.names = {}     # type: Dict[str, Dict[MudObject, None]]  # name -> objects known by that name
+        self.objects = {}   # type: Dict[MudObject, Tuple[str, ...]]  # object -> the names that were indexed for it
+        self.trie = {}      # type: Dict[Optional[str], Any]  # word -> subtrie, the None key marks the end of a name
+
+    def add(self, obj: 'MudObject') -> None:
+        if obj in self.objects:
+            self.remove(obj)
+        names = tuple({obj.name} | set(obj.aliases))
+        self.objects[obj] = names
+        for name in names:
+            objects = self.names.get(name)
+            if objects is None:
+                self.names[name] = {obj: None}
+                node = self.trie
+                for word in name.split(" "):
+                    node = node.setdefault(word, {})
+                node[None] = True
+            else:
+                objects[obj] = None
+
+    def remove(self, obj: 'MudObject') -> None:
+        for name in self.objects.pop(obj, ()):
+            objects = self.names[name]
+            del objects[obj]
+            if not objects:
+                del self.names[name]
+                path = []
+                node = self.trie
+                for word in name.split(" "):
+                    path.append((node, word))
+                    node = node[word]
+                del node[None]
+                for parent, word in reversed(path):
+                    if parent[word]:
+                        break
+                    del parent[word]
+
+    def clear(self) -> None:
+        self.names.clear()
+        self.objects.clear()
+        self.trie.clear()
+
+    def rebuild(self, source: Iterable['MudObject']) -> None:
+        self.clear()
+        for obj in source:
+            self.add(obj)
+        self.source = source
+
+    def get(self, name: str) -> Optional['MudObject']:
+        objects = self.names.get(name)
+        return next(iter(objects)) if objects else None
+
+    def match(self, words: Sequence[str], startindex: int, maxwords: int=5) -> int:
+        """
+        Returns the number of words of the shortest name that matches the words starting at startindex,
+        or 0 if there is no such name (names longer than maxwords are not considered).
+        """
+        node = self.trie
+        for wordcount, word in enumerate(words[startindex:startindex + maxwords], start=1):
+            node = node.get(word)
+            if node is None:
+                return 0
+            if None in node:
+                return wordcount
+        return 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __bool__(self) -> bool:
+        return bool(self.objects)
+
+
 class MudObjRegistry:
     # the vnum machinery for all created MudObjects:
     seq_nr = 1
@@ -249,11 +473,17 @@ class MudObject:
     includes the tantalizing sentence, ``The wall looks strange here.``
     Using extra descriptions, players could then see additional detail by typing
     ``look at wall.``  There can be an unlimited number of Extra Descriptions.
+
+    An incremental save game contains just the objects whose state changed since the previous save,
+    which is found out by comparing their states. Objects can also be marked as changed (the _dirty flag)
+    to make sure they're saved; changing the name, title, descriptions, aliases or verbs,
+    moving things around, and opening, closing or locking things does this automatically.
     """
     subjective = "it"
     possessive = "its"
     objective = "it"
     gender = "n"
+    _dirty = True   # new objects are 'changed' as well
 
     @staticmethod
     def __new__(cls, *args, **kwargs):
@@ -288,6 +518,50 @@ class MudObject:
         """
         pass
 
+    def mark_dirty(self) -> None:
+        """Mark the object as changed, so that it's always included in the next (incremental) save game."""
+        self._dirty = True
+
+    @property
+    def verbs(self) -> Dict[str, str]:
+        """custom verbs that need to be recognised (verb->docstring mapping), verb handling is done via handle_verb() callbacks."""
+        return self._verbs
+
+    @verbs.setter
+    def verbs(self, verbs: Dict[str, str]) -> None:
+        self._verbs = _VerbsDict(self, verbs)
+        self._dirty = True
+        self._verbs_changed()
+
+    def _verbs_changed(self) -> None:
+        # update the verb index of whatever this object is in (if that keeps one)
+        pass
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @name.setter
+    def name(self, value: str) -> None:
+        self._name = value
+        self._dirty = True
+        self._names_changed()
+
+    @property
+    def aliases(self) -> Set[str]:
+        """other names this object is known by. Changes to it are tracked if it is a set."""
+        return self._aliases
+
+    @aliases.setter
+    def aliases(self, aliases: Iterable[str]) -> None:
+        self._aliases = _AliasSet(self, aliases) if isinstance(aliases, set) else aliases
+        self._dirty = True
+        self._names_changed()
+
+    def _names_changed(self) -> None:
+        # update the name index of whatever this object is in (if that keeps one)
+        pass
+
     @property
     def title(self) -> str:
         return self._title
@@ -295,6 +569,7 @@ class MudObject:
     @title.setter
     def title(self, value: str) -> None:
         self._title = value
+        self._dirty = True
 
     @property
     def description(self) -> str:
@@ -303,6 +578,7 @@ class MudObject:
     @description.setter
     def description(self, value: str) -> None:
         self._description = value
+        self._dirty = True
 
     @property
     def short_description(self) -> str:
@@ -311,6 +587,7 @@ class MudObject:
     @short_description.setter
     def short_description(self, value: str) -> None:
         self._short_description = value
+        self._dirty = True
 
     @property
     def extra_desc(self) -> Dict[str, str]:
@@ -320,6 +597,7 @@ class MudObject:
     def extra_desc(self, value: Dict[str, str]) -> None:
         assert isinstance(value, dict)
         self._extradesc = value
+        self._dirty = True
 
     def init_names(self, name: str, title: str, descr: str, short_descr: str) -> None:
         """(re)set the name and description attributes"""
@@ -340,6 +618,7 @@ class MudObject:
         """For the set of keywords, add the extra description text"""
         for keyword in keywords:
             self._extradesc[keyword] = description
+        self._dirty = True
 
     def __repr__(self):
         return "<%s '%s' #%d @ 0x%x>" % (self.__class__.__name__, self.name, self.vnum, id(self))
@@ -434,6 +713,16 @@ class Item(MudObject):
     def __contains__(self, item: 'Item') -> bool:
         raise ActionRefused("You can't look inside of that.")
 
+    def _verbs_changed(self) -> None:
+        container = getattr(self, "contained_in", None)
+        if isinstance(container, (Location, Living)) and self in container:
+            container._verb_index.add(self)
+
+    def _names_changed(self) -> None:
+        container = getattr(self, "contained_in", None)
+        if isinstance(container, (Location, Living)) and self in container:
+            container._item_names.add(self)
+
     @property
     def location(self) -> Optional['Location']:
         if not self.contained_in:
@@ -449,6 +738,7 @@ class Item(MudObject):
     def location(self, value: 'Location') -> None:
         if value is None or isinstance(value, Location):
             self.contained_in = value
+            self._dirty = True
         else:
             raise TypeError("can only set item's location to a Location, for other container types use item.contained_in")
 
@@ -586,6 +876,21 @@ class Armour(Item):
     pass
 
 
+def broadcast(livings: Iterable['Living'], message: str) -> None:
+    """
+    Tells the same message to all the given livings. The message is converted to str only once,
+    and livings that don't override tell() receive it directly (players in their text buffer)
+    instead of via their tell method. Used by Location.tell to message everyone in a room.
+    """
+    message = str(message)
+    for living in livings:
+        cls = type(living)
+        if cls.tell is cls._hear_tell:
+            living._hear(message)
+        else:
+            living.tell(message)
+
+
 class Location(MudObject):
     """
     A location in the mud world. Livings and Items are in it.
@@ -597,6 +902,11 @@ class Location(MudObject):
         self.livings = set()  # type: Set[Living] # set of livings in this location
         self.items = set()    # type: Set[Item] # set of all items in the room
         self.exits = {}       # type: Dict[str, Exit] # dictionary of all exits: exit_direction -> Exit object with target & descr
+        self._verb_index = _VerbIndex()     # custom verbs of the livings, items and exits in here
+        self._living_names = _NameIndex()   # names of the livings in here
+        self._living_names.source = self.livings
+        self._item_names = _NameIndex()     # names of the items in here
+        self._item_names.source = self.items
         super().__init__(name, descr=descr)
         self.name = name      # make sure we preserve the case; base object overwrites it in lowercase
 
@@ -618,6 +928,27 @@ class Location(MudObject):
         self.livings.clear()
         self.items.clear()
         self.exits.clear()
+        self._dirty = True
+        self._verb_index.clear()
+        self._living_names.clear()
+        self._item_names.clear()
+
+    def _reindex_verbs(self) -> None:
+        # rebuild the verb index from scratch, needed when the contents were replaced directly
+        self._verb_index.clear()
+        for obj in itertools.chain(self.livings, self.items, self.exits.values()):
+            self._verb_index.add(obj)
+
+    def _name_indexes(self) -> Tuple[_NameIndex, _NameIndex]:
+        """
+        The name indexes of the livings and of the items in here.
+        They're rebuilt if the livings or items set was replaced directly.
+        """
+        if self._living_names.source is not self.livings:
+            self._living_names.rebuild(self.livings)
+        if self._item_names.source is not self.items:
+            self._item_names.rebuild(self.items)
+        return self._living_names, self._item_names
 
     def add_exits(self, exits: Iterable['Exit']) -> None:
         """Adds every exit from the sequence as an exit to this room."""
@@ -626,9 +957,13 @@ class Location(MudObject):
             # note: we're not simply adding it to the .exits dict here, because
             # the exit may have aliases defined that it wants to be known as also.
 
+    def _names_changed(self) -> None:
+        self._wiretap = None   # the wiretap topic is named after the location
+
     def get_wiretap(self) -> pubsub.Topic:
         """get a wiretap for this location"""
-        return pubsub.topic(("wiretap-location", "%s#%d" % (self.name, self.vnum)))
+        self._wiretap = pubsub.topic(("wiretap-location", "%s#%d" % (self.name, self.vnum)))
+        return self._wiretap
 
     def tell(self, room_msg: str, exclude_living: 'Living'=None, specific_targets: Set[Union[ParsedWhoType]]=None,
              specific_target_msg: str="") -> None:
@@ -641,16 +976,24 @@ class Location(MudObject):
         targets = specific_targets or set()
         assert isinstance(targets, (frozenset, set, list, tuple))
         assert exclude_living is None or isinstance(exclude_living, Living)
-        for living in self.livings:
-            if living == exclude_living:
-                continue
-            if living in targets:
-                living.tell(specific_target_msg)
-            else:
-                living.tell(room_msg)
+        if targets:
+            receivers = []   # type: List[Living]
+            for living in self.livings:
+                if living == exclude_living:
+                    continue
+                if living in targets:
+                    living.tell(specific_target_msg)
+                else:
+                    receivers.append(living)
+            broadcast(receivers, room_msg)
+        elif exclude_living is None:
+            broadcast(self.livings, room_msg)
+        else:
+            broadcast([living for living in self.livings if living != exclude_living], room_msg)
         if room_msg:
-            tap = self.get_wiretap()
-            tap.send((self.name, room_msg))
+            tap = self._wiretap
+            if tap is not None and tap.subscribers:
+                tap.send((self.name, room_msg))
 
     def message_nearby_locations(self, message: str) -> None:
         """
@@ -766,22 +1109,30 @@ class Location(MudObject):
         assert obj is not None
         if isinstance(obj, Living):
             self.livings.add(obj)
+            self._living_names.add(obj)
         elif isinstance(obj, Item):
             self.items.add(obj)
+            self._item_names.add(obj)
         else:
             raise TypeError("can only add Living or Item")
         obj.location = self
+        self._dirty = True
+        self._verb_index.add(obj)
 
     def remove(self, obj: Union['Living', Item], actor: Optional['Living']) -> None:
         """Remove obj from this location (either a Living or an Item)"""
         assert obj is not None
         if obj in self.livings:
             self.livings.remove(obj)    # type: ignore
+            self._living_names.remove(obj)
         elif obj in self.items:
             self.items.remove(obj)      # type: ignore
+            self._item_names.remove(obj)
         else:
             return   # just ignore an object that wasn't present in the first place
         obj.location = None
+        self._dirty = True
+        self._verb_index.remove(obj)
 
     def handle_verb(self, parsed: ParseResult, actor: 'Living') -> bool:
         """
@@ -941,6 +1292,8 @@ class Living(MudObject):
         self.money = 0.0  # the currency is determined by util.MoneyFormatter set in the driver
         self.default_verb = "examine"
         self.__inventory = set()   # type: Set[Item]
+        self._verb_index = _VerbIndex()     # custom verbs of the items in the inventory
+        self._item_names = _NameIndex()     # names of the items in the inventory
         self.previous_commandline = ""
         self._previous_parse = ParseResult("")
         self.teleported_from = None   # type: Optional[Location]   # used by teleport/return commands
@@ -948,6 +1301,17 @@ class Living(MudObject):
         self.is_pet = False   # set this to True if creature is/becomes someone's pet
         super().__init__(name, title=title, descr=descr, short_descr=short_descr)
 
+    def _verbs_changed(self) -> None:
+        location = getattr(self, "location", None)
+        if location is not None and self in location.livings:
+            location._verb_index.add(self)
+
+    def _names_changed(self) -> None:
+        self._wiretap = None   # the wiretap topic is named after the living
+        location = getattr(self, "location", None)
+        if location is not None and self in location.livings:
+            location._living_names.add(self)
+
     def init_gender(self, gender: str) -> None:
         """(re)set gender attributes"""
         self.gender = gender
@@ -989,6 +1353,9 @@ class Living(MudObject):
                 raise
         self.__inventory.add(item)
         item.contained_in = self
+        item._dirty = self._dirty = True
+        self._verb_index.add(item)
+        self._item_names.add(item)
 
     def remove(self, item: Union['Living', Item], actor: Optional['Living']) -> None:
         """remove an item from the inventory"""
@@ -998,6 +1365,9 @@ class Living(MudObject):
         if actor is self or actor is not None and "wizard" in actor.privileges:
             self.__inventory.remove(item)
             item.contained_in = None
+            item._dirty = self._dirty = True
+            self._verb_index.remove(item)
+            self._item_names.remove(item)
         else:
             raise ActionRefused("You can't take %s from %s." % (item.title, self.title))
 
@@ -1005,10 +1375,15 @@ class Living(MudObject):
         super().destroy(ctx)
         if self.location and self in self.location.livings:
             self.location.livings.remove(self)
+            self.location._dirty = True
+            self.location._verb_index.remove(self)
+            self.location._living_names.remove(self)
         self.location = _limbo
         for item in self.__inventory:
             item.destroy(ctx)
         self.__inventory.clear()
+        self._verb_index.clear()
+        self._item_names.clear()
         # @todo: remove attack status, etc.
         self.soul = None   # type: ignore  # truly die ;-)
 
@@ -1017,8 +1392,9 @@ class Living(MudObject):
         if make_clone:
             # avoid deepcopying the location
             location, self.location = self.location, _limbo
+            wiretap, self._wiretap = self._wiretap, None
             duplicate = copy.deepcopy(self)
-            self.location = location
+            self.location, self._wiretap = location, wiretap
             MudObjRegistry.track_vnum(duplicate, fix_clones=True)   # deepcopy overwrites initially given vnum so make a new one
             mud_context.driver.register_periodicals(duplicate)
         else:
@@ -1050,7 +1426,8 @@ class Living(MudObject):
 
     def get_wiretap(self) -> pubsub.Topic:
         """get a wiretap for this living"""
-        return pubsub.topic(("wiretap-living", "%s#%d" % (self.name, self.vnum)))
+        self._wiretap = pubsub.topic(("wiretap-living", "%s#%d" % (self.name, self.vnum)))
+        return self._wiretap
 
     def tell(self, message: str, *, end: bool=False, format: bool=True) -> 'Living':
         """
@@ -1066,10 +1443,20 @@ class Living(MudObject):
         Note: end and format parameters are ignored for Livings but may be
         useful when this function is called on a subclass such as Player.
         """
-        tap = self.get_wiretap()
-        tap.send((self.name, str(message)))
+        tap = self._wiretap
+        if tap is not None and tap.subscribers:
+            tap.send((self.name, str(message)))
         return self
 
+    _hear_tell = tell   # the tell method that _hear is equivalent to, see broadcast()
+
+    def _hear(self, message: str) -> None:
+        # receive an already formatted message that is broadcast to many livings at once.
+        # Must have the same effect as tell(message), but it is cheaper.
+        tap = self._wiretap
+        if tap is not None and tap.subscribers:
+            tap.send((self.name, message))
+
     def tell_later(self, message: str) -> None:
         """Tell something to this creature, but do it after all other messages."""
         pending_tells.send(lambda: self.tell(message))
@@ -1419,8 +1806,10 @@ class Container(Item):
         """Set the container's initial inventory"""
         assert len(self.__inventory) == 0
         self.__inventory = set(items)
+        self._dirty = True
         for item in items:
             item.contained_in = self
+            item._dirty = True
 
     @property
     def inventory(self) -> FrozenSet[Item]:
@@ -1437,6 +1826,7 @@ class Container(Item):
         for item in self.__inventory:
             item.destroy(ctx)
         self.__inventory.clear()
+        self._dirty = True
         super().destroy(ctx)
 
     def insert(self, item: Union[Living, Item], actor: Optional[Living]) -> None:
@@ -1445,6 +1835,7 @@ class Container(Item):
             raise ActionRefused("You can't do that.")
         self.__inventory.add(item)
         item.contained_in = self
+        item._dirty = self._dirty = True
 
     def remove(self, item: Union[Living, Item], actor: Optional[Living]) -> None:
         assert item is not None
@@ -1452,6 +1843,7 @@ class Container(Item):
             raise ActionRefused("You can't do that.")
         self.__inventory.remove(item)
         item.contained_in = None
+        item._dirty = self._dirty = True
 
 
 class Exit(MudObject):
@@ -1486,6 +1878,7 @@ class Exit(MudObject):
             self._target_str = target_location
             title = "Exit to <unbound:%s>" % target_location
         long_descr = long_descr or short_descr
+        self._bound_locations = WeakSet()   # type: WeakSet[Location]
         # the name of the exit/door is the first direction given (any others are aliases)
         super().__init__(direction, title=title, descr=long_descr, short_descr=short_descr)
         self.aliases = aliases
@@ -1526,6 +1919,13 @@ class Exit(MudObject):
             if direction in location.exits:
                 raise LocationIntegrityError("exit already exists: '%s' in %s" % (direction, location), direction, self, location)
             location.exits[direction] = self
+        location._dirty = True
+        self._bound_locations.add(location)
+        location._verb_index.add(self)
+
+    def _verbs_changed(self) -> None:
+        for location in getattr(self, "_bound_locations", ()):
+            location._verb_index.add(self)
 
     def _bind_target(self, game_zones_module: ModuleType) -> None:
         """
@@ -1545,7 +1945,7 @@ class Exit(MudObject):
                                      (target_module, target_object, self.short_description))
             assert isinstance(target, Location)
             self.target = target
-            self.title = "Exit to " + target.title
+            self.title = "Exit to " + target.title   # this marks it dirty as well
             del self._target_str
 
     def allow_passage(self, actor: Living) -> None:
@@ -1613,6 +2013,7 @@ class Door(Exit):
         self.linked_door = other_door
         other_door.linked_door = self
         other_door.key_code = self.key_code
+        self._dirty = True
         return other_door
 
     @property
@@ -1650,10 +2051,12 @@ class Door(Exit):
             raise ActionRefused("You try to open it, but it's locked.")
         else:
             self.opened = True
+            self._dirty = True
             actor.tell("You open it.")
             actor.tell_others("{Actor} opens the %s." % self.name)
             if self.linked_door:
                 self.linked_door.opened = True
+                self.linked_door._dirty = True
                 self.target.tell("The %s is opened from the other side." % self.linked_door.name)
 
     def close(self, actor: Living, item: Item=None) -> None:
@@ -1661,10 +2064,12 @@ class Door(Exit):
         if not self.opened:
             raise ActionRefused("It's already closed.")
         self.opened = False
+        self._dirty = True
         actor.tell("You close it.")
         actor.tell_others("{Actor} closes the %s." % self.name)
         if self.linked_door:
             self.linked_door.opened = False
+            self.linked_door._dirty = True
             self.target.tell("The %s is closed from the other side." % self.linked_door.name)
 
     def lock(self, actor: Living, item: Item=None) -> None:
@@ -1685,10 +2090,12 @@ class Door(Exit):
             if not key:
                 raise ActionRefused("You don't seem to have the means to lock it.")
         self.locked = True
+        self._dirty = True
         actor.tell("Your %s fits, the %s is now locked." % (key.title, self.name))
         actor.tell_others("{Actor} locks the %s with %s." % (self.name, lang.a(key.title)))
         if self.linked_door:
             self.linked_door.locked = True
+            self.linked_door._dirty = True
             self.target.tell("The %s is locked from the other side." % self.linked_door.name)
 
     def unlock(self, actor: Living, item: Item=None) -> None:
@@ -1710,11 +2117,13 @@ class Door(Exit):
                 raise ActionRefused("You don't seem to have the means to unlock it.")
         self.locked = False
         self.opened = True
+        self._dirty = True
         actor.tell("Your %s fits! You unlock the %s and open it." % (key.title, self.name))
         actor.tell_others("{Actor} unlocks the %s with %s %s, and opens it." % (self.name, actor.possessive, key.title))
         if self.linked_door:
             self.linked_door.locked = False
             self.linked_door.opened = True
+            self.linked_door._dirty = True
             self.target.tell("The %s is unlocked and opened from the other side." % self.linked_door.name)
 
     def check_key(self, item: Item) -> bool:
@@ -1728,6 +2137,7 @@ class Door(Exit):
                 raise TaleError("door key codes must match")
             else:
                 self.key_code = other_code
+                self._dirty = True
         return key_code and key_code == self.key_code
 
     def search_key(self, actor: Living) -> Optional[Item]:
@@ -1757,6 +2167,7 @@ class Key(Item):
 
     def key_for(self, door: Door=None, code: str="") -> None:
         """Makes this key a key for the given door. (basically just copies the door's key_code)"""
+        self._dirty = True
         if code:
             assert door is None
             self.key_code = code
@@ -1766,6 +2177,96 @@ class Key(Item):
                 raise LocationIntegrityError("door has no key_code set", "", door, door.target)
 
 
+class _VerbTemplates:
+    """
+    The message templates of a soul verb, precompiled into sequences of segments.
+    A segment is either literal text or one of the placeholders (such as ' \nWHO' or '$') that are substituted
+    when the verb is used, so the messages can be rendered with a single join instead of a chain of replaces.
+    The placeholders are substituted in the same way as a chain of str.replace calls on the verb text would.
+    Templates are compiled on first use and recompiled when the verb's definition changes.
+    """
+    _placeholders_regex = re.compile(r"( \n(?:WHO|YOUR|MY|POSS|IS|SUBJ|HOW|WHERE|WHAT|MSG))")
+    _placeholders_verb_ending_regex = re.compile(r"( \n(?:WHO|YOUR|MY|POSS|IS|SUBJ|HOW|WHERE|WHAT|MSG)|\$)")
+
+    def __init__(self, verb: str, verbdata: Tuple) -> None:
+        self.verbdata = verbdata
+        # variants for (no targets, with targets) -> (text to check for a person or None, action segments, room segments)
+        # if the room segments are None, the room text is the action text with the '$' verb endings turned into 's'.
+        self.variants = {}  # type: Dict[bool, Tuple[Optional[str], Tuple[str, ...], Optional[Tuple[str, ...]]]]
+        vtype = verbdata[0]
+        if vtype == verbdefs.DEUX:
+            variant = (verbdata[2], self.split(verbdata[2]), self.split(verbdata[3]))
+            self.variants = {False: variant, True: variant}
+        elif vtype == verbdefs.QUAD:
+            self.variants = {
+                False: (None, self.split(verbdata[2]), self.split(verbdata[3])),
+                True: (None, self.split(verbdata[4]), self.split(verbdata[5]))
+            }
+        elif vtype == verbdefs.FULL:
+            pass   # not used yet
+        elif vtype in (verbdefs.DEFA, verbdefs.PREV, verbdefs.PHYS, verbdefs.SHRT, verbdefs.PERS, verbdefs.SIMP):
+            for with_targets in (False, True):
+                if vtype == verbdefs.DEFA:
+                    action = verb + "$ \nHOW \nAT"
+                elif vtype == verbdefs.PREV:
+                    action = verb + "$" + Soul.spacify(verbdata[2]) + " \nWHO \nHOW"
+                elif vtype == verbdefs.PHYS:
+                    action = verb + "$" + Soul.spacify(verbdata[2]) + " \nWHO \nHOW \nWHERE"
+                elif vtype == verbdefs.SHRT:
+                    action = verb + "$" + Soul.spacify(verbdata[2]) + " \nHOW"
+                elif vtype == verbdefs.PERS:
+                    action = verbdata[3] if with_targets else verbdata[2]
+                else:
+                    action = verbdata[2]
+                if with_targets and len(verbdata) > 3:
+                    action = action.replace(" \nAT", Soul.spacify(verbdata[3]) + " \nWHO")
+                else:
+                    action = action.replace(" \nAT", "")
+                self.variants[with_targets] = (action, self.split(action, True), None)
+        else:
+            raise TaleError("invalid vtype " + vtype)
+
+    @classmethod
+    def split(cls, text: str, verb_endings: bool=False) -> Tuple[str, ...]:
+        regex = cls._placeholders_verb_ending_regex if verb_endings else cls._placeholders_regex
+        return tuple(segment for segment in regex.split(text) if segment)
+
+    @classmethod
+    def fill(cls, segments: Sequence[str], fields: Dict[str, str]) -> List[str]:
+        """
+        Substitutes the given placeholder fields, and strips the whitespace around the result.
+        Other placeholders are left in place. Placeholders in the substituted texts are recognised too.
+        """
+        result = []
+        for segment in segments:
+            if segment in fields:
+                text = fields[segment]
+                if "\n" in text or "$" in text:
+                    result.extend(fields.get(s, s) for s in cls.split(text, "$" in fields))
+                elif text:
+                    result.append(text)
+            else:
+                result.append(segment)
+        while result:
+            stripped = result[0].lstrip()
+            if stripped:
+                result[0] = stripped
+                break
+            del result[0]
+        while result:
+            stripped = result[-1].rstrip()
+            if stripped:
+                result[-1] = stripped
+                break
+            del result[-1]
+        return result
+
+    @staticmethod
+    def qualify(qualifier_text: str, segments: List[str]) -> List[str]:
+        prefix, suffix = (qualifier_text % "\0").split("\0")
+        return [prefix] + segments + [suffix]
+
+
 class Soul:
     """
     The 'soul' of a Living (most importantly, a Player).
@@ -1776,10 +2277,22 @@ class Soul:
     _quoted_message_regex = re.compile(r"('(?P<msg1>.*)')|(\"(?P<msg2>.*)\")")  # greedy single-or-doublequoted string match
     _skip_words = {"and", "&", "at", "to", "before", "in", "into", "on", "off", "onto",
                    "the", "with", "from", "after", "before", "under", "above", "next"}
+    _verb_templates = {}  # type: Dict[str, _VerbTemplates]  # compiled message templates of the soul verbs, shared by all souls
 
     def __init__(self) -> None:
         self.__previously_parsed = ParseResult("")
 
+    @classmethod
+    def compile_verbs(cls) -> None:
+        """
+        Compiles the message templates of all soul verbs that aren't compiled yet or whose definition has changed.
+        This is done at startup; verbs that are changed afterwards are (re)compiled when they're used.
+        """
+        for verb, verbdata in verbdefs.VERBS.items():
+            templates = cls._verb_templates.get(verb)
+            if templates is None or templates.verbdata is not verbdata:
+                cls._verb_templates[verb] = _VerbTemplates(verb, verbdata)
+
     def is_verb(self, verb: str) -> bool:
         return verb in verbdefs.VERBS
 
@@ -1816,7 +2329,6 @@ class Soul:
         message = parsed.message
         adverb = parsed.adverb
 
-        vtype = verbdata[0]
         if not message and verbdata[1] and len(verbdata[1]) > 1:
             message = verbdata[1][1]  # get the message from the verbs table
         if message:
@@ -1840,126 +2352,67 @@ class Soul:
             where = " " + verbdata[1][2]  # replace bodyparts string by specific one from verbs table
         how = self.spacify(adverb)
 
-        def result_messages(action: str, action_room: str) -> Tuple[Set[ParsedWhoType], str, str, str]:
-            action = action.strip()
-            action_room = action_room.strip()
-            if parsed.qualifier:
-                qual_action, qual_room, use_room_default = verbdefs.ACTION_QUALIFIERS[parsed.qualifier]
-                action_room = qual_room % action_room if use_room_default else qual_room % action
-                action = qual_action % action
-            # construct message seen by player
-            targetnames = [self.who_replacement(player, target, player) for target in parsed.who_info]
-            player_msg = action.replace(" \nWHO", " " + lang.join(targetnames))
-            player_msg = player_msg.replace(" \nYOUR", " your")
-            player_msg = player_msg.replace(" \nMY", " your")
-            # construct message seen by room
-            targetnames = [self.who_replacement(player, target, None) for target in parsed.who_info]
-            room_msg = action_room.replace(" \nWHO", " " + lang.join(targetnames))
-            room_msg = room_msg.replace(" \nYOUR", " " + player.possessive)
-            room_msg = room_msg.replace(" \nMY", " " + player.objective)
-            # construct message seen by targets
-            target_msg = action_room.replace(" \nWHO", " you")
-            target_msg = target_msg.replace(" \nYOUR", " " + player.possessive)
-            target_msg = target_msg.replace(" \nPOSS", " your")
-            target_msg = target_msg.replace(" \nIS", " are")
-            target_msg = target_msg.replace(" \nSUBJ", " you")
-            target_msg = target_msg.replace(" \nMY", " " + player.objective)
-            # fix up POSS, IS, SUBJ in the player and room messages
-            if parsed.who_count == 1:
-                only_living = parsed.who_1
-                subjective = getattr(only_living, "subjective", "it")  # if no subjective attr, use "it"
-                player_msg = player_msg.replace(" \nIS", " is")
-                player_msg = player_msg.replace(" \nSUBJ", " " + subjective)
-                player_msg = player_msg.replace(" \nPOSS", " " + Soul.poss_replacement(player, only_living, player))
-                room_msg = room_msg.replace(" \nIS", " is")
-                room_msg = room_msg.replace(" \nSUBJ", " " + subjective)
-                room_msg = room_msg.replace(" \nPOSS", " " + Soul.poss_replacement(player, only_living, None))
-            else:
-                targetnames_player = lang.join([Soul.poss_replacement(player, living, player) for living in parsed.who_info])
-                targetnames_room = lang.join([Soul.poss_replacement(player, living, None) for living in parsed.who_info])
-                player_msg = player_msg.replace(" \nIS", " are")
-                player_msg = player_msg.replace(" \nSUBJ", " they")
-                player_msg = player_msg.replace(" \nPOSS", " " + lang.possessive(targetnames_player))
-                room_msg = room_msg.replace(" \nIS", " are")
-                room_msg = room_msg.replace(" \nSUBJ", " they")
-                room_msg = room_msg.replace(" \nPOSS", " " + lang.possessive(targetnames_room))
-            # add fullstops at the end
-            player_msg = lang.fullstop("You " + player_msg)
-            room_msg = lang.capital(lang.fullstop(player.title + " " + room_msg))
-            target_msg = lang.capital(lang.fullstop(player.title + " " + target_msg))
-            if player in parsed.who_info:
-                who = set(parsed.who_info)
-                who.remove(player)  # the player should not be part of the remaining targets.
-                whof = set(who)
-            else:
-                whof = set(parsed.who_info)
-            return whof, player_msg, room_msg, target_msg
-
-        # construct the action string
-        action = None
-        if vtype == verbdefs.DEUX:
-            action = verbdata[2]
-            action_room = verbdata[3]
-            if not self.check_person(action, parsed):
-                raise ParseError("The verb %s needs a person." % parsed.verb)
-            action = action.replace(" \nWHERE", where)
-            action_room = action_room.replace(" \nWHERE", where)
-            action = action.replace(" \nWHAT", message)
-            action = action.replace(" \nMSG", msg)
-            action_room = action_room.replace(" \nWHAT", message)
-            action_room = action_room.replace(" \nMSG", msg)
-            action = action.replace(" \nHOW", how)
-            action_room = action_room.replace(" \nHOW", how)
-            return result_messages(action, action_room)
-        elif vtype == verbdefs.QUAD:
-            if parsed.who_info:
-                action = verbdata[4]
-                action_room = verbdata[5]
-            else:
-                action = verbdata[2]
-                action_room = verbdata[3]
-            action = action.replace(" \nWHERE", where)
-            action_room = action_room.replace(" \nWHERE", where)
-            action = action.replace(" \nWHAT", message)
-            action = action.replace(" \nMSG", msg)
-            action_room = action_room.replace(" \nWHAT", message)
-            action_room = action_room.replace(" \nMSG", msg)
-            action = action.replace(" \nHOW", how)
-            action_room = action_room.replace(" \nHOW", how)
-            return result_messages(action, action_room)
-        elif vtype == verbdefs.FULL:
+        templates = self._verb_templates.get(parsed.verb)
+        if templates is None or templates.verbdata is not verbdata:
+            templates = self._verb_templates[parsed.verb] = _VerbTemplates(parsed.verb, verbdata)
+        variant = templates.variants.get(bool(parsed.who_info))
+        if variant is None:
             raise TaleError("vtype verbdefs.FULL")  # doesn't matter, verbdefs.FULL is not used yet anyway
-        elif vtype == verbdefs.DEFA:
-            action = parsed.verb + "$ \nHOW \nAT"
-        elif vtype == verbdefs.PREV:
-            action = parsed.verb + "$" + self.spacify(verbdata[2]) + " \nWHO \nHOW"
-        elif vtype == verbdefs.PHYS:
-            action = parsed.verb + "$" + self.spacify(verbdata[2]) + " \nWHO \nHOW \nWHERE"
-        elif vtype == verbdefs.SHRT:
-            action = parsed.verb + "$" + self.spacify(verbdata[2]) + " \nHOW"
-        elif vtype == verbdefs.PERS:
-            action = verbdata[3] if parsed.who_count else verbdata[2]
-        elif vtype == verbdefs.SIMP:
-            action = verbdata[2]
-        else:
-            raise TaleError("invalid vtype " + vtype)
-
-        if parsed.who_info and len(verbdata) > 3:
-            action = action.replace(" \nAT", self.spacify(verbdata[3]) + " \nWHO")
-        else:
-            action = action.replace(" \nAT", "")
-
-        if not self.check_person(action, parsed):
+        person_check_action, action_segments, action_room_segments = variant
+        if person_check_action is not None and not self.check_person(person_check_action, parsed):
             raise ParseError("The verb %s needs a person." % parsed.verb)
 
-        action = action.replace(" \nHOW", how)
-        action = action.replace(" \nWHERE", where)
-        action = action.replace(" \nWHAT", message)
-        action = action.replace(" \nMSG", msg)
-        action_room = action
-        action = action.replace("$", "")
-        action_room = action_room.replace("$", "s")
-        return result_messages(action, action_room)
+        # fill in the parts that are the same for every observer
+        if action_room_segments is None:
+            # the room text is the same as the player's text, except for the verb endings
+            fields = {" \nHOW": how, " \nWHERE": where, " \nWHAT": message, " \nMSG": msg, "$": ""}
+            action = _VerbTemplates.fill(action_segments, fields)
+            fields["$"] = "s"
+            action_room = _VerbTemplates.fill(action_segments, fields)
+        else:
+            fields = {" \nHOW": how, " \nWHERE": where, " \nWHAT": message, " \nMSG": msg}
+            action = _VerbTemplates.fill(action_segments, fields)
+            action_room = _VerbTemplates.fill(action_room_segments, fields)
+        if parsed.qualifier:
+            qual_action, qual_room, use_room_default = verbdefs.ACTION_QUALIFIERS[parsed.qualifier]
+            action_room = _VerbTemplates.qualify(qual_room, action_room if use_room_default else action)
+            action = _VerbTemplates.qualify(qual_action, action)
+
+        # fill in the rest, for the player, the room, and the targets (only the placeholders that are used)
+        player_fields = {" \nYOUR": " your", " \nMY": " your"}
+        room_fields = {" \nYOUR": " " + player.possessive, " \nMY": " " + player.objective}
+        target_fields = {" \nWHO": " you", " \nYOUR": " " + player.possessive, " \nMY": " " + player.objective,
+                         " \nIS": " are", " \nSUBJ": " you", " \nPOSS": " your"}
+        used = set(action).union(action_room)
+        if " \nWHO" in used:
+            player_fields[" \nWHO"] = " " + lang.join([self.who_replacement(player, target, player) for target in parsed.who_info])
+            room_fields[" \nWHO"] = " " + lang.join([self.who_replacement(player, target, None) for target in parsed.who_info])
+        if parsed.who_count == 1:
+            only_living = parsed.who_1
+            player_fields[" \nIS"] = room_fields[" \nIS"] = " is"
+            subjective = getattr(only_living, "subjective", "it")  # if no subjective attr, use "it"
+            player_fields[" \nSUBJ"] = room_fields[" \nSUBJ"] = " " + subjective
+            if " \nPOSS" in used:
+                player_fields[" \nPOSS"] = " " + Soul.poss_replacement(player, only_living, player)
+                room_fields[" \nPOSS"] = " " + Soul.poss_replacement(player, only_living, None)
+        else:
+            player_fields[" \nIS"] = room_fields[" \nIS"] = " are"
+            player_fields[" \nSUBJ"] = room_fields[" \nSUBJ"] = " they"
+            if " \nPOSS" in used:
+                player_fields[" \nPOSS"] = " " + lang.possessive(lang.join([Soul.poss_replacement(player, living, player)
+                                                                           for living in parsed.who_info]))
+                room_fields[" \nPOSS"] = " " + lang.possessive(lang.join([Soul.poss_replacement(player, living, None)
+                                                                         for living in parsed.who_info]))
+        player_msg = "".join([player_fields.get(segment, segment) for segment in action])
+        room_msg = "".join([room_fields.get(segment, segment) for segment in action_room])
+        target_msg = "".join([target_fields.get(segment, segment) for segment in action_room])
+        # add fullstops at the end
+        player_msg = lang.fullstop("You " + player_msg)
+        room_msg = lang.capital(lang.fullstop(player.title + " " + room_msg))
+        target_msg = lang.capital(lang.fullstop(player.title + " " + target_msg))
+        who = set(parsed.who_info)
+        who.discard(player)  # the player should not be part of the remaining targets.
+        return who, player_msg, room_msg, target_msg
 
     def parse(self, player: Living, cmd: str, external_verbs: Set[str]=set()) -> ParseResult:
         """Parse a command string, returns a ParseResult object."""
@@ -2034,20 +2487,10 @@ class Soul:
             unparsed = unparsed[len(verb):].lstrip()
         include_flag = True
         collect_message = False
-        all_livings = {}  # livings in the room (including player) by name + aliases
-        all_items = {}  # all items in the room or player's inventory, by name + aliases
-        for living in player.location.livings:
-            all_livings[living.name] = living
-            for alias in living.aliases:
-                all_livings[alias] = living
-        for item in player.location.items:
-            all_items[item.name] = item
-            for alias in item.aliases:
-                all_items[alias] = item
-        for item in player.inventory:
-            all_items[item.name] = item
-            for alias in item.aliases:
-                all_items[alias] = item
+        # livings in the room (including player) and items in the player's inventory or in the room, by name + aliases
+        # (an item in the inventory takes precedence over an item in the room with the same name)
+        all_livings, room_items = player.location._name_indexes()
+        all_items = (player._item_names, room_items)
         previous_word = None
         words_enumerator = enumerate(words)
         for index, word in words_enumerator:
@@ -2091,7 +2534,7 @@ class Soul:
             if word in verbdefs.BODY_PARTS:
                 if bodypart:
                     raise ParseError("You can't do that both %s and %s." % (verbdefs.BODY_PARTS[bodypart], verbdefs.BODY_PARTS[word]))
-                if (word not in all_items and word not in all_livings) or previous_word == "my":
+                if (word not in all_items[0] and word not in all_items[1] and word not in all_livings) or previous_word == "my":
                     bodypart = word
                     arg_words.append(word)
                     continue
@@ -2126,7 +2569,7 @@ class Soul:
                 arg_words.append(word)
                 continue
             if word in all_livings:
-                living = all_livings[word]
+                living = all_livings.get(word)
                 if include_flag:
                     who_info[living].sequence = who_sequence
                     who_info[living].previous_word = previous_word
@@ -2138,8 +2581,10 @@ class Soul:
                 arg_words.append(word)
                 previous_word = None
                 continue
-            if word in all_items:
-                item = all_items[word]
+            item = all_items[0].get(word)
+            if item is None:
+                item = all_items[1].get(word)
+            if item is not None:
                 if include_flag:
                     who_info[item].sequence = who_sequence
                     who_info[item].previous_word = previous_word
@@ -2165,7 +2610,7 @@ class Soul:
                         next(words_enumerator)
                         wordcount -= 1
                     continue
-            item_or_living, full_name, wordcount = self.check_name_with_spaces(words, index, all_livings, all_items, {})
+            item_or_living, full_name, wordcount = self._match_name_with_spaces(words, index, (all_livings,) + all_items)
             if item_or_living:
                 while wordcount > 1:
                     next(words_enumerator)
@@ -2193,7 +2638,7 @@ class Soul:
                     for name in all_livings:
                         if name.startswith(word):
                             raise ParseError("Perhaps you meant %s?" % name)
-                    for name in all_items:
+                    for name in itertools.chain(all_items[1], all_items[0]):
                         if name.startswith(word):
                             raise ParseError("Perhaps you meant %s?" % name)
                 if not external_verb:
@@ -2294,7 +2739,8 @@ class Soul:
             else:
                 raise TaleError("cannot determine POSS for None target")
 
-    def spacify(self, string: str) -> str:
+    @staticmethod
+    def spacify(string: str) -> str:
         """returns string prefixed with a space, if it has contents. If it is empty, prefix nothing"""
         return " " + string.lstrip(" \t") if string else ""
 
@@ -2344,6 +2790,23 @@ class Soul:
             pass
         return None, "", 0
 
+    @staticmethod
+    def _match_name_with_spaces(words: Sequence[str], startindex: int, indexes: Sequence[_NameIndex]) \
+            -> Tuple[Optional[ParsedWhoType], str, int]:
+        """
+        Like check_name_with_spaces, but walks the word tries of the given name indexes.
+        The shortest matching name wins, on equal length the earlier index has priority.
+        """
+        best_index, best_wordcount = None, 6
+        for index in indexes:
+            wordcount = index.match(words, startindex, best_wordcount - 1)
+            if wordcount:
+                best_index, best_wordcount = index, wordcount
+        if best_index is None:
+            return None, "", 0
+        name = " ".join(words[startindex:startindex + best_wordcount])
+        return best_index.get(name), name, best_wordcount   # type: ignore
+
 
 _limbo = Location("Limbo", "The intermediate or transitional place or state. There's only nothingness. "
                            "Living beings end up here if they're not in a proper location yet.")
@@ -9,6 +9,7 @@ import datetime
 import gc
 import importlib
 import inspect
+import json
 import os
 import platform
 import sys
@@ -423,11 +424,13 @@ Usage is: set xxx.fieldname=value (you can use Python literals only)"""
     expected_type = type(getattr(obj, field))
     if expected_type is type(value):
         setattr(obj, field, value)
+        obj.mark_dirty()
         player.tell("Field set: %s.%s = %r" % (name, field, value))
     else:
         if expected_type is str:
             value = str(value)
             setattr(obj, field, value)
+            obj.mark_dirty()
             player.tell("Field set: %s.%s = %r" % (name, field, value))
         else:
             raise ActionRefused("Data type mismatch, expected %s." % expected_type)
@@ -514,6 +517,49 @@ def do_pubsub(player: Player, parsed: base.ParseResult, ctx: util.Context) -> No
     player.tell("\n".join(txt), format=False)
 
 
+@wizcmd("pubsub_stats")
+def do_pubsub_stats(player: Player, parsed: base.ParseResult, ctx: util.Context) -> None:
+    """
+    Pubsub delivery metrics: published events, sync batch sizes and time spent per listener.
+    Use 'on' or 'off' to start or stop recording them (starting resets them),
+    and 'dump' to get all of them in json format.
+    """
+    arg = parsed.args[0] if parsed.args else ""
+    if arg in ("on", "off"):
+        pubsub.enable_metrics(arg == "on")
+        player.tell("Pubsub metrics recording is now %s." % arg)
+        return
+    metrics = pubsub.metrics_dump()
+    if arg == "dump":
+        player.tell(json.dumps(metrics, sort_keys=True, indent=2), format=False)
+        return
+    elif arg:
+        raise ActionRefused("Use on, off or dump, or no argument for an overview.")
+    if not metrics["enabled"]:
+        player.tell("Pubsub metrics are not being recorded. Use 'pubsub_stats on' to start.")
+        return
+    player.tell("<bright>Pubsub metrics overview</> (recorded for %d seconds):" % metrics["duration"], end=True)
+    txt = ["<ul>  topic                                  <dim>|</><ul>published<dim>|</><ul>dropped<dim>|</>"
+           "<ul>syncs<dim>|</><ul>max batch<dim>|</><ul>listener ms</>"]
+    listeners = []
+    for name, info in sorted(metrics["topics"].items()):
+        batches = info["batch_sizes"] or {"count": 0, "max": 0}
+        listener_time = sum(histogram["total"] for histogram in info["listeners"].values())
+        txt.append("%-40.40s <dim>|</>  %6d <dim>|</> %6d <dim>|</>%5d<dim>|</>  %6d <dim>|</> %9.2f"
+                   % (name, info["published"], info["dropped"], batches["count"], batches["max"], listener_time * 1000))
+        listeners.extend((histogram["total"], name, listener, histogram) for listener, histogram in info["listeners"].items())
+    if listeners:
+        txt.append("")
+        txt.append("<ul>  listener (busiest first)               <dim>|</><ul>  calls <dim>|</><ul>total ms<dim>|</>"
+                   "<ul>mean us<dim>|</><ul>p99 us<dim>|</><ul> max us</>")
+        for total, name, listener, histogram in sorted(listeners, key=lambda entry: entry[0], reverse=True)[:20]:
+            txt.append("%-40.40s <dim>|</> %6d <dim>|</>%7.2f <dim>|</>%6d <dim>|</>%6d <dim>|</>%7d"
+                       % (listener + " @ " + name, histogram["count"], total * 1000, histogram["mean"] * 1e6,
+                          histogram["p99"] * 1e6, histogram["max"] * 1e6))
+    txt.append("")
+    player.tell("\n".join(txt), format=False)
+
+
 @wizcmd("force")
 def do_force(player: Player, parsed: base.ParseResult, ctx: util.Context) -> None:
     """Force another living being into performing a given command."""
@@ -566,6 +612,9 @@ def do_accounts(player: Player, parsed: base.ParseResult, ctx: util.Context) ->
         txt.append(" %-12s <dim>|</> %19s <dim>|</> %-20s <dim>|</> %s <dim>|</> %s" %
                    (account.name, account.logged_in, account.email, "*" if account.banned else " ", lang.join(account.privileges, "")))
     txt.append("\nWizards: " + lang.join(wizards))
+    metrics = ctx.driver.mud_accounts.write_metrics()
+    txt.append("Buffered account writes: %(dirty)d accounts pending, %(writes)d writes (%(coalesced)d coalesced), "
+               "%(flushes)d flushes of %(flushed_accounts)d accounts, last flush %(last_flush_duration).3f sec." % metrics)
     player.tell("\n".join(txt), format=False)
 
 
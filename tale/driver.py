@@ -7,7 +7,7 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 
 import collections
 import datetime
-import heapq
+import functools
 import importlib
 import inspect
 import os
@@ -17,14 +17,15 @@ import random
 import sys
 import threading
 import time
+from concurrent.futures import Future
 from functools import total_ordering
 from types import ModuleType
-from typing import Sequence, Union, Tuple, Any, Dict, Callable, Iterable, Generator, Set, List, MutableSequence, Optional
+from typing import Sequence, Union, Tuple, Any, Dict, Callable, Iterable, Generator, Set, List, MutableSequence, Optional, Mapping
 
 import appdirs
 
 from . import __version__ as tale_version_str, _check_required_libraries
-from . import mud_context, errors, util, cmds, player, pubsub, charbuilder, lang, verbdefs, vfs, base
+from . import mud_context, errors, util, cmds, player, pubsub, charbuilder, lang, verbdefs, vfs, base, scheduler
 from .story import TickMethod, GameMode, MoneyType, StoryBase
 from .tio import DEFAULT_SCREEN_WIDTH
 from .races import playable_races
@@ -43,6 +44,7 @@ class Commands:
     def __init__(self) -> None:
         self.commands_per_priv = {"": {}}    # type: Dict[str, Dict[str, Callable]]
         self.no_soul_parsing = set()   # type: Set[str]
+        self._cache = {}    # type: Dict[frozenset, Dict[str, Callable]]  # privileges -> available commands
 
     def add(self, verb: str, func: Callable, privilege: str="") -> None:
         self.validatefunc(func)
@@ -50,12 +52,14 @@ class Commands:
             if verb in commands:
                 raise ValueError("command defined more than once: " + verb)
         self.commands_per_priv.setdefault(privilege, {})[verb] = func
+        self._cache.clear()
 
     def override(self, verb: str, func: Callable, privilege: str="") -> Callable:
         self.validatefunc(func)
         if verb in self.commands_per_priv[privilege]:
             existing = self.commands_per_priv[privilege][verb]
             self.commands_per_priv[privilege][verb] = func
+            self._cache.clear()
             return existing
         raise LookupError("command not defined: " + verb)
 
@@ -64,16 +68,25 @@ class Commands:
             raise ValueError("the function '%s' is not a proper command function (did you forget the decorator?)" % func.__name__)
 
     def get(self, privileges: Iterable[str]) -> Dict[str, Callable]:
-        result = dict(self.commands_per_priv[""])  # always include the cmds for empty privilege
-        for priv in privileges:
-            if priv in self.commands_per_priv:
-                result.update(self.commands_per_priv[priv])
+        """
+        Returns the commands (verb->function) available with the given privileges.
+        The result is cached per set of privileges and shared between callers, so don't modify it.
+        """
+        key = frozenset(privileges)
+        result = self._cache.get(key)
+        if result is None:
+            result = dict(self.commands_per_priv[""])  # always include the cmds for empty privilege
+            for priv in key:
+                if priv in self.commands_per_priv:
+                    result.update(self.commands_per_priv[priv])
+            self._cache[key] = result
         return result
 
     def adjust_available_commands(self, server_mode: GameMode) -> None:
         # disable commands flagged with the given game_mode
         # disable soul verbs flagged with override
         # mark non-soul commands
+        self._cache.clear()
         for commands in self.commands_per_priv.values():
             for cmd, func in list(commands.items()):
                 disabled_mode = getattr(func, "disabled_in_mode", None)
@@ -85,6 +98,12 @@ class Commands:
                     self.no_soul_parsing.add(cmd)
 
 
+@functools.lru_cache(maxsize=1024)
+def _wants_ctx(func: Callable) -> bool:
+    # signature inspection is slow, so the result is cached per (unbound) function
+    return "ctx" in inspect.signature(func).parameters
+
+
 @total_ordering
 class Deferred:
     """
@@ -126,6 +145,7 @@ class Deferred:
         self.vargs = vargs
         self.kwargs = kwargs
         self.periodical = periodical
+        self._resolved = None   # type: Optional[Tuple[Any, str, Callable, bool]]  # cache of the resolved action (not serialized)
 
     def __eq__(self, other):
         if self.__class__ == other.__class__:
@@ -149,8 +169,12 @@ class Deferred:
             secs = int(secs / game_clock.times_realtime)
         return datetime.timedelta(seconds=secs)
 
-    def __call__(self, *args: Any, **kwargs: Any) -> None:
-        self.kwargs = self.kwargs or {}
+    def _resolve_action(self) -> Tuple[Callable, bool]:
+        # Returns the function to call and whether it wants a ctx argument.
+        # This is cached for as long as the owner and action remain the same (they're replaced when loading a savegame).
+        resolved = self._resolved
+        if resolved and resolved[0] is self.owner and resolved[1] == self.action:
+            return resolved[2], resolved[3]
         if callable(self.action):
             func = self.action
         else:
@@ -163,9 +187,16 @@ class Deferred:
                 else:
                     raise RuntimeError("invalid owner specifier: " + self.owner)
             func = getattr(self.owner, self.action)
+        wants_ctx = _wants_ctx(getattr(func, "__func__", func))
+        self._resolved = (self.owner, self.action, func, wants_ctx)
+        return func, wants_ctx
+
+    def __call__(self, *args: Any, **kwargs: Any) -> None:
+        self.kwargs = self.kwargs or {}
+        func, wants_ctx = self._resolve_action()
         if self.periodical and hasattr(func, "_tale_periodically") and not func._tale_periodically:     # type: ignore
             return  # no longer marked as periodical
-        if "ctx" in inspect.signature(func).parameters:
+        if wants_ctx:
             self.kwargs["ctx"] = kwargs["ctx"]  # add a 'ctx' keyword argument to the call for convenience
         func(*self.vargs, **self.kwargs)
         if self.periodical and (not hasattr(func, "_tale_periodically") or func._tale_periodically):    # type: ignore
@@ -183,6 +214,7 @@ class Deferred:
             del self.action
             del self.kwargs
             del self.vargs
+            del self._resolved
 
 
 class Driver(pubsub.Listener):
@@ -193,10 +225,12 @@ class Driver(pubsub.Listener):
     """
     def __init__(self) -> None:
         self.unbound_exits = []    # type: List[base.Exit]
-        self.deferreds = []   # type: List[Deferred]  # heapq
+        self.deferreds = scheduler.HeapScheduler()   # type: scheduler.DeferredScheduler
         self.deferreds_lock = threading.Lock()
         self.server_started = datetime.datetime.now().replace(microsecond=0)
         self.server_loop_durations = collections.deque(maxlen=10)    # type: MutableSequence[float]
+        self.periodic_groups = {}   # type: Dict[float, scheduler.PeriodicGroup]
+        self.input_wakeup = threading.Event()   # set when player input (or a new dialog) is waiting, wakes up event driven main loops
         self.commands = Commands()
         self.all_players = {}   # type: Dict[str, player.PlayerConnection]  # maps playername to player connection object
         self.zones = None       # type: ModuleType
@@ -209,6 +243,8 @@ class Driver(pubsub.Listener):
         self._stop_mainloop = True
         # playerconnections that wait for input; maps connection to tuple (dialog, validator, echo_input)
         self.waiting_for_input = {}   # type: Dict[player.PlayerConnection, Tuple[Generator, Any, Any]]
+        # playerconnections with a dialog that waits for the result of work done in the background (see _continue_dialog)
+        self.waiting_for_result = set()   # type: Set[player.PlayerConnection]
         mud_context.driver = self
         for verb, func, privilege in cmds.all_registered_commands():
             self.commands.add(verb, func, privilege)
@@ -268,6 +304,7 @@ class Driver(pubsub.Listener):
                 cmds.clear_registered_commands()
         self.commands.adjust_available_commands(self.story.config.server_mode)
         self.game_clock = util.GameDateTime(self.story.config.epoch or self.server_started, self.story.config.gametime_to_realtime)
+        self._create_deferreds_scheduler()
         self.moneyfmt = None
         if self.story.config.money_type != MoneyType.NOTHING:
             self.moneyfmt = util.MoneyFormatter.create_for(self.story.config.money_type)
@@ -302,6 +339,7 @@ class Driver(pubsub.Listener):
         for x in self.unbound_exits:
             x._bind_target(self.zones)
         self.unbound_exits = []
+        base.Soul.compile_verbs()
         sys.excepthook = util.excepthook  # install custom verbose crash reporter
         self.start_main_loop()   # doesn't exit! (unless game is killed)
         self._stop_driver()
@@ -364,6 +402,30 @@ class Driver(pubsub.Listener):
         time.sleep(0.1)
 
     def _continue_dialog(self, conn: player.PlayerConnection, dialog: Generator, message: str) -> None:
+        self._resume_dialog(conn, dialog, dialog.send, message or None)
+
+    def _continue_dialog_with_result(self, conn: player.PlayerConnection, dialog: Generator, future: Future) -> None:
+        """
+        Continue a dialog that was waiting for the result of some work done in the background
+        (the future). The result is sent into the dialog, or the exception is raised in it.
+        """
+        self.waiting_for_result.discard(conn)
+        if not conn.player or not conn.io:
+            dialog.close()   # the player disconnected in the meantime
+            return
+        try:
+            result = future.result()
+        except Exception as x:
+            self._resume_dialog(conn, dialog, dialog.throw, x)
+        else:
+            self._resume_dialog(conn, dialog, dialog.send, result)
+
+    def _resume_dialog(self, conn: player.PlayerConnection, dialog: Generator, resume: Callable, value: Any) -> None:
+        # A dialog generator yields what it waits for:
+        #   "input" or "input-noecho" and a prompt (and optional validator): the next line of input of the player is sent back.
+        #   "await-result" and a concurrent.futures.Future: the result of the future is sent back (or its exception raised)
+        #       when it completes. This is meant for slow work (such as database access) that is done in another
+        #       thread, so the driver's main loop can continue meanwhile. (Only the mud driver supports this)
         # Notice that the try...except structure is very similar to
         # the one in _server_loop_process_player_input
         # That's no surprise because also in this async case, we need
@@ -371,7 +433,7 @@ class Driver(pubsub.Listener):
         # generator. The reguar player input function has to deal with
         # them as well, caused by normal player commands.
         try:
-            why, what = dialog.send(message or None)
+            why, what = resume(value)
         except StopIteration:
             if conn.player:
                 conn.write_output()   # immediately give feedback (if any) once the dialog ends
@@ -396,6 +458,17 @@ class Driver(pubsub.Listener):
                 assert conn not in self.waiting_for_input, "can only run one async dialog at the same time"
                 conn.io.dont_echo_next_cmd = why == "input-noecho"  # this avoids echoing of the password
                 self.waiting_for_input[conn] = (dialog, validator, why != "input-noecho")
+            elif why == "await-result":
+                if not isinstance(what, Future):
+                    raise TypeError("await-result requires a Future")
+                conn.write_output()
+                self.waiting_for_result.add(conn)
+
+                def result_ready(future: Future) -> None:
+                    # called from the thread that completed the future; the dialog continues in the main loop
+                    topic_async_dialogs.send((conn, dialog, future))
+                    self.notify_input_available()
+                what.add_done_callback(result_ready)
             else:
                 raise ValueError("invalid generator wait reason: " + why)
 
@@ -482,13 +555,8 @@ class Driver(pubsub.Listener):
         self.game_clock.add_realtime(datetime.timedelta(seconds=self.story.config.server_tick_time))
         ctx = util.Context(self, self.game_clock, self.story.config, None)
 
-        due_deferreds = []
         with self.deferreds_lock:
-            while self.deferreds:
-                deferred = self.deferreds[0]
-                if deferred.due_gametime > self.game_clock.clock:
-                    break
-                due_deferreds.append(heapq.heappop(self.deferreds))
+            due_deferreds = self.deferreds.pop_due(self.game_clock.clock)
         for deferred in due_deferreds:
             try:
                 deferred(ctx=ctx)  # call the deferred and provide a context object
@@ -499,6 +567,7 @@ class Driver(pubsub.Listener):
                 print("".join(util.format_traceback()), file=sys.stderr)
                 print("(Please report this problem)", file=sys.stderr)
         del due_deferreds
+        self._call_periodic_groups(ctx)
 
         pubsub.sync()
         for name, conn in list(self.all_players.items()):
@@ -508,13 +577,30 @@ class Driver(pubsub.Listener):
             else:
                 # disconnect corrupt player connection
                 self.disconnect_player(conn)
-        # clean up idle wiretap topics
-        topicinfo = pubsub.pending()
-        for topicname in topicinfo:
-            if isinstance(topicname, tuple) and topicname[0].startswith("wiretap-"):
-                events, idle_time, subbers = topicinfo[topicname]
-                if events == 0 and not subbers and idle_time > 30:
-                    pubsub.topic(topicname).destroy()
+        # clean up topics that have been without subscribers for a while (wiretaps)
+        pubsub.expire_idle()
+
+    def notify_input_available(self) -> None:
+        """Signal the main loop that there is something to process (player input, new connection)."""
+        self.input_wakeup.set()
+
+    def _call_periodic_groups(self, ctx: util.Context) -> None:
+        for group in list(self.periodic_groups.values()):
+            for method in group.next_bucket():
+                if hasattr(method, "_tale_periodically") and not method._tale_periodically:    # type: ignore
+                    group.remove_method(method)     # no longer marked as periodical
+                    continue
+                try:
+                    if _wants_ctx(method.__func__):     # type: ignore
+                        method(ctx=ctx)
+                    else:
+                        method()
+                except StoryCompleted:
+                    raise    # handled elsewhere (IF)
+                except Exception:
+                    print("\n* Exception while executing periodic method {0}:".format(method), file=sys.stderr)
+                    print("".join(util.format_traceback()), file=sys.stderr)
+                    print("(Please report this problem)", file=sys.stderr)
 
     def disconnect_idling(self, conn: player.PlayerConnection) -> None:
         raise NotImplementedError
@@ -538,7 +624,7 @@ class Driver(pubsub.Listener):
         # We pass in all 'external verbs' (non-soul verbs) so it will do the
         # parsing for us even if it's a verb the soul doesn't recognise by itself.
         command_verbs = self.commands.get(player.privileges)
-        custom_verbs = set(self.current_custom_verbs(player))
+        custom_verbs = self.custom_verbs_lookup(player)
         try:
             if _verb in self.commands.no_soul_parsing:
                 # don't use the soul to parse it further
@@ -546,8 +632,8 @@ class Driver(pubsub.Listener):
                 raise errors.NonSoulVerb(base.ParseResult(_verb, unparsed=_rest.strip()))
             else:
                 # Parse the command by using the soul.
-                all_verbs = set(command_verbs) | custom_verbs
-                parsed = player.parse(cmd, external_verbs=all_verbs)
+                all_verbs = collections.ChainMap(command_verbs, custom_verbs)
+                parsed = player.parse(cmd, external_verbs=all_verbs)     # type: ignore
             # If parsing went without errors, it's a soul verb, handle it as a socialize action
             player.turns += 1
             player.do_socialize_cmd(parsed)
@@ -640,16 +726,18 @@ class Driver(pubsub.Listener):
         """returns dict of the currently recognised custom verbs (verb->helptext mapping)"""
         verbs = player.verbs.copy()
         verbs.update(player.location.verbs)
-        for living in player.location.livings:
-            verbs.update(living.verbs)
-        for item in player.inventory:
-            verbs.update(item.verbs)
-        for item in player.location.items:
-            verbs.update(item.verbs)
-        for exit in set(player.location.exits.values()):
-            verbs.update(exit.verbs)
+        verbs.update(player.location._verb_index.helptexts())
+        verbs.update(player._verb_index.helptexts())
         return verbs
 
+    def custom_verbs_lookup(self, player: player.Player) -> Mapping[str, Any]:
+        """
+        Returns a mapping that can be used to quickly check if a verb is one of the currently recognised custom verbs.
+        It is a view on the verb indexes of the player's location and inventory, so it's only valid right now.
+        """
+        return collections.ChainMap(player.verbs, player.location.verbs,       # type: ignore
+                                    player.location._verb_index.verbs, player._verb_index.verbs)
+
     def current_verbs(self, player: player.Player) -> Dict[str, str]:
         """return a dict of all currently recognised verbs, and their help text"""
         normal_verbs = self.commands.get(player.privileges)
@@ -742,11 +830,53 @@ class Driver(pubsub.Listener):
         self._enqueue_deferred(deferred)
         return deferred
 
+    def _restore_saved_objects(self, deserializer: Any, state: Dict[str, Any], objects_finder: Any) -> List[Dict[str, Any]]:
+        """
+        Restores the exits, items, locations and livings from the saved game state (see TaleDeserializer),
+        using the objects finder to look up the existing objects. Returns the info of the restored livings,
+        the caller still has to hook up whom they're following (when the player objects are there as well).
+        """
+        exits_data = list(sorted(state.pop("exits"), key=lambda d: d.get("vnum")))
+        saved_exits = deserializer.recreate_classes(exits_data, objects_finder)
+        assert all(isinstance(e, base.Exit) for e in saved_exits)
+
+        items_data = list(sorted(state.pop("items"), key=lambda d: d.get("vnum")))
+        saved_items_info = deserializer.recreate_classes(items_data, objects_finder)
+        # link items contained in other items
+        for item_info in saved_items_info:
+            item = item_info["item"]
+            assert isinstance(item, base.Item)
+            if item_info["contains"]:
+                if isinstance(item, base.Container):
+                    contained = {objects_finder.resolve_item_ref(*i_ref) for i_ref in item_info["contains"]}
+                    item.init_inventory(contained)
+                else:
+                    raise errors.TaleError("can't put stuff in an item that isn't a Container")
+
+        loc_data = list(sorted(state.pop("locations"), key=lambda d: d.get("vnum")))
+        saved_locs = deserializer.recreate_classes(loc_data, objects_finder)
+        assert all(isinstance(l, base.Location) for l in saved_locs)
+
+        livings_data = list(sorted(state.pop("livings"), key=lambda d: d.get("vnum")))
+        saved_livings_info = deserializer.recreate_classes(livings_data, objects_finder)
+        for living_info in saved_livings_info:
+            living = living_info["living"]
+            assert isinstance(living, base.Living)
+            if living_info["inventory"]:
+                contained = {objects_finder.resolve_item_ref(*i_ref) for i_ref in living_info["inventory"]}
+                living.init_inventory(contained)
+            loc = objects_finder.resolve_location_ref(*living_info["location"])
+            if living.location and living.location is not loc:
+                living.location.remove(living, living)
+            # we can't yet set following because it might still point to a non-existing player object. Do that later.
+            loc.insert(living, living)
+        return saved_livings_info
+
     def _enqueue_deferred(self, deferred: Deferred) -> None:
         if "ctx" in deferred.kwargs:
             raise errors.TaleError("you cannot enqueue a Deferred that already has a 'ctx' kwarg (serialization issues)")
         with self.deferreds_lock:
-            heapq.heappush(self.deferreds, deferred)
+            self.deferreds.push(deferred)
 
     def pubsub_event(self, topicname: pubsub.TopicNameType, event: Union[Callable, Tuple[player.PlayerConnection, str]]) -> None:
         if topicname == "driver-pending-actions":
@@ -756,25 +886,53 @@ class Driver(pubsub.Listener):
             assert callable(event), "the driver-pending-tells events should be callables"
             event()
         elif topicname == "driver-async-dialogs":
+            # a new dialog (conn, dialog), or a dialog that can continue with a result (conn, dialog, future)
             if isinstance(event, tuple):
-                conn, dialog = event
+                conn, dialog = event[:2]
             else:
                 raise TypeError("event must be tuple here")
             assert type(conn) is player.PlayerConnection
             assert inspect.isgenerator(dialog)
-            self._continue_dialog(conn, dialog, "")     # type: ignore
+            if len(event) == 3:
+                self._continue_dialog_with_result(conn, dialog, event[2])     # type: ignore
+            else:
+                self._continue_dialog(conn, dialog, "")     # type: ignore
         else:
             raise ValueError("unknown topic: " + str(topicname))
 
     def remove_deferreds(self, owner: str) -> None:
         with self.deferreds_lock:
-            self.deferreds = [d for d in self.deferreds if d.owner is not owner]
-            heapq.heapify(self.deferreds)
+            self.deferreds.remove_owner(owner)
+        for group in self.periodic_groups.values():
+            group.remove(owner)
+
+    def _create_deferreds_scheduler(self) -> None:
+        # select the scheduler backend configured by the story; the wheel is bucketed on the game time of one server tick
+        resolution = self.story.config.server_tick_time * (self.story.config.gametime_to_realtime or 1)
+        new_scheduler = scheduler.create_scheduler(self.story.config.deferred_scheduler, resolution)
+        with self.deferreds_lock:
+            for deferred in self.deferreds:
+                new_scheduler.push(deferred)
+            self.deferreds = new_scheduler
 
     def register_periodicals(self, obj: base.MudObject) -> None:
         for func, period in util.get_periodicals(obj).items():
             assert len(period) == 3
-            mud_context.driver.defer(period, func)
+            if getattr(func, "_tale_periodic_grouped", False):
+                self.register_grouped_periodical(period[1], func)
+            else:
+                mud_context.driver.defer(period, func)
+
+    def register_grouped_periodical(self, period: float, method: Callable) -> None:
+        """
+        Add a bound method to the periodic group for the given period (in real time seconds).
+        The methods in a group are spread evenly over the server ticks within the period, and called in batches.
+        They are removed from the group when their object is destroyed.
+        """
+        if period not in self.periodic_groups:
+            tick_time = self.story.config.server_tick_time if self.story else 1.0
+            self.periodic_groups[period] = scheduler.PeriodicGroup(period, tick_time)
+        self.periodic_groups[period].add(method)
 
     @property
     def uptime(self) -> Tuple[int, int, int]:
@@ -5,10 +5,13 @@ Single user driver (for interactive fiction).
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
+import binascii
+import os
 import sys
 import time
 import threading
-from typing import Generator, Optional, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Generator, Optional, Sequence
 from .story import GameMode, TickMethod, StoryConfig
 from . import base
 from . import charbuilder
@@ -40,6 +43,12 @@ class IFDriver(driver.Driver):
         if web:
             self.io_type = "web"
         self.wizard_override = wizard_override
+        self.savegame_id = ""    # id of the last full save game, the incremental saves refer to it
+        self.savegame_deltas = 0    # number of incremental saves written after the last full save game
+        self.savegame_states = {}   # type: Dict[int, Dict[str, Any]]  # vnum -> saved state, of the objects in the previous save
+        self.save_executor = ThreadPoolExecutor(max_workers=1)   # encodes and writes the save games in the background
+        self.save_lock = threading.Lock()
+        self.queued_save = None     # type: Optional[SaveJob]
 
     def start_main_loop(self):
         if self.io_type == "web":
@@ -75,21 +84,94 @@ class IFDriver(driver.Driver):
             return True
 
     def do_save(self, player: Player) -> None:
+        """
+        Saves the game. Only a snapshot of the game state is made right now, it is encoded and written
+        to the save game file in the background, so the game doesn't stall meanwhile. The player is told when it's done.
+        If the previous save is still waiting to be written, it's replaced by this one (only the newest state is written).
+        """
         if not self.story.config.savegames_enabled:
             raise errors.ActionRefused("It is not possible to save your progress.")
-        serializer = savegames.TaleSerializer()
+        with self.save_lock:
+            queued = self.queued_save
+            if queued:
+                # forget the snapshot that was waiting, so that the changes it had get into this one
+                for obj in queued.changed_objects:
+                    obj._dirty = True
+                self.savegame_id, self.savegame_deltas = queued.previous_savegame
+            job = self._snapshot_game(player)
+            if queued:
+                job.future = queued.future
+            self.queued_save = job
+        if not queued:
+            self.save_executor.submit(self._write_save)
+
+    def _snapshot_game(self, player: Player) -> 'SaveJob':
+        serializer = savegames.TaleSerializer(self.story.config.savegame_format)
         all_locations = [loc for loc in base.MudObjRegistry.all_locations.values()]
         all_items = [i for i in base.MudObjRegistry.all_items.values() if i.contained_in]
         all_livings = [l for l in base.MudObjRegistry.all_livings.values() if l.location]
         all_exits = list(base.MudObjRegistry.all_exits.values())
-        savedata = serializer.serialize(self.story.config, player, all_items, all_livings, all_locations, all_exits,
-                                        self.deferreds, self.game_clock)
-        del all_locations, all_exits, all_items, all_livings
-        self.user_resources[util.storyname_to_filename(self.story.config.name) + ".savegame"] = savedata
-        player.tell("Game saved.")
+        savegame_filename = util.storyname_to_filename(self.story.config.name) + ".savegame"
+        previous_savegame = (self.savegame_id, self.savegame_deltas)
+        changed_objects = [obj for obj in all_items + all_locations + all_exits if obj._dirty]   # type: ignore
+        if self.savegame_id and self.savegame_deltas < self.story.config.savegame_max_deltas:
+            # only save the changes since the previous save
+            self.savegame_deltas += 1
+            data = serializer.savegame_delta_state(self.story.config, player, all_items, all_livings, all_locations, all_exits,
+                                                   list(self.deferreds), self.game_clock, self.savegame_id, self.savegame_deltas,
+                                                   self.savegame_states)
+            job = SaveJob(serializer, serializer.snapshot(data, self.savegame_states, changed_objects), player,
+                          savegame_filename + ".delta%d" % self.savegame_deltas, [])
+        else:
+            # full save, this also merges the previous incremental saves into it
+            obsolete_files = [savegame_filename + ".delta%d" % number
+                              for number in range(1, max(self.savegame_deltas, self.story.config.savegame_max_deltas) + 1)]
+            self.savegame_id = binascii.hexlify(os.urandom(8)).decode("ascii")
+            self.savegame_deltas = 0
+            data = serializer.savegame_state(self.story.config, player, all_items, all_livings, all_locations, all_exits,
+                                             list(self.deferreds), self.game_clock, self.savegame_id)
+            job = SaveJob(serializer, serializer.snapshot(data, self.savegame_states, changed_objects), player,
+                          savegame_filename, obsolete_files)
+            saved_vnums = {obj.vnum for obj in all_items + all_locations + all_exits}   # type: ignore
+            self.savegame_states = {vnum: state for vnum, state in self.savegame_states.items() if vnum in saved_vnums}
+        job.previous_savegame = previous_savegame
+        job.changed_objects = changed_objects
+        for obj in changed_objects:
+            obj._dirty = False
+        job.game_time = str(self.game_clock)
+        return job
+
+    def _write_save(self) -> None:
+        # runs in the save thread
+        with self.save_lock:
+            job, self.queued_save = self.queued_save, None
+        if not job:
+            return
+        try:
+            self.user_resources[job.filename] = job.serializer.encode(job.snapshot)
+            for name in job.obsolete_files:
+                del self.user_resources[name]
+        except Exception as x:
+            with self.save_lock:
+                self.savegame_id = ""   # the next save has to be a full save again
+            message = "<bright>The game could not be saved:</> %s: %s" % (type(x).__name__, x)
+            driver.topic_pending_tells.send(lambda: job.player.tell(message, end=True))
+            job.future.set_exception(x)
+        else:
+            driver.topic_pending_tells.send(lambda: self._tell_saved(job))
+            job.future.set_result(None)
+        self.notify_input_available()   # wake up the main loop so the player is told right away
+
+    def _tell_saved(self, job: 'SaveJob') -> None:
+        job.player.tell("Game saved.")
         if self.story.config.display_gametime:
-            player.tell("Game time: %s" % self.game_clock)
-        player.tell("\n")
+            job.player.tell("Game time: %s" % job.game_time)
+        job.player.tell("\n")
+
+    def wait_for_saves(self) -> None:
+        """Waits until the save games are written, and tells the player about it."""
+        self.save_executor.submit(lambda: None).result()    # it runs the writes in order
+        pubsub.sync("driver-pending-tells")
 
     def connect_player(self, player_io_type: str, line_delay: int) -> PlayerConnection:
         connection = PlayerConnection()
@@ -219,7 +301,12 @@ class IFDriver(driver.Driver):
             if conn not in self.waiting_for_input:
                 conn.write_input_prompt()
             if self.story.config.server_tick_method == TickMethod.COMMAND:
-                conn.player.input_is_available.wait()   # blocking wait until playered entered something
+                if not self._wait_for_command(conn.player):
+                    # woken up without input, for instance by a save that finished in the background: show its message
+                    pubsub.sync("driver-pending-tells")
+                    conn.need_new_input_prompt = True
+                    conn.write_output()
+                    continue
                 has_input = True
             elif self.story.config.server_tick_method == TickMethod.TIMER:
                 # server tick goes on a timer, wait a limited time for player input before going on
@@ -256,6 +343,7 @@ class IFDriver(driver.Driver):
                     continue
                 except errors.SessionExit:
                     self._stop_mainloop = True
+                    self.wait_for_saves()
                     self.story.goodbye(conn.player)
                     self._stop_driver()
                     break
@@ -291,15 +379,38 @@ class IFDriver(driver.Driver):
             self.server_loop_durations.append(loop_duration)
             conn.write_output()
 
+    def _wait_for_command(self, player: Player) -> bool:
+        """
+        Blocking wait until the player entered something, or until the main loop is woken up for another reason.
+        Returns True if there is player input.
+        """
+        if not player.input_is_available.is_set():
+            self.input_wakeup.wait()
+        # clearing it after waking up is fine: anything that finished meanwhile is handled by this loop iteration
+        self.input_wakeup.clear()
+        return player.input_is_available.is_set()
+
+    def _stop_driver(self) -> None:
+        self.save_executor.shutdown(wait=True)   # don't lose a save game that is still being written
+        super()._stop_driver()
+
     def _load_saved_game(self, existing_player: Player) -> Optional[Player]:
         # at this time, game loading/saving is only supported in single player IF mode.
         assert len(self.all_players) == 1
         conn = list(self.all_players.values())[0]
+        self.wait_for_saves()
         try:
-            savegame = self.user_resources[util.storyname_to_filename(self.story.config.name) + ".savegame"].data
+            savegame_filename = util.storyname_to_filename(self.story.config.name) + ".savegame"
+            savegame = self.user_resources[savegame_filename].data
+            deltas = []
+            while True:
+                try:
+                    deltas.append(self.user_resources[savegame_filename + ".delta%d" % (len(deltas) + 1)].data)
+                except FileNotFoundError:
+                    break
             deserializer = savegames.TaleDeserializer()
-            state = deserializer.deserialize(savegame)
-            del savegame
+            state, savegame_id, savegame_deltas = deserializer.deserialize_incremental(savegame, deltas)
+            del savegame, deltas
         except (ValueError, TypeError) as x:
             print("There was a problem loading the saved game data:")
             print(type(x).__name__, x)
@@ -318,7 +429,8 @@ class IFDriver(driver.Driver):
                 existing_player.tell("<it>Note: the saved game data is from a different version of the game and may cause problems.</>")
                 existing_player.tell("We'll attempt to load it anyway. (Current game version: %s / Saved game data version: %s). "
                                      % (self.story.config.version, savegame_version), end=True)
-            objects_finder = SavegameExistingObjectsFinder()
+            objects_finder = savegames.SavegameExistingObjectsFinder()
+            saved_vnums = {obj_state["vnum"] for key in ("items", "locations", "exits") for obj_state in state[key]}
 
             clock = deserializer.recreate_classes(state.pop("clock"), None)
             assert isinstance(clock, util.GameDateTime)
@@ -328,40 +440,7 @@ class IFDriver(driver.Driver):
             assert isinstance(story_config, StoryConfig)
             self.story.config = story_config
 
-            exits_data = list(sorted(state.pop("exits"), key=lambda d: d.get("vnum")))
-            saved_exits = deserializer.recreate_classes(exits_data, objects_finder)
-            assert all(isinstance(e, base.Exit) for e in saved_exits)
-
-            items_data = list(sorted(state.pop("items"), key=lambda d: d.get("vnum")))
-            saved_items_info = deserializer.recreate_classes(items_data, objects_finder)
-            # link items contained in other items
-            for item_info in saved_items_info:
-                item = item_info["item"]
-                assert isinstance(item, base.Item)
-                if item_info["contains"]:
-                    if isinstance(item, base.Container):
-                        contained = {objects_finder.resolve_item_ref(*i_ref) for i_ref in item_info["contains"]}
-                        item.init_inventory(contained)
-                    else:
-                        raise errors.TaleError("can't put stuff in an item that isn't a Container")
-
-            loc_data = list(sorted(state.pop("locations"), key=lambda d: d.get("vnum")))
-            saved_locs = deserializer.recreate_classes(loc_data, objects_finder)
-            assert all(isinstance(l, base.Location) for l in saved_locs)
-
-            livings_data = list(sorted(state.pop("livings"), key=lambda d: d.get("vnum")))
-            saved_livings_info = deserializer.recreate_classes(livings_data, objects_finder)
-            for living_info in saved_livings_info:
-                living = living_info["living"]
-                assert isinstance(living, base.Living)
-                if living_info["inventory"]:
-                    contained = {objects_finder.resolve_item_ref(*i_ref) for i_ref in living_info["inventory"]}
-                    living.init_inventory(contained)
-                loc = objects_finder.resolve_location_ref(*living_info["location"])
-                if living.location and living.location is not loc:
-                    living.location.remove(living, living)
-                # we can't yet set following because it might still point to a non-existing player object. Do that later.
-                loc.insert(living, living)
+            saved_livings_info = self._restore_saved_objects(deserializer, state, objects_finder)
 
             saved_player_info = deserializer.recreate_classes(state.pop("player"), None)
             saved_player = saved_player_info["player"]
@@ -392,13 +471,26 @@ class IFDriver(driver.Driver):
 
             saved_deferreds = deserializer.recreate_classes(state.pop("deferreds"), objects_finder)
             assert all(isinstance(d, driver.Deferred) for d in saved_deferreds)
-            self.deferreds = []
+            self.deferreds.clear()
             for d in saved_deferreds:
                 self._enqueue_deferred(d)
 
             # done, check
             assert len(state) == 0, "everything must have been converted"
 
+            # the next save can be an incremental one that only contains the objects that change from now on
+            self.savegame_id = savegame_id
+            self.savegame_deltas = savegame_deltas
+            self.savegame_states.clear()
+            loaded_objects = []
+            for registry in (base.MudObjRegistry.all_items, base.MudObjRegistry.all_locations, base.MudObjRegistry.all_exits):
+                for vnum, obj in registry.items():   # type: ignore
+                    if vnum in saved_vnums:
+                        obj._dirty = False
+                        loaded_objects.append(obj)
+            # the next incremental save compares the objects with the state they've been loaded with
+            savegames.TaleSerializer(self.story.config.savegame_format).snapshot(loaded_objects, self.savegame_states)
+
             self.waiting_for_input = {}   # can't keep the old waiters around
             saved_player.tell("\n")
             saved_player.tell("Game loaded.")
@@ -410,47 +502,16 @@ class IFDriver(driver.Driver):
             return saved_player
 
 
-class SavegameExistingObjectsFinder:
-    def resolve_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.MudObject:
-        if baseclassname == "tale.base.Item":
-            return self.resolve_item_ref(vnum, name, classname, baseclassname)
-        elif baseclassname == "tale.base.Location":
-            return self.resolve_location_ref(vnum, name, classname, baseclassname)
-        elif baseclassname == "tale.base.Living":
-            return self.resolve_living_ref(vnum, name, classname, baseclassname)
-        else:
-            raise errors.TaleError("invalid base class for resolve_ref: " + baseclassname)
-
-    def resolve_location_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Location:
-        loc = base.MudObjRegistry.all_locations.get(vnum, None)
-        if not loc:
-            raise LookupError("location vnum not found: " + str(vnum))
-        if loc.name != name or savegames.qual_baseclassname(loc) != baseclassname:
-            raise errors.TaleError("location inconsistency for vnum " + str(vnum))
-        return loc
-
-    def resolve_living_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Living:
-        liv = base.MudObjRegistry.all_livings.get(vnum, None)
-        if not liv:
-            raise LookupError("living vnum not found: " + str(vnum))
-        if liv.name != name:
-            if savegames.qual_baseclassname(liv) != baseclassname:
-                if baseclassname == "tale.player.Player":
-                    return liv  # special case when the living is the Player
-                raise errors.TaleError("living inconsistency for vnum " + str(vnum))
-        return liv
-
-    def resolve_item_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Item:
-        item = base.MudObjRegistry.all_items.get(vnum, None)
-        if not item:
-            raise LookupError("item vnum not found: " + str(vnum))
-        if item.name != name or savegames.qual_baseclassname(item) != baseclassname:
-            raise errors.TaleError("item inconsistency for vnum " + str(vnum))
-        return item
-
-    def resolve_exit(self, vnum: int, name: str, classname: str, baseclassname: str) -> Union[base.Exit, base.Door]:
-        assert baseclassname == "tale.base.Exit"
-        exit = base.MudObjRegistry.all_exits[vnum]
-        if exit.name != name or savegames.qual_baseclassname(exit) != baseclassname:
-            raise errors.TaleError("exit/door inconsistency for vnum " + str(vnum))
-        return exit
+class SaveJob:
+    """A snapshot of the game state, waiting to be written to the save game file by the save thread."""
+    def __init__(self, serializer: savegames.TaleSerializer, snapshot: Dict[str, Any], player: Player,
+                 filename: str, obsolete_files: Sequence[str]) -> None:
+        self.serializer = serializer
+        self.snapshot = snapshot
+        self.player = player
+        self.filename = filename
+        self.obsolete_files = obsolete_files    # old incremental saves to remove, after a full save
+        self.future = Future()  # type: Future
+        self.previous_savegame = ("", 0)    # savegame id and number of deltas, to go back to if this job is replaced
+        self.changed_objects = []   # the objects that were saved as changed, marked dirty again if this job is replaced
+        self.game_time = ""
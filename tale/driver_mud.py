@@ -7,7 +7,9 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 
 import time
 import socket
+import sys
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Union, Generator, Dict, Tuple, Optional, Any
 
 from .story import GameMode
@@ -18,9 +20,11 @@ from . import driver
 from . import errors
 from . import lang
 from . import pubsub
+from . import savegames
 from . import util
 from .player import PlayerConnection, Player
 from .tio.mud_browser_io import TaleMudWsgiApp
+from .tio.sessions import MemorySessionStore, SqliteSessionStore
 
 
 class MudDriver(driver.Driver):
@@ -33,13 +37,31 @@ class MudDriver(driver.Driver):
         self.game_mode = GameMode.MUD
         self.restricted = restricted   # restricted mud mode? (no new players allowed)
         self.mud_accounts = None   # type: accounts.MudAccounts
+        self.account_service = None   # type: accounts.AccountService
+        self.accounts_flush = None   # type: Future
+        self.web_sessions = None   # the web sessions of the players, in memory or in a sqlite database
+        self.checkpoint_executor = ThreadPoolExecutor(max_workers=1)   # writes the world state in the background
+        self.world_checkpoint = None   # type: Future
+        self.world_checkpoint_time = 0.0
+        self.world_states = {}   # type: Dict[int, Dict[str, Any]]  # vnum -> state, of the objects in the previous checkpoint
 
     def start_main_loop(self):
         # Driver runs as main thread, wsgi webserver runs in background thread
         accounts_db_file = self.user_resources.validate_path("useraccounts.sqlite")
         self.mud_accounts = accounts.MudAccounts(accounts_db_file)
+        self.account_service = accounts.AccountService(self.mud_accounts)   # for database work during the login dialogs
         base._limbo.init_inventory([LimboReaper()])  # add the grim reaper to Limbo
-        wsgi_server = TaleMudWsgiApp.create_app_server(self, use_ssl=False, ssl_certs=None)    # you can enable SSL here
+        if self.story.config.mud_persistence_interval > 0:
+            self._restore_world()   # before the web server starts, so no players are connected yet
+        self.world_checkpoint_time = time.time()
+        if self.story.config.mud_session_store == "sqlite":
+            self.web_sessions = SqliteSessionStore(self.user_resources.validate_path("websessions.sqlite"))
+        elif self.story.config.mud_session_store == "memory":
+            self.web_sessions = MemorySessionStore()
+        else:
+            raise ValueError("invalid mud_session_store config setting: " + str(self.story.config.mud_session_store))
+        wsgi_server = TaleMudWsgiApp.create_app_server(self, use_ssl=False, ssl_certs=None,    # you can enable SSL here
+                                                       sessions=self.web_sessions)
         wsgi_thread = threading.Thread(name="wsgi", target=wsgi_server.serve_forever)
         wsgi_thread.daemon = True
         wsgi_thread.start()
@@ -59,6 +81,116 @@ class MudDriver(driver.Driver):
             print("Access the game on this web server url (ipv4):   %s://%s:%d/tale/" % (protocol, hostname, port), end="\n\n")
         self._main_loop_wrapper(None)   # this doesn't return!
 
+    def _server_tick(self) -> None:
+        super()._server_tick()
+        if self.web_sessions and self.web_sessions.expire_due():
+            self.web_sessions.expire()    # clean up the web sessions of browsers that haven't been back for a long time
+        if self.accounts_flush and self.accounts_flush.done():
+            if self.accounts_flush.exception():
+                print("ERROR WRITING ACCOUNT DATA:", repr(self.accounts_flush.exception()), file=sys.stderr)
+            self.accounts_flush = None
+        if self.mud_accounts and not self.accounts_flush and self.mud_accounts.flush_due():
+            self.accounts_flush = self.account_service.flush()    # write the buffered account data in the background
+        if self.world_checkpoint and self.world_checkpoint.done():
+            if self.world_checkpoint.exception():
+                print("ERROR WRITING WORLD STATE:", repr(self.world_checkpoint.exception()), file=sys.stderr)
+            self.world_checkpoint = None
+        interval = self.story.config.mud_persistence_interval
+        if interval > 0 and not self.world_checkpoint and time.time() - self.world_checkpoint_time >= interval:
+            self.world_checkpoint = self.checkpoint_world()
+
+    def checkpoint_world(self) -> Future:
+        """
+        Saves the state of the world, so that it can be restored when the server restarts.
+        The players (and the things they carry) are left out, they're stored in the accounts database.
+        A snapshot of the state is made right away, writing it is done in the background.
+        Returns a Future that completes when it's been written.
+        """
+        serializer = savegames.TaleSerializer(self.story.config.savegame_format, exclude_players=True)
+        all_items = [i for i in base.MudObjRegistry.all_items.values() if i.contained_in and not self._carried_by_player(i)]
+        all_livings = [l for l in base.MudObjRegistry.all_livings.values() if l.location and not isinstance(l, Player)]
+        all_locations = list(base.MudObjRegistry.all_locations.values())
+        all_exits = list(base.MudObjRegistry.all_exits.values())
+        saved_ids = {id(obj) for obj in all_items + all_livings + all_locations + all_exits}   # type: ignore
+        with self.deferreds_lock:
+            # the deferreds of other things are created again by the code at startup
+            deferreds = [d for d in self.deferreds if id(d.owner) in saved_ids]
+        data = serializer.world_state(self.story.config, all_items, all_livings, all_locations, all_exits, deferreds, self.game_clock)
+        snapshot = serializer.snapshot(data, self.world_states)
+        saved_vnums = {obj.vnum for obj in all_items + all_locations + all_exits}   # type: ignore
+        self.world_states = {vnum: state for vnum, state in self.world_states.items() if vnum in saved_vnums}
+        self.world_checkpoint_time = time.time()
+        return self.checkpoint_executor.submit(self._write_world_state, serializer, snapshot)
+
+    def _write_world_state(self, serializer: savegames.TaleSerializer, snapshot: Dict[str, Any]) -> None:
+        self.user_resources["world.savegame"] = serializer.encode(snapshot)
+
+    @staticmethod
+    def _carried_by_player(item: base.Item) -> bool:
+        container = item.contained_in
+        while isinstance(container, base.Item):
+            container = container.contained_in
+        return isinstance(container, Player)
+
+    def _restore_world(self) -> None:
+        try:
+            data = self.user_resources["world.savegame"].data
+        except FileNotFoundError:
+            return
+        deserializer = savegames.TaleDeserializer()
+        try:
+            state = deserializer.deserialize(data)
+            del data
+            version = state.pop("story_config")["version"]
+            if version != self.story.config.version:
+                print("The saved world state is from a different version of the story (%s), it is not restored.\n" % version)
+                return
+            print("Restoring the saved world state.\n")
+            saved_vnums = {obj_state["vnum"] for key in ("items", "livings") for obj_state in state[key]}
+            ctx = util.Context(self, self.game_clock, self.story.config, None)
+            for item in list(base.MudObjRegistry.all_items.values()):
+                if item.vnum not in saved_vnums and item.contained_in and not self._carried_by_player(item):
+                    # this item is no longer in the world (or a player had it)
+                    container = item.contained_in
+                    container.remove(item, container if isinstance(container, base.Living) else None)
+                    item.destroy(ctx)
+            objects_finder = savegames.SavegameExistingObjectsFinder()
+            clock = deserializer.recreate_classes(state.pop("clock"), None)
+            assert isinstance(clock, util.GameDateTime)
+            self.game_clock = clock
+            saved_livings_info = self._restore_saved_objects(deserializer, state, objects_finder)
+            for living_info in saved_livings_info:
+                if living_info["following"]:
+                    living_info["living"].following = objects_finder.resolve_living_ref(*living_info["following"])
+            for living in list(base.MudObjRegistry.all_livings.values()):
+                if living.vnum not in saved_vnums and living.location and living.location is not base._limbo \
+                        and not isinstance(living, Player):
+                    living.destroy(ctx)     # this creature is no longer in the world
+            saved_deferreds = deserializer.recreate_classes(state.pop("deferreds"), objects_finder)
+            assert all(isinstance(d, driver.Deferred) for d in saved_deferreds)
+            with self.deferreds_lock:
+                other_deferreds = [d for d in self.deferreds if not isinstance(d.owner, base.MudObject)]
+                self.deferreds.clear()
+            for d in other_deferreds + saved_deferreds:
+                self._enqueue_deferred(d)
+            assert len(state) == 0, "everything must have been converted"
+        except (ValueError, TypeError, LookupError, errors.TaleError) as x:
+            print("There was a problem restoring the saved world state:", file=sys.stderr)
+            print(type(x).__name__, x, file=sys.stderr)
+            raise SystemExit(10)
+
+    def _stop_driver(self) -> None:
+        if self.story and self.story.config.mud_persistence_interval > 0:
+            try:
+                self.checkpoint_world().result()    # the world as it is now, for when the server starts again
+            except Exception as x:
+                print("ERROR WRITING WORLD STATE:", repr(x), file=sys.stderr)
+        self.checkpoint_executor.shutdown(wait=True)
+        super()._stop_driver()
+        if self.mud_accounts:
+            self.account_service.shutdown()   # let the pending account work finish
+            self.mud_accounts.close()     # this also writes the buffered account data
+
     def show_motd(self, player: Player, notify_no_motd: bool=False) -> None:
         """Prints the Message-Of-The-Day file, if present."""
         try:
@@ -95,12 +227,13 @@ class MudDriver(driver.Driver):
         self.print_game_intro(connection)
         connection.output("\n")
         # check if we have at least 1 admin user
-        if len(self.mud_accounts.all_accounts(having_privilege="wizard")) == 0:
+        if not self.mud_accounts.has_wizard():
             # there is no wizard, create a dialog to construct the initial admin user
             driver.topic_async_dialogs.send((connection, self._login_dialog_mud_create_admin(connection)))
-            return connection
-        # create the login dialog
-        driver.topic_async_dialogs.send((connection, self._login_dialog_mud(connection)))
+        else:
+            # create the login dialog
+            driver.topic_async_dialogs.send((connection, self._login_dialog_mud(connection)))
+        self.notify_input_available()   # the main loop should pick up the new dialog right away
         return connection
 
     def disconnect_idling(self, conn: PlayerConnection) -> None:
@@ -163,7 +296,7 @@ class MudDriver(driver.Driver):
             else:
                 break
         stats = base.Stats.from_race(race, gender=gender[0])
-        self.mud_accounts.create(name, password, email, stats, privileges={"wizard"})
+        yield "await-result", self.account_service.create(name, password, email, stats, privileges={"wizard"})
         conn.output("<it>Okay, your admin account is ready. You can try logging in.</it>\n")
         conn.output("\n")
         yield from self._login_dialog_mud(conn)  # continue with the normal login dialog
@@ -182,7 +315,7 @@ class MudDriver(driver.Driver):
 
             # see if it is a new player or a name we already know.
             try:
-                account = self.mud_accounts.get(name)
+                account = yield "await-result", self.account_service.get(name)
             except LookupError:
                 if self.restricted:
                     conn.player.tell("<bright>We're sorry, the mud is running in restricted mode at the moment. "
@@ -205,8 +338,8 @@ class MudDriver(driver.Driver):
                     conn.player.tell("\n<bright>Your account has not been created!</>", end=True)
                     conn.player.tell("-- -- -- --", end=True)
                     continue
-                self.mud_accounts.create(name_info.name, name_info.password, name_info.email, name_info.stats)
-                self.mud_accounts.save_story_data(name_info.name, name_info.story_data)
+                yield "await-result", self.account_service.create(name_info.name, name_info.password, name_info.email, name_info.stats)
+                yield "await-result", self.account_service.save_story_data(name_info.name, name_info.story_data)
                 del name_info
                 conn.player.tell("\n<bright>Your new account has been created!</>  Go ahead and log in with it.", end=True)
                 conn.player.tell("-- -- -- --", end=True)
@@ -215,14 +348,14 @@ class MudDriver(driver.Driver):
             # ask and validate the password.
             try:
                 password = yield "input-noecho", "Please type in your password."
-                self.mud_accounts.valid_password(name, password)
+                yield "await-result", self.account_service.valid_password(name, password)
                 del password
             except ValueError as x:
                 conn.output("<it>%s</it>" % x)
                 continue
 
             # try to get the account and see if it is banned or not.
-            account = self.mud_accounts.get(name)
+            account = yield "await-result", self.account_service.get(name)
             if account.banned:
                 conn.player.tell("\n<bright>You have been banned by an admin!</>  Try logging in later or get in touch.", end=True)
                 conn.player.tell("\n")
@@ -263,6 +396,8 @@ class MudDriver(driver.Driver):
             for name, value in vars(existing_player).items():
                 if not name.startswith("_") and name not in ("vnum", "soul", "input_is_available", "teleported_from", "transcript"):
                     state[name] = value
+            state["name"] = existing_player.name
+            state["aliases"] = set(existing_player.aliases)
             state["title"] = existing_player.title
             state["description"] = existing_player.description
             state["short_description"] = existing_player.short_description
@@ -275,7 +410,7 @@ class MudDriver(driver.Driver):
             self._overwrite_player(conn.player, state)
             conn.output("\n")
         else:
-            self.mud_accounts.logged_in(account.name)
+            yield "await-result", self.account_service.logged_in(account.name)
             # for a normal log in, set the connecting player to the proper account name, and move them to the starting location.
             name_info = charbuilder.PlayerNaming()
             name_info.name = account.name
@@ -294,7 +429,7 @@ class MudDriver(driver.Driver):
         if prompt:
             yield "input", "\n" + prompt
         self.story.init_player(conn.player)
-        self.mud_accounts.save_story_data(conn.player.name, conn.player.story_data)
+        yield "await-result", self.account_service.save_story_data(conn.player.name, conn.player.story_data)
         conn.output("\n")
         self.show_motd(conn.player, True)
         conn.player.look(short=False)  # force a 'look' command to get our bearings
@@ -335,24 +470,25 @@ class MudDriver(driver.Driver):
             pubsub.sync("driver-async-dialogs")
             for conn in self.all_players.values():
                 conn.write_output()
-                if conn not in self.waiting_for_input:
+                if conn not in self.waiting_for_input and conn not in self.waiting_for_result:
                     conn.write_input_prompt()
 
             # server tick goes on a timer
-            wait_time = max(0.01, self.story.config.server_tick_time - loop_duration)
-            while wait_time > 0:
-                if any(conn.player.input_is_available.is_set() for conn in self.all_players.values()):
-                    # there was player input, abort the wait loop and deal with it
-                    break
-                sub_wait = min(0.1, wait_time)  # keep things responsive
-                time.sleep(sub_wait)
-                wait_time -= sub_wait
+            if self.story.config.mud_event_loop:
+                # deferreds are only executed in the server tick, so the next tick is the latest moment we have to wake up
+                self._wait_for_input_event(previous_server_tick + self.story.config.server_tick_time - time.time())
+            else:
+                self._wait_for_input_polling(max(0.01, self.story.config.server_tick_time - loop_duration))
 
             loop_start = time.time()
             for conn in list(self.all_players.values()):
                 if conn.player.input_is_available.is_set():
                     conn.need_new_input_prompt = True
                     try:
+                        if conn in self.waiting_for_result:
+                            # the dialog is busy, ignore the input until it continues
+                            conn.player.get_pending_input()
+                            continue
                         if conn in self.waiting_for_input:
                             # this connection is processing direct input, rather than regular commands
                             dialog, validator, echo_input = self.waiting_for_input.pop(conn)
@@ -395,6 +531,26 @@ class MudDriver(driver.Driver):
                 conn.player.tell("<rev>StoryCompleted event in MUD mode - should NOT happen</> - Please report this error")
                 raise
 
+    def _wait_for_input_event(self, wait_time: float) -> None:
+        """
+        Block until a player entered some input (or a new dialog was started), or until the wait time has passed.
+        The wakeup event is cleared right after waking up and before the connections are processed,
+        so input that arrives while processing will immediately wake up the next wait.
+        """
+        if wait_time > 0:
+            self.input_wakeup.wait(wait_time)
+        self.input_wakeup.clear()
+
+    def _wait_for_input_polling(self, wait_time: float) -> None:
+        """Legacy wait loop: poll all connections for input every 0.1 seconds, until the wait time has passed."""
+        while wait_time > 0:
+            if any(conn.player.input_is_available.is_set() for conn in self.all_players.values()):
+                # there was player input, abort the wait loop and deal with it
+                break
+            sub_wait = min(0.1, wait_time)  # keep things responsive
+            time.sleep(sub_wait)
+            wait_time -= sub_wait
+
 
 class LimboReaper(base.Living):
     """The Grim Reaper hangs about in Limbo, and makes sure no one stays there for too long."""
@@ -116,6 +116,7 @@ class Bank(Item):
 
     def save(self) -> None:
         """Save the bank account data to the data file."""
+        self.mark_dirty()
         if not self.storage_file:
             return
         data = {
@@ -63,6 +63,7 @@ class Boxlike(Container):
         if self.opened:
             raise ActionRefused("It's already open.")
         self.opened = True
+        self.mark_dirty()
         actor.tell("You opened the %s." % self.name)
         actor.tell_others("{Actor} opened the %s." % self.name)
 
@@ -70,6 +71,7 @@ class Boxlike(Container):
         if not self.opened:
             raise ActionRefused("It's already closed.")
         self.opened = False
+        self.mark_dirty()
         actor.tell("You closed the %s." % self.name)
         actor.tell_others("{Actor} closed the %s." % self.name)
 
@@ -303,6 +305,7 @@ class Money(Item):
         for m in location.items:
             if isinstance(m, Money):
                 m.value += self.value
+                m.mark_dirty()
                 break
         else:
             location.insert(self, actor)
@@ -230,6 +230,7 @@ class BulletinBoard(Item):
 
     def save(self) -> None:
         """save the messages to persistent data file"""
+        self.mark_dirty()
         if not self.storage_file:
             return
         data = {
@@ -80,6 +80,15 @@ class Player(base.Living, pubsub.Listener):
             self._output.print(msg, end=end, format=format)
         return self
 
+    _hear_tell = tell
+
+    def _hear(self, message: str) -> None:
+        super()._hear(message)
+        if message == "\n":
+            self._output.p()
+        else:
+            self._output.print(message)
+
     def tell_text_file(self, file_resource: Resource, reformat=True) -> None:
         """
         Show the contents of the given text file resource to the player.
@@ -161,6 +170,8 @@ class Player(base.Living, pubsub.Listener):
             self.transcript.write("\n\n>> %s\n" % cmd)
         self.input_is_available.set()
         self.last_input_time = time.time()
+        if mud_context.driver:
+            mud_context.driver.notify_input_available()
 
     @property
     def idle_time(self) -> float:
@@ -3,6 +3,16 @@ Simple Pubsub signaling. Provides immediate (synchronous) sending,
 or store-and-forward sending when the sync() function is called.
 Uses weakrefs to not needlessly lock subscribers/topics in memory.
 
+Topics are only registered (and kept alive) while they have subscribers;
+sending an event to a topic that nobody is subscribed to does nothing at all.
+When a topic loses its last subscriber, it is put in an expiry queue and
+dropped from the registry after a while, if it is still unused by then.
+
+Optionally, delivery metrics can be recorded (see enable_metrics): per topic the
+number of published events, the sizes of the batches of events that are synced,
+and the time spent in the pubsub_event method of each kind of subscriber.
+These are kept in fixed-size histograms and can be obtained with metrics_dump.
+
 'Tale' mud driver, mudlib and interactive fiction framework
 Copyright by Irmen de Jong (irmen@razorvine.net)
 
@@ -30,17 +40,27 @@ Currently defined pubsub topics used by the Tale driver:
 
 """
 
+import bisect
+import collections
+import heapq
+import itertools
 import threading
 import time
 import weakref
-from typing import Dict, List, Tuple, Union, Optional, Set, Any
+from typing import Dict, List, Tuple, Union, Optional, Set, Any, Sequence
 
 TopicNameType = Union[str, Tuple]
 
-__all__ = ["topic", "unsubscribe_all", "Listener"]
+__all__ = ["topic", "unsubscribe_all", "Listener", "enable_metrics", "metrics_dump"]
+
+IDLE_EXPIRY = 30.0   # seconds after which a topic without subscribers is dropped from the registry
 
-all_topics = {}  # type: Dict[TopicNameType, Topic]
-__topic_lock = threading.Lock()
+all_topics = {}  # type: Dict[TopicNameType, Topic]   # the topics that have subscribers
+_known_topics = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary   # all topics that are still referenced
+_topic_lock = threading.Lock()
+_expiry_queue = []  # type: List[Tuple[float, int, Topic]]   # heap of (expiry time, seqnr, topic)
+_expiry_requests = collections.deque()  # type: collections.deque  # (expiry time, topic) not yet in the heap
+_expiry_seqnr = itertools.count()
 
 
 class Listener:
@@ -54,44 +74,185 @@ class Listener:
         pass
 
 
+class Histogram:
+    """
+    Histogram with a fixed number of buckets, given by their upper bounds.
+    Values larger than the last bound are counted in an extra overflow bucket.
+    """
+    __slots__ = ("bounds", "counts", "count", "total", "maximum")
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """upper bound of the bucket that holds the given percentile (the maximum, for the overflow bucket)"""
+        threshold = self.count * percent / 100.0
+        running = 0
+        for bound, count in zip(self.bounds, self.counts):
+            running += count
+            if running >= threshold and running > 0:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.mean,
+            "max": self.maximum,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "buckets": [[bound, count] for bound, count in zip(list(self.bounds) + [None], self.counts)]
+        }
+
+
+BATCH_SIZE_BOUNDS = tuple(2 ** i for i in range(13))     # 1 ... 4096 events
+DURATION_BOUNDS = tuple(1e-6 * 2 ** i for i in range(21))   # 1 microsecond ... 1 second
+
+
+class Metrics:
+    """Pubsub delivery metrics, recorded while metrics are enabled."""
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.published = {}  # type: Dict[TopicNameType, List[int]]    # topic -> [published, dropped (no subscribers)]
+        self.batch_sizes = {}  # type: Dict[TopicNameType, Histogram]
+        self.listener_times = {}  # type: Dict[Tuple[TopicNameType, str], Histogram]
+
+    def record_publish(self, topicname: TopicNameType, delivered: bool) -> None:
+        counts = self.published.get(topicname)
+        if counts is None:
+            counts = self.published[topicname] = [0, 0]
+        counts[0] += 1
+        if not delivered:
+            counts[1] += 1
+
+    def record_batch(self, topicname: TopicNameType, size: int) -> None:
+        histogram = self.batch_sizes.get(topicname)
+        if histogram is None:
+            histogram = self.batch_sizes[topicname] = Histogram(BATCH_SIZE_BOUNDS)
+        histogram.add(size)
+
+    def record_listener(self, topicname: TopicNameType, subscriber: Listener, duration: float) -> None:
+        key = (topicname, "%s.%s" % (type(subscriber).__module__, type(subscriber).__qualname__))
+        histogram = self.listener_times.get(key)
+        if histogram is None:
+            histogram = self.listener_times[key] = Histogram(DURATION_BOUNDS)
+        histogram.add(duration)
+
+    def as_dict(self) -> Dict[str, Any]:
+        topics = {}  # type: Dict[str, Dict[str, Any]]
+
+        def topic_entry(topicname: TopicNameType) -> Dict[str, Any]:
+            key = topicname if isinstance(topicname, str) else ":".join(str(part) for part in topicname)
+            if key not in topics:
+                topics[key] = {"published": 0, "dropped": 0, "batch_sizes": None, "listeners": {}}
+            return topics[key]
+        for topicname, (published, dropped) in self.published.items():
+            entry = topic_entry(topicname)
+            entry["published"] = published
+            entry["dropped"] = dropped
+        for topicname, histogram in self.batch_sizes.items():
+            topic_entry(topicname)["batch_sizes"] = histogram.as_dict()
+        for (topicname, listener), histogram in self.listener_times.items():
+            topic_entry(topicname)["listeners"][listener] = histogram.as_dict()
+        return {
+            "started": self.started,
+            "duration": time.time() - self.started,
+            "topics": topics
+        }
+
+
+metrics = None  # type: Optional[Metrics]
+
+
 class Topic:
     """
     A pubsub topic to send/receive events. You get these from the topic function.
     """
+    __slots__ = ("name", "subscribers", "events", "last_event", "expires", "__weakref__")
+
     def __init__(self, name: TopicNameType) -> None:
         self.name = name
         self.subscribers = set()  # type: Set[weakref.ReferenceType[Listener]]
         self.events = []  # type: List[Any]
         self.last_event = time.time()  # type: float
+        self.expires = 0.0  # type: float
 
     @property
     def idle_time(self) -> float:
+        if self.events:
+            return 0.0
         return time.time() - self.last_event
 
     def destroy(self) -> None:
         self.sync()
-        del all_topics[self.name]
+        with _topic_lock:
+            all_topics.pop(self.name, None)
+            if _known_topics.get(self.name) is self:
+                del _known_topics[self.name]
         self.name = "<defunct>"
-        del self.subscribers
+        self.subscribers = set()   # objects may still hold on to the topic and check this
         del self.events
 
     def subscribe(self, subscriber: Listener) -> None:
         if not isinstance(subscriber, Listener):
             raise TypeError("subscriber must be a Listener")
-        self.subscribers.add(weakref.ref(subscriber))
+        self.subscribers.add(weakref.ref(subscriber, self.__subscriber_gone))
+        if self.name not in all_topics:
+            with _topic_lock:
+                all_topics.setdefault(self.name, self)
 
     def unsubscribe(self, subscriber: Listener) -> None:
-        self.subscribers.discard(weakref.ref(subscriber))
+        subber_ref = weakref.ref(subscriber)
+        if subber_ref in self.subscribers:
+            self.subscribers.discard(subber_ref)
+            if not self.subscribers:
+                self.__schedule_expiry()
+
+    def __subscriber_gone(self, subber_ref: 'weakref.ReferenceType[Listener]') -> None:
+        # weakref callback: the subscriber has been garbage collected
+        self.subscribers.discard(subber_ref)
+        if not self.subscribers:
+            self.__schedule_expiry()
+
+    def __schedule_expiry(self) -> None:
+        # This can run in any thread, also from the weakref callback during garbage collection,
+        # so it doesn't touch the heap or take the lock. expire_idle() moves it into the heap.
+        self.expires = time.time() + IDLE_EXPIRY
+        _expiry_requests.append((self.expires, self))
 
     def send(self, event: Any, synchronous: bool=False) -> Optional[List[Any]]:
+        if metrics is not None:
+            metrics.record_publish(self.name, bool(self.subscribers))
+        if not self.subscribers:
+            return [] if synchronous else None
         self.events.append(event)
-        self.last_event = time.time()
         if synchronous:
             return self.sync()
         return None
 
     def sync(self) -> List[Any]:
+        if not self.events:
+            return []
         events, self.events = self.events, []
+        self.last_event = time.time()
+        if metrics is not None:
+            metrics.record_batch(self.name, len(events))
         results = []
         for event in events:
             results.extend(self.__sync_event(event))
@@ -99,41 +260,90 @@ class Topic:
 
     def __sync_event(self, event: Any) -> List[Any]:
         results = []
-        for subber_ref in self.subscribers:
+        for subber_ref in list(self.subscribers):
             subber = subber_ref()
             if subber is not None:
+                recorder = metrics
+                start = time.perf_counter() if recorder else 0.0
                 try:
                     result = subber.pubsub_event(self.name, event)
                     results.append(result)
                 except Listener.NotYet:
                     pass
+                finally:
+                    if recorder:
+                        recorder.record_listener(self.name, subber, time.perf_counter() - start)
         return results
 
 
 def topic(name: TopicNameType) -> Topic:
     """Create a topic object (singleton). Name can be a string or a tuple."""
-    with __topic_lock:
-        if name in all_topics:
-            return all_topics[name]
-        instance = all_topics[name] = Topic(name)
-        return instance
+    instance = all_topics.get(name)
+    if instance is None:
+        with _topic_lock:
+            instance = _known_topics.get(name)
+            if instance is None:
+                instance = _known_topics[name] = Topic(name)
+    return instance
 
 
 def sync(topic: TopicNameType=None) -> List:
     """Sync all pending events (i.e. push them to the subscribers)"""
     if topic:
-        return all_topics[topic].sync()
+        instance = all_topics.get(topic)
+        return instance.sync() if instance else []
     else:
         for t in list(all_topics.values()):
-            t.sync()
+            if t.events:
+                t.sync()
         return []
 
 
 def pending(topicname: TopicNameType=None) -> Dict[TopicNameType, Tuple[int, float, int]]:
     """Return a dictionary from topic name to tuple (number of pending events, idle time, num subbers)"""
-    with __topic_lock:
-        topics = [all_topics[topicname]] if topicname else list(all_topics.values())
-        return {t.name: (len(t.events), t.idle_time, len(t.subscribers)) for t in topics}
+    with _topic_lock:
+        if topicname:
+            topics = [t for t in [_known_topics.get(topicname)] if t]
+        else:
+            topics = list(_known_topics.values())
+    return {t.name: (len(t.events), t.idle_time, len(t.subscribers)) for t in topics}
+
+
+def expire_idle() -> None:
+    """
+    Drop the topics from the registry that lost their subscribers longer than IDLE_EXPIRY seconds ago.
+    Their Topic objects remain valid and will register themselves again when they get a new subscriber.
+    """
+    now = time.time()
+    with _topic_lock:
+        while _expiry_requests:
+            expires, t = _expiry_requests.popleft()
+            heapq.heappush(_expiry_queue, (expires, next(_expiry_seqnr), t))
+        while _expiry_queue and _expiry_queue[0][0] <= now:
+            expires, _, t = heapq.heappop(_expiry_queue)
+            if t.expires == expires and not t.subscribers and not t.events and all_topics.get(t.name) is t:
+                del all_topics[t.name]
+
+
+def enable_metrics(enabled: bool=True) -> None:
+    """
+    Switch the recording of delivery metrics on or off. Switching it on
+    starts with fresh metrics. Recording costs a bit of time for every event.
+    """
+    global metrics
+    metrics = Metrics() if enabled else None
+
+
+def metrics_dump() -> Dict[str, Any]:
+    """
+    The recorded delivery metrics, as a dictionary containing only builtin types (can be converted to json).
+    Tuple topic names are joined with ':'. Durations are in seconds.
+    """
+    if metrics is None:
+        return {"enabled": False}
+    dump = metrics.as_dict()
+    dump["enabled"] = True
+    return dump
 
 
 def unsubscribe_all(subscriber: Listener) -> None:
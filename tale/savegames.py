@@ -1,7 +1,11 @@
+import collections
+import copy
 import datetime
+import enum
 import importlib
 import gzip
-from typing import Any, Tuple, List, Optional, Dict, Type, Sequence, Union
+import struct
+from typing import Any, Tuple, List, Optional, Dict, Type, Sequence, Union, Callable
 
 from .base import Item, Location, Living, Exit, Door, MudObject, MudObjRegistry, Stats, _limbo
 from .story import StoryConfig, MoneyType, GameMode, TickMethod
@@ -42,41 +46,298 @@ def qual_baseclassname(obj: MudObject) -> str:
         raise ValueError("cannot determine Tale base class", obj)
 
 
+class BinaryEncoder:
+    """
+    Compact binary encoding of the savegame data, as an alternative to serpent's python literal text.
+    It produces exactly the same structure when decoded as serpent does when it reads its text back,
+    so the deserializer can recreate the objects in the same way. Registered classes are converted to
+    their state dict with the given functions, and strings that occur more than once are stored only once.
+    Format (version 1): a tag byte followed by the value:
+        N=None T=True F=False  b=int 0..255 (1 byte)  i=int (8 bytes)  I=big int (as text)  f=float (8 bytes)
+        s=new string (length + utf-8)  r=repeated string (index)  q=repeated string (index 0..255, 1 byte)
+        l=list  t=tuple  S=set  d=dict  (length + the elements, or the key and value pairs)
+    Lengths and indexes are 4 byte unsigned integers, everything is little endian.
+    """
+    version = 1
+
+    def __init__(self, state_functions: Sequence[Tuple[Type, Callable[[Any], Dict[str, Any]]]]) -> None:
+        self.state_functions = state_functions
+        self.serpent = serpent.Serializer(module_in_classname=True)
+
+    def encode(self, obj: Any) -> bytes:
+        self.out = bytearray([self.version])
+        self.strings = {}   # type: Dict[str, int]
+        self.active_ids = set()     # type: set
+        self._encode(obj)
+        out = bytes(self.out)
+        del self.out, self.strings
+        return out
+
+    def _encode(self, obj: Any) -> None:
+        out = self.out
+        t = type(obj)
+        if t is str:
+            index = self.strings.get(obj)
+            if index is None:
+                self.strings[obj] = len(self.strings)
+                data = obj.encode("utf-8", "surrogatepass")
+                out += b"s" + pack_uint(len(data)) + data
+            elif index <= 255:
+                out += short_string_refs[index]
+            else:
+                out += b"r" + pack_uint(index)
+        elif t is int:
+            if 0 <= obj <= 255:
+                out += small_ints[obj]
+            elif -2**63 <= obj < 2**63:
+                out += b"i" + pack_int(obj)
+            else:
+                data = str(obj).encode("ascii")
+                out += b"I" + pack_uint(len(data)) + data
+        elif obj is None:
+            out += b"N"
+        elif t is bool:
+            out += b"T" if obj else b"F"
+        elif t is float:
+            out += b"f" + pack_float(obj)
+        elif t is dict:
+            self._encode_dict(obj)
+        elif t is list or t is tuple or t is set or t is frozenset:
+            self._encode_sequence(obj, t)
+        else:
+            self._encode_object(obj, t)
+
+    def _encode_sequence(self, obj: Any, t: Type) -> None:
+        if t is list:
+            self.out += b"l"
+        elif t is tuple or not obj:
+            self.out += b"t"    # serpent also stores an empty set as an empty tuple
+        else:
+            self.out += b"S"
+        self.out += pack_uint(len(obj))
+        out = self.out
+        encode = self._encode
+        strings = self.strings
+        for element in obj:
+            # shortcuts for the most common values, inlined for speed
+            t = type(element)
+            if t is str:
+                index = strings.get(element, 256)
+                if index <= 255:
+                    out += short_string_refs[index]
+                    continue
+            elif t is int and 0 <= element <= 255:
+                out += small_ints[element]
+                continue
+            encode(element)
+
+    def _encode_dict(self, obj: Dict) -> None:
+        if id(obj) in self.active_ids:
+            raise ValueError("Circular reference detected (dict)")
+        self.active_ids.add(id(obj))
+        out = self.out
+        out += b"d" + pack_uint(len(obj))
+        encode = self._encode
+        strings = self.strings
+        for key, value in obj.items():
+            # shortcuts for the most common keys and values, inlined for speed
+            index = strings.get(key, 256) if type(key) is str else 256
+            if index <= 255:
+                out += short_string_refs[index]
+            else:
+                encode(key)
+            t = type(value)
+            if t is str:
+                index = strings.get(value, 256)
+                if index <= 255:
+                    out += short_string_refs[index]
+                    continue
+            elif value is None:
+                out += b"N"
+                continue
+            elif t is bool:
+                out += b"T" if value else b"F"
+                continue
+            elif t is int and 0 <= value <= 255:
+                out += small_ints[value]
+                continue
+            encode(value)
+        self.active_ids.discard(id(obj))
+
+    def _encode_object(self, obj: Any, t: Type) -> None:
+        # the other types are converted in the same way as serpent does it
+        for clazz, state_function in self.state_functions:
+            if isinstance(obj, clazz):
+                self._encode(state_function(obj))
+                return
+        if isinstance(obj, enum.Enum):
+            self._encode(obj.value)
+        elif isinstance(obj, (datetime.datetime, datetime.date)):
+            self._encode(obj.isoformat())
+        elif isinstance(obj, (dict, list, tuple, set, frozenset)) and not isinstance(obj, collections.OrderedDict):
+            base_type = next(base for base in t.__mro__ if base in (dict, list, tuple, set, frozenset))
+            self._encode(base_type(obj))
+        elif hasattr(obj, "__dict__") and getattr(t, "__getstate__", None) is getattr(object, "__getstate__", None) \
+                and not any(base in serpent.Serializer.dispatch for base in t.__mro__):
+            # a regular object, serpent stores its vars
+            if id(obj) in self.active_ids:
+                raise ValueError("Circular reference detected (class)")
+            self.active_ids.add(id(obj))
+            state = dict(vars(obj))
+            state["__class__"] = qual_classname(obj)
+            self._encode(state)
+            self.active_ids.discard(id(obj))
+        else:
+            # special types such as bytes, Decimal, uuid, timedelta, exceptions and OrderedDict
+            self._encode(serpent.loads(self.serpent.serialize(obj)))
+
+
+class BinaryDecoder:
+    """Decodes the data made by the BinaryEncoder."""
+    def decode(self, data: bytes) -> Any:
+        if not data or data[0] != BinaryEncoder.version:
+            raise ValueError("unsupported binary savegame format version")
+        self.data = data
+        self.position = 1
+        self.strings = []   # type: List[str]
+        try:
+            result = self._decode()
+        except (IndexError, KeyError, struct.error):
+            raise ValueError("corrupt binary savegame data")
+        if self.position != len(data):
+            raise ValueError("corrupt binary savegame data")
+        del self.data, self.strings
+        return result
+
+    def _uint(self) -> int:
+        value = unpack_uint(self.data, self.position)[0]
+        self.position += 4
+        return value
+
+    def _decode(self) -> Any:
+        data = self.data
+        tag = data[self.position]
+        self.position += 1
+        if tag == 113:    # q
+            self.position += 1
+            return self.strings[data[self.position - 1]]
+        if tag == 114:    # r
+            return self.strings[self._uint()]
+        if tag == 115:    # s
+            length = self._uint()
+            value = data[self.position:self.position + length].decode("utf-8", "surrogatepass")
+            self.position += length
+            self.strings.append(value)
+            return value
+        if tag == 98:    # b
+            self.position += 1
+            return data[self.position - 1]
+        if tag == 100:    # d
+            result = {}
+            for _ in range(self._uint()):
+                key = self._decode()
+                result[key] = self._decode()
+            return result
+        if tag == 108:    # l
+            return [self._decode() for _ in range(self._uint())]
+        if tag == 116:    # t
+            return tuple([self._decode() for _ in range(self._uint())])
+        if tag == 83:    # S
+            return {self._decode() for _ in range(self._uint())}
+        if tag == 78:    # N
+            return None
+        if tag == 84:    # T
+            return True
+        if tag == 70:    # F
+            return False
+        if tag == 105:    # i
+            self.position += 8
+            return unpack_int(data, self.position - 8)[0]
+        if tag == 102:    # f
+            self.position += 8
+            return unpack_float(data, self.position - 8)[0]
+        if tag == 73:    # I
+            length = self._uint()
+            self.position += length
+            return int(data[self.position - length:self.position].decode("ascii"))
+        raise ValueError("corrupt binary savegame data")
+
+
+small_ints = tuple(b"b" + bytes((i,)) for i in range(256))
+short_string_refs = tuple(b"q" + bytes((i,)) for i in range(256))
+pack_uint = struct.Struct("<I").pack
+pack_int = struct.Struct("<q").pack
+pack_float = struct.Struct("<d").pack
+unpack_uint = struct.Struct("<I").unpack_from
+unpack_int = struct.Struct("<q").unpack_from
+unpack_float = struct.Struct("<d").unpack_from
+immutable_types = frozenset([str, int, float, bool, type(None), bytes])
+
+
 class TaleSerializer:
     xor_key = 0x5c    # please do not hack the save files
-
-    def __init__(self):
-        serpent.register_class(Player, self.serialize_player)
-        serpent.register_class(ShopBehavior, self.serialize_shopbehavior)
-        serpent.register_class(Location, self.serialize_location)
-        serpent.register_class(Stats, self.serialize_stats)
-        serpent.register_class(Item, self.serialize_item)
-        serpent.register_class(Living, self.serialize_living)
-        serpent.register_class(Exit, self.serialize_exit)
-        serpent.register_class(Deferred, self.serialize_deferred)
+    xor_table = bytes(map(xor_key.__xor__, range(256)))   # xor every byte with the key in one go, using bytes.translate
+
+    def __init__(self, format: str="serpent", exclude_players: bool=False) -> None:
+        if format not in ("serpent", "binary"):
+            raise ValueError("invalid savegame format: " + format)
+        self.format = format
+        self.exclude_players = exclude_players   # leave out the (references to) players, for the world state of a mud
+        # the classes that need special treatment, and the functions that return the state to be saved of their objects
+        self.state_functions = [
+            (Player, self.player_state),
+            (ShopBehavior, self.shopbehavior_state),
+            (Location, self.location_state),
+            (Stats, self.stats_state),
+            (Item, self.item_state),
+            (Living, self.living_state),
+            (Exit, self.exit_state),
+            (Deferred, self.deferred_state)
+        ]   # type: List[Tuple[Type, Callable[[Any], Dict[str, Any]]]]
+        for clazz, state_function in self.state_functions:
+            serpent.register_class(clazz, self._serpent_serializer(state_function))
         self.serializer = serpent.Serializer(indent=True, module_in_classname=True)
 
+    @staticmethod
+    def _serpent_serializer(state_function: Callable[[Any], Dict[str, Any]]) -> Callable:
+        def serialize(obj: Any, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+            ser._serialize(state_function(obj), out, indentlevel)
+        return serialize
+
     def serialize(self, story: StoryConfig, player: Player, items: Sequence[Item], livings: Sequence[Living],
                   locations: Sequence[Location], exits: Sequence[Exit],
-                  deferreds: Sequence[Deferred], clock: GameDateTime):
-        livings = [l for l in livings if l is not player]
-        if _limbo not in locations:
-            locations = list(locations)
-            locations.append(_limbo)
-        if any(i not in items for i in player.inventory):
-            raise ValueError("missing item (from player inventory)")
-        if any(i not in items for living in livings for i in living.inventory):
-            raise ValueError("missing item (from living inventory)")
-        if any(i not in items for loc in locations for i in loc.items):
-            raise ValueError("missing item (from locations)")
-        if any(l is not player and l not in livings for loc in locations for l in loc.livings):
-            raise ValueError("missing living (from locations)")
-        if any(living.location is not None and living.location not in locations for living in livings):
-            raise ValueError("missing location (from livings)")
-        if player.location is not None and player.location not in locations:
-            raise ValueError("missing location (from player)")
-        if any(e not in exits for loc in locations for e in loc.exits.values()):
-            raise ValueError("missing exit (from location)")
+                  deferreds: Sequence[Deferred], clock: GameDateTime, savegame_id: str="",
+                  states: Dict[int, Dict[str, Any]]=None):
+        """
+        Full save. If states is given (a dict vnum -> state), it is filled with the saved states of
+        the items, locations and exits, so that serialize_delta() can write only what changes after this.
+        """
+        data = self.savegame_state(story, player, items, livings, locations, exits, deferreds, clock, savegame_id)
+        if states is not None:
+            data = self.snapshot(data, states)
+        return self.encode(data)
+
+    def serialize_delta(self, story: StoryConfig, player: Player, items: Sequence[Item], livings: Sequence[Living],
+                        locations: Sequence[Location], exits: Sequence[Exit],
+                        deferreds: Sequence[Deferred], clock: GameDateTime, savegame_id: str, number: int,
+                        states: Dict[int, Dict[str, Any]]):
+        """
+        Incremental save: like serialize(), but only the items, locations and exits that have changed
+        since the previous save are written: the ones whose state differs from their state in states
+        (that the previous save has filled in), or that have been marked dirty. The states are updated.
+        For all others only the vnum is written, so the loader knows they're still there.
+        The livings and the player are always written completely, because their stats and such are often changed in-place.
+        The delta must be applied on top of the full save with the same savegame_id and the deltas before it,
+        see TaleDeserializer.deserialize_incremental().
+        """
+        data = self.savegame_delta_state(story, player, items, livings, locations, exits, deferreds, clock, savegame_id, number, states)
+        return self.encode(self.snapshot(data, states))
+
+    def savegame_state(self, story: StoryConfig, player: Player, items: Sequence[Item], livings: Sequence[Living],
+                       locations: Sequence[Location], exits: Sequence[Exit],
+                       deferreds: Sequence[Deferred], clock: GameDateTime, savegame_id: str="") -> Dict[str, Any]:
+        """the data that serialize() encodes"""
+        livings, locations = self.check_consistency(player, items, livings, locations, exits)
         data = {
             # "story_version": story.version,
             # "tale_version_required": story.requires_tale,
@@ -89,20 +350,185 @@ class TaleSerializer:
             "deferreds": deferreds,
             "player": player,
         }
+        if savegame_id:
+            data["savegame_id"] = savegame_id   # incremental saves (see serialize_delta) refer to this
+        return data
+
+    def savegame_delta_state(self, story: StoryConfig, player: Player, items: Sequence[Item], livings: Sequence[Living],
+                             locations: Sequence[Location], exits: Sequence[Exit],
+                             deferreds: Sequence[Deferred], clock: GameDateTime, savegame_id: str, number: int,
+                             previous: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+        """the data that serialize_delta() encodes, previous are the saved states (vnum -> state, see snapshot())"""
+        livings, locations = self.check_consistency(player, items, livings, locations, exits)
+        data = {
+            "story_config": story,
+            "clock": clock,
+            "items": self._changed_objects(items, previous),
+            "livings": livings,
+            "locations": self._changed_objects(locations, previous),
+            "exits": self._changed_objects(exits, previous),
+            "deferreds": deferreds,
+            "player": player,
+            "item_refs": [i.vnum for i in items],
+            "location_refs": [loc.vnum for loc in locations],
+            "exit_refs": [e.vnum for e in exits],
+            "savegame_id": savegame_id,
+            "delta": number
+        }
+        return data
+
+    def _changed_objects(self, objects: Sequence[Union[Item, Location, Exit]],
+                         previous: Dict[int, Dict[str, Any]]) -> List[Union[Item, Location, Exit]]:
+        return [obj for obj in objects if obj._dirty or previous.get(obj.vnum) != self.snapshot(obj)]
+
+    def world_state(self, story: StoryConfig, items: Sequence[Item], livings: Sequence[Living],
+                    locations: Sequence[Location], exits: Sequence[Exit],
+                    deferreds: Sequence[Deferred], clock: GameDateTime) -> Dict[str, Any]:
+        """
+        The state of the world without any players (and the things they carry), that a mud uses to persist the world.
+        Use exclude_players=True for this, so that the locations and the livings don't refer to the players.
+        """
+        if not self.exclude_players:
+            raise TaleError("world state requires exclude_players")
+        livings, locations = self.check_consistency(None, items, livings, locations, exits)
+        return {
+            "story_config": story,
+            "clock": clock,
+            "items": items,
+            "livings": livings,
+            "locations": locations,
+            "exits": exits,
+            "deferreds": deferreds
+        }
+
+    def check_consistency(self, player: Optional[Player], items: Sequence[Item], livings: Sequence[Living],
+                          locations: Sequence[Location], exits: Sequence[Exit]) -> Tuple[List[Living], List[Location]]:
+        """checks that all objects referenced are saved as well, returns the livings (without player) and locations (with limbo) to save"""
+        livings = [l for l in livings if l is not player]
+        if self.exclude_players:
+            livings = [l for l in livings if not isinstance(l, Player)]
+        locations = list(locations)
+        if _limbo not in locations:
+            locations.append(_limbo)
+        item_ids = {id(i) for i in items}
+        living_ids = {id(l) for l in livings}
+        location_ids = {id(loc) for loc in locations}
+        exit_ids = {id(e) for e in exits}
+        if player is not None and any(id(i) not in item_ids for i in player.inventory):
+            raise ValueError("missing item (from player inventory)")
+        if any(id(i) not in item_ids for living in livings for i in living.inventory):
+            raise ValueError("missing item (from living inventory)")
+        if any(id(i) not in item_ids for loc in locations for i in loc.items):
+            raise ValueError("missing item (from locations)")
+        if any(l is not player and id(l) not in living_ids and not (self.exclude_players and isinstance(l, Player))
+               for loc in locations for l in loc.livings):
+            raise ValueError("missing living (from locations)")
+        if any(living.location is not None and id(living.location) not in location_ids for living in livings):
+            raise ValueError("missing location (from livings)")
+        if player is not None and player.location is not None and id(player.location) not in location_ids:
+            raise ValueError("missing location (from player)")
+        if any(id(e) not in exit_ids for loc in locations for e in loc.exits.values()):
+            raise ValueError("missing exit (from location)")
+        return livings, locations
+
+    def snapshot(self, data: Any, previous: Dict[int, Dict[str, Any]]=None, changed: List[Any]=None) -> Any:
+        """
+        Returns a copy of the data in which all game objects have been replaced by their state to be saved.
+        It doesn't share anything mutable with the game, so it can be encoded in another thread
+        while the game continues (and changes the objects). Encoding the snapshot gives the same result.
+        The states of the items, locations and exits are never changed once they're in a snapshot, so they can be shared
+        (copy on write): previous is a dict (vnum -> state) that is updated with the states of this snapshot.
+        The state of every object is computed again, but when it is equal to the previous one, that one is reused.
+        The items, locations and exits whose state did change are appended to changed, if it's given.
+        """
+        self.active_ids = set()     # type: set
+        self.previous = previous
+        self.changed = changed
+        try:
+            return self._snapshot(data)
+        finally:
+            del self.active_ids, self.previous, self.changed
+
+    def _snapshot(self, obj: Any) -> Any:
+        t = type(obj)
+        if t in immutable_types:
+            return obj
+        if t is dict:
+            return self._snapshot_dict(obj)
+        if t is list or t is tuple or t is set or t is frozenset:
+            return self._snapshot_sequence(obj, t)
+        for clazz, state_function in self.state_functions:
+            if isinstance(obj, clazz):
+                if self.previous is not None and isinstance(obj, (Item, Location, Exit)):
+                    state = self._snapshot_dict(state_function(obj))
+                    previous_state = self.previous.get(obj.vnum)
+                    if state == previous_state:
+                        return previous_state
+                    self.previous[obj.vnum] = state
+                    if self.changed is not None:
+                        self.changed.append(obj)
+                    return state
+                return self._snapshot_dict(state_function(obj))
+        if isinstance(obj, (enum.Enum, datetime.date)):
+            return obj      # immutable
+        if isinstance(obj, (dict, list, tuple, set, frozenset)) and not isinstance(obj, collections.OrderedDict):
+            base_type = next(base for base in t.__mro__ if base in (dict, list, tuple, set, frozenset))
+            return self._snapshot(base_type(obj))
+        if hasattr(obj, "__dict__") and getattr(t, "__getstate__", None) is getattr(object, "__getstate__", None) \
+                and not any(base in serpent.Serializer.dispatch for base in t.__mro__):
+            # a regular object, the state is its vars (as serpent stores it)
+            if id(obj) in self.active_ids:
+                raise ValueError("Circular reference detected (class)")
+            self.active_ids.add(id(obj))
+            state = self._snapshot_dict(dict(vars(obj)))
+            state["__class__"] = qual_classname(obj)
+            self.active_ids.discard(id(obj))
+            return state
+        return copy.deepcopy(obj)
+
+    def _snapshot_dict(self, obj: Dict) -> Dict:
+        if id(obj) in self.active_ids:
+            raise ValueError("Circular reference detected (dict)")
+        self.active_ids.add(id(obj))
+        copied = {}
+        snapshot = self._snapshot
+        for key, value in obj.items():
+            copied[key] = value if type(value) in immutable_types else snapshot(value)
+        self.active_ids.discard(id(obj))
+        return copied
+
+    def _snapshot_sequence(self, obj: Any, t: Type) -> Any:
+        if t is tuple or t is frozenset:
+            if all(type(element) in immutable_types for element in obj):
+                return obj      # immutable (this is the case for the references to other objects)
+        elif id(obj) in self.active_ids:
+            raise ValueError("Circular reference detected (sequence)")
+        self.active_ids.add(id(obj))
+        snapshot = self._snapshot
+        copied = t([element if type(element) in immutable_types else snapshot(element) for element in obj])
+        self.active_ids.discard(id(obj))
+        return copied
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        if self.format == "binary":
+            return self.obfuscate(BinaryEncoder(self.state_functions).encode(data), b"TALEBIN1")
         serialized = self.serializer.serialize(data)
         return self.obfuscate(serialized)
 
-    def obfuscate(self, data: bytes) -> bytes:
-        data = gzip.compress(data)
-        return b"TALESAVE1" + bytes(b ^ self.xor_key for b in data)
+    def obfuscate(self, data: bytes, header: bytes=b"TALESAVE1") -> bytes:
+        data = gzip.compress(data, compresslevel=6)   # barely larger than level 9, but many times faster
+        return header + data.translate(self.xor_table)
 
     def add_basic_properties(self, state: Dict[str, Any], obj: MudObject) -> None:
         state["__class__"] = qual_classname(obj)
         state["__base_class__"] = qual_baseclassname(obj)
+        state["name"] = obj.name
+        state["aliases"] = set(obj.aliases) if isinstance(obj.aliases, set) else obj.aliases
         state["title"] = obj.title
         state["descr"] = obj.description
         state["short_descr"] = obj.short_description
         state["extra_desc"] = obj.extra_desc
+        state["verbs"] = dict(obj.verbs)
 
     def add_inventory_property(self, state: Dict[str, Any], obj: MudObject) -> None:
         try:
@@ -112,14 +538,15 @@ class TaleSerializer:
         else:
             state["inventory"] = {mudobj_ref(m) for m in inv}
 
-    def serialize_shopbehavior(self, obj: ShopBehavior, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def shopbehavior_state(self, obj: ShopBehavior) -> Dict[str, Any]:
         state = dict(vars(obj))
         state["__class__"] = qual_classname(obj)
         state["forsale"] = {mudobj_ref(i) for i in state["forsale"]}
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_deferred(self, obj: Deferred, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def deferred_state(self, obj: Deferred) -> Dict[str, Any]:
         state = dict(vars(obj))
+        del state["_resolved"]   # cached function lookup, can't be serialized
         state["__class__"] = qual_classname(obj)
         if not isinstance(state["owner"], str):
             try:
@@ -127,9 +554,9 @@ class TaleSerializer:
             except Exception:
                 # owner is not a regular mudobj
                 state["owner"] = "class:" + qual_classname(state["owner"])
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_stats(self, obj: Stats, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def stats_state(self, obj: Stats) -> Dict[str, Any]:
         state = {
             "__class__": qual_classname(obj),
             "race": obj.race,
@@ -143,9 +570,9 @@ class TaleSerializer:
             "alignment": obj.alignment
             # the other attributes are re-initialized from the races table
         }
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_player(self, obj: Player, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def player_state(self, obj: Player) -> Dict[str, Any]:
         state = dict(vars(obj))
         # remove stuff we don't want to serialize at all
         unserialized_attrs = {"subjective", "possessive", "objective", "teleported_from", "soul",
@@ -168,9 +595,9 @@ class TaleSerializer:
         state["location"] = mudobj_ref(state["location"])
         state["inventory"] = {mudobj_ref(thing) for thing in obj.inventory}
         state["following"] = mudobj_ref(state["following"])
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_item(self, obj: Item, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def item_state(self, obj: Item) -> Dict[str, Any]:
         if obj.contained_in and obj not in obj.contained_in:
             raise TaleError("item {} containment inconsistency".format(obj))
         state = dict(vars(obj))
@@ -182,9 +609,9 @@ class TaleSerializer:
                 del state[name]
         self.add_basic_properties(state, obj)  # basic properties
         self.add_inventory_property(state, obj)  # inventory (of Container subtype)
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_living(self, obj: Living, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def living_state(self, obj: Living) -> Dict[str, Any]:
         if obj.location and obj.location is not _limbo and obj not in obj.location:
             raise TaleError("living {} location inconsistency".format(obj))
         state = dict(vars(obj))
@@ -204,10 +631,12 @@ class TaleSerializer:
         state["race"] = obj.stats.race
         state["location"] = mudobj_ref(state["location"])
         state["inventory"] = {mudobj_ref(thing) for thing in obj.inventory}
+        if self.exclude_players and isinstance(state["following"], Player):
+            state["following"] = None
         state["following"] = mudobj_ref(state["following"])
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_exit(self, obj: Exit, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def exit_state(self, obj: Exit) -> Dict[str, Any]:
         state = dict(vars(obj))
         # remove stuff we don't want to serialize at all
         for name in list(state):
@@ -218,9 +647,9 @@ class TaleSerializer:
         if "linked_door" in state:
             # it's probably a Door, and linked_door referes to another door (cyclic)
             state["linked_door"] = mudobj_ref(state["linked_door"])
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_location(self, obj: Location, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def location_state(self, obj: Location) -> Dict[str, Any]:
         state = dict(vars(obj))
         # remove stuff we don't want to serialize at all
         for name in list(state):
@@ -228,20 +657,52 @@ class TaleSerializer:
                 del state[name]
         self.add_basic_properties(state, obj)
         # livings and items, and the exits, present in this location:
-        state["livings"] = {mudobj_ref(l) for l in state["livings"]}
+        if self.exclude_players:
+            state["livings"] = {mudobj_ref(l) for l in state["livings"] if not isinstance(l, Player)}
+        else:
+            state["livings"] = {mudobj_ref(l) for l in state["livings"]}
         state["items"] = {mudobj_ref(i) for i in state["items"]}
         state["exits"] = {mudobj_ref(e) for e in state["exits"].values()}
-        ser._serialize(state, out, indentlevel)
+        return state
 
 
 class TaleDeserializer:
     def deserialize(self, data):
+        if data.startswith(b"TALEBIN1"):
+            return BinaryDecoder().decode(gzip.decompress(data[8:].translate(TaleSerializer.xor_table)))
         return serpent.loads(self.deobfuscate(data))
 
+    def deserialize_incremental(self, data: bytes, deltas: Sequence[bytes]) -> Tuple[Dict[str, Any], str, int]:
+        """
+        Deserializes a full save and applies the incremental saves (see TaleSerializer.serialize_delta) on top of it, in order.
+        Stops at the first delta that doesn't belong to the full save (a leftover from an older save).
+        Returns the resulting state (the same as what deserialize() returns for a full save of that game state),
+        the savegame id, and the number of deltas that have been applied.
+        """
+        state = self.deserialize(data)
+        savegame_id = state.pop("savegame_id", "")
+        applied = 0
+        if savegame_id:
+            for number, delta_data in enumerate(deltas, start=1):
+                delta = self.deserialize(delta_data)
+                if delta["savegame_id"] != savegame_id or delta["delta"] != number:
+                    break
+                for key in ("story_config", "clock", "livings", "deferreds", "player"):
+                    state[key] = delta[key]
+                for key, refs_key in (("items", "item_refs"), ("locations", "location_refs"), ("exits", "exit_refs")):
+                    states = {obj_state["vnum"]: obj_state for obj_state in state[key]}
+                    states.update((obj_state["vnum"], obj_state) for obj_state in delta[key])
+                    try:
+                        state[key] = [states[vnum] for vnum in delta[refs_key]]
+                    except KeyError as x:
+                        raise ValueError("incremental savegame misses the state of object #%s" % x) from None
+                applied = number
+        return state, savegame_id, applied
+
     def deobfuscate(self, data: bytes) -> bytes:
         if not data.startswith(b"TALESAVE1"):
             return data
-        return gzip.decompress(bytes(b ^ TaleSerializer.xor_key for b in data[9:]))
+        return gzip.decompress(data[9:].translate(TaleSerializer.xor_table))
 
     def recreate_classes(self, literal, existing_object_lookup):
         t = type(literal)
@@ -482,6 +943,7 @@ class TaleDeserializer:
                 # remove the item from its original location, it was moved here
                 thing.contained_in.remove(thing, None)
             thing.contained_in = loc
+        loc._reindex_verbs()
         # livings are moved in the correct location when they're created elsewhere.
         return loc
 
@@ -501,6 +963,54 @@ class TaleDeserializer:
                 if type(value) is int and atype is float:
                     # special case for int vs float (accept ints if type is float)
                     value = float(value)
+                elif type(value) is dict and issubclass(atype, dict):
+                    pass    # special case for dict subclasses such as the verbs dict
                 else:
                     raise TypeError("{}.{} has different type".format(obj.__class__, name))
             setattr(obj, name, value)
+
+
+class SavegameExistingObjectsFinder:
+    def resolve_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> MudObject:
+        if baseclassname == "tale.base.Item":
+            return self.resolve_item_ref(vnum, name, classname, baseclassname)
+        elif baseclassname == "tale.base.Location":
+            return self.resolve_location_ref(vnum, name, classname, baseclassname)
+        elif baseclassname == "tale.base.Living":
+            return self.resolve_living_ref(vnum, name, classname, baseclassname)
+        else:
+            raise TaleError("invalid base class for resolve_ref: " + baseclassname)
+
+    def resolve_location_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> Location:
+        loc = MudObjRegistry.all_locations.get(vnum, None)
+        if not loc:
+            raise LookupError("location vnum not found: " + str(vnum))
+        if loc.name != name or qual_baseclassname(loc) != baseclassname:
+            raise TaleError("location inconsistency for vnum " + str(vnum))
+        return loc
+
+    def resolve_living_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> Living:
+        liv = MudObjRegistry.all_livings.get(vnum, None)
+        if not liv:
+            raise LookupError("living vnum not found: " + str(vnum))
+        if liv.name != name:
+            if qual_baseclassname(liv) != baseclassname:
+                if baseclassname == "tale.player.Player":
+                    return liv  # special case when the living is the Player
+                raise TaleError("living inconsistency for vnum " + str(vnum))
+        return liv
+
+    def resolve_item_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> Item:
+        item = MudObjRegistry.all_items.get(vnum, None)
+        if not item:
+            raise LookupError("item vnum not found: " + str(vnum))
+        if item.name != name or qual_baseclassname(item) != baseclassname:
+            raise TaleError("item inconsistency for vnum " + str(vnum))
+        return item
+
+    def resolve_exit(self, vnum: int, name: str, classname: str, baseclassname: str) -> Union[Exit, Door]:
+        assert baseclassname == "tale.base.Exit"
+        exit = MudObjRegistry.all_exits[vnum]
+        if exit.name != name or qual_baseclassname(exit) != baseclassname:
+            raise TaleError("exit/door inconsistency for vnum " + str(vnum))
+        return exit
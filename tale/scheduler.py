@@ -0,0 +1,248 @@
+"""
+Scheduler backends that hold the driver's Deferreds, ordered on their due (game) time.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import datetime
+import heapq
+import itertools
+import weakref
+from typing import Any, Callable, Dict, Iterator, List, Union
+
+__all__ = ["DeferredScheduler", "HeapScheduler", "TimingWheelScheduler", "PeriodicGroup", "create_scheduler"]
+
+
+class DeferredScheduler:
+    """
+    Base class for the deferreds scheduler backends.
+    The scheduler only looks at the ``due_gametime`` and ``owner`` attributes of the deferreds.
+    It is not thread safe by itself, the driver guards it with its deferreds_lock.
+    It can be iterated over (in no particular order) and indexed (in due time order, slow).
+    """
+    def push(self, deferred: Any) -> None:
+        """add a deferred to the schedule"""
+        raise NotImplementedError
+
+    def pop_due(self, now: datetime.datetime) -> List[Any]:
+        """remove and return all deferreds that are due at the given game time, sorted on their due time"""
+        raise NotImplementedError
+
+    def remove_owner(self, owner: Any) -> None:
+        """remove all deferreds that belong to the given owner object"""
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __iter__(self) -> Iterator[Any]:
+        raise NotImplementedError
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        return sorted(self)[index]
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+
+class HeapScheduler(DeferredScheduler):
+    """The default scheduler: a simple heapq. Removing deferreds of an owner is O(n)."""
+    def __init__(self) -> None:
+        self._heap = []     # type: List[Any]
+
+    def push(self, deferred: Any) -> None:
+        heapq.heappush(self._heap, deferred)
+
+    def pop_due(self, now: datetime.datetime) -> List[Any]:
+        due = []
+        while self._heap and self._heap[0].due_gametime <= now:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+    def remove_owner(self, owner: Any) -> None:
+        self._heap = [d for d in self._heap if d.owner is not owner]
+        heapq.heapify(self._heap)
+
+    def clear(self) -> None:
+        self._heap = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(list(self._heap))
+
+
+class TimingWheelScheduler(DeferredScheduler):
+    """
+    Hierarchical timing wheel, bucketed on a fixed resolution of game time seconds (usually the game time
+    that passes in one server tick). Adding a deferred and removing all deferreds of an owner are O(1)
+    per deferred, and advancing the clock only touches the buckets that are passed.
+    Deferreds due in a tick that has been reached are kept in a small 'ready' bucket,
+    and are checked against their exact due time, so the firing semantics are the same as with the heapq.
+    """
+    def __init__(self, resolution: float, slots: int=64, levels: int=4) -> None:
+        if resolution <= 0:
+            raise ValueError("resolution must be > 0")
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.clear()
+
+    def clear(self) -> None:
+        self._epoch = None      # type: datetime.datetime
+        self._current = 0       # the tick number that the wheel has advanced to
+        self._wheels = [[{} for _ in range(self.slots)] for _ in range(self.levels)]  # type: List[List[Dict[int, Any]]]
+        self._ready = {}        # type: Dict[int, Any]
+        self._overflow = {}     # type: Dict[int, Any]
+        self._buckets = {}      # type: Dict[int, Dict[int, Any]]  # deferred id -> bucket it is in
+        self._owners = {}       # type: Dict[int, Dict[int, Any]]   # owner id -> deferreds (by id)
+
+    def _tick_of(self, due: datetime.datetime) -> int:
+        return int((due - self._epoch).total_seconds() // self.resolution)
+
+    def _place(self, deferred: Any) -> None:
+        tick = self._tick_of(deferred.due_gametime)
+        delta = tick - self._current
+        if delta <= 0:
+            bucket = self._ready
+        else:
+            for level in range(self.levels):
+                if delta < self.slots ** (level + 1):
+                    bucket = self._wheels[level][(tick // self.slots ** level) % self.slots]
+                    break
+            else:
+                bucket = self._overflow
+        bucket[id(deferred)] = deferred
+        self._buckets[id(deferred)] = bucket
+
+    def push(self, deferred: Any) -> None:
+        if self._epoch is None:
+            self._epoch = deferred.due_gametime
+        self._place(deferred)
+        self._owners.setdefault(id(deferred.owner), {})[id(deferred)] = deferred
+
+    def pop_due(self, now: datetime.datetime) -> List[Any]:
+        if self._epoch is None:
+            return []
+        target = self._tick_of(now)
+        if target > self._current:
+            if not self._buckets or target - self._current > self.slots ** 2:
+                # nothing scheduled, or a huge leap in time: just redistribute everything (O(n))
+                everything = list(self)
+                self._current = target
+                self._wheels = [[{} for _ in range(self.slots)] for _ in range(self.levels)]
+                self._ready = {}
+                self._overflow = {}
+                self._buckets = {}
+                for deferred in everything:
+                    self._place(deferred)
+            else:
+                while self._current < target:
+                    self._advance()
+        due = [d for d in self._ready.values() if d.due_gametime <= now]
+        for deferred in due:
+            self._discard(deferred)
+        due.sort()
+        return due
+
+    def _advance(self) -> None:
+        self._current += 1
+        current = self._current
+        if current % self.slots ** self.levels == 0:
+            self._cascade(self._overflow)
+        for level in range(self.levels - 1, 0, -1):
+            span = self.slots ** level
+            if current % span == 0:
+                self._cascade(self._wheels[level][(current // span) % self.slots])
+        self._cascade(self._wheels[0][current % self.slots])
+
+    def _cascade(self, bucket: Dict[int, Any]) -> None:
+        if bucket:
+            deferreds = list(bucket.values())
+            bucket.clear()
+            for deferred in deferreds:
+                self._place(deferred)
+
+    def _discard(self, deferred: Any) -> None:
+        del self._buckets.pop(id(deferred))[id(deferred)]
+        owned = self._owners[id(deferred.owner)]
+        del owned[id(deferred)]
+        if not owned:
+            del self._owners[id(deferred.owner)]
+
+    def remove_owner(self, owner: Any) -> None:
+        for deferred_id in self._owners.pop(id(owner), {}):
+            del self._buckets.pop(deferred_id)[deferred_id]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def __iter__(self) -> Iterator[Any]:
+        buckets = itertools.chain([self._ready, self._overflow], itertools.chain.from_iterable(self._wheels))
+        return iter([d for bucket in buckets for d in bucket.values()])
+
+
+class PeriodicGroup:
+    """
+    A group of periodic methods that share the same period (in real time seconds).
+    The methods are divided over as many buckets as there are server ticks in the period,
+    and every server tick the next bucket is called as a whole. That spreads the load evenly.
+    The objects are weakly referenced so they drop out of the group by themselves once they're gone.
+    """
+    def __init__(self, period: float, tick_time: float) -> None:
+        self.period = period
+        num_buckets = max(1, int(round(period / tick_time)))
+        self.buckets = [weakref.WeakKeyDictionary() for _ in range(num_buckets)]  # type: List[weakref.WeakKeyDictionary]
+        self.current = 0
+
+    def add(self, method: Callable) -> None:
+        """add a bound method to the group, in the bucket that currently has the fewest objects"""
+        obj = method.__self__       # type: ignore
+        for bucket in self.buckets:
+            if obj in bucket:
+                bucket[obj].add(method.__name__)
+                return
+        bucket = min(self.buckets, key=len)
+        bucket[obj] = {method.__name__}
+
+    def remove_method(self, method: Callable) -> None:
+        """remove a single bound method from the group, the object itself is removed once it has no methods left"""
+        obj = method.__self__       # type: ignore
+        for bucket in self.buckets:
+            names = bucket.get(obj)
+            if names is not None:
+                names.discard(method.__name__)
+                if not names:
+                    del bucket[obj]
+                return
+
+    def remove(self, obj: Any) -> None:
+        """remove all methods of the given object from the group"""
+        try:
+            for bucket in self.buckets:
+                bucket.pop(obj, None)
+        except TypeError:
+            pass   # object can't be weakly referenced, so it can't be in the group either
+
+    def next_bucket(self) -> List[Callable]:
+        """advance to the next bucket and return the bound methods in it"""
+        bucket = self.buckets[self.current]
+        self.current = (self.current + 1) % len(self.buckets)
+        return [getattr(obj, name) for obj, names in list(bucket.items()) for name in names]
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets)
+
+
+def create_scheduler(kind: str, resolution: float) -> DeferredScheduler:
+    """Create a scheduler backend by name: 'heap' or 'wheel' (the latter uses the given game time resolution)"""
+    if kind == "heap":
+        return HeapScheduler()
+    elif kind == "wheel":
+        return TimingWheelScheduler(resolution)
+    raise ValueError("invalid deferred scheduler type: " + str(kind))
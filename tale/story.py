@@ -64,10 +64,17 @@ class StoryConfig:
         self.startlocation_player = ""       # name of the location where a player starts the game in
         self.startlocation_wizard = ""       # name of the location where a wizard player starts the game in
         self.savegames_enabled = True        # allow savegames?
+        self.savegame_format = "serpent"     # savegame data format: "serpent" (python literal text) or "binary" (compact, faster)
+        self.savegame_max_deltas = 10        # number of incremental saves (only the changes) before a full save again (0 = always full)
         self.show_exits_in_look = True       # with the look command, also show exit descriptions automatically?
         self.license_file = ""               # game license file, if applicable
         self.mud_host = ""                   # for mud mode: hostname to bind the server on. Use "[...]" for IPV6 connectivity.
         self.mud_port = 0                    # for mud mode: port number to bind the server on
+        self.mud_event_loop = True           # for mud mode: event driven main loop (False = legacy 0.1 sec input polling loop)
+        self.mud_web_server = "threads"      # for mud mode: web server "threads" (thread per connection) or "asyncio" (single thread)
+        self.mud_session_store = "memory"    # for mud mode: web sessions storage "memory" or "sqlite" (survives server restarts)
+        self.mud_persistence_interval = 0.0  # for mud mode: seconds between checkpoints of the world state, restored at startup (0 = off)
+        self.deferred_scheduler = "heap"     # scheduler for deferreds: "heap" or "wheel" (timing wheel, for many periodic deferreds)
         self.zones = []                      # type: List[str]  # names of zone modules to load, in this order
         self.server_mode = GameMode.IF       # the actual game mode the server is operating in (will be set at startup time)
 
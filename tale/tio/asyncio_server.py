@@ -0,0 +1,508 @@
+"""
+Single threaded web server for the browser interface, built on asyncio.
+It runs the same wsgi app (and session middleware) as the wsgiref based servers,
+but every connection is handled by a coroutine instead of by a thread.
+The wsgi app itself is called in a small pool of worker threads, so that a request
+that blocks for a bit (on the session database, for instance) doesn't stall the other connections.
+The long lived event stream of a player's browser is served by a coroutine,
+so there's no longer a thread parked per connected player.
+It also provides a websocket endpoint that carries both the output to the browser and
+the commands from the player over a single connection.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import socket
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+from .. import __version__ as tale_version_str
+
+__all__ = ["AsyncWsgiServer", "AsyncEventStream", "AsyncWebSocket"]
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_CONTINUATION, WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xa
+
+
+class WebSocketError(Exception):
+    """Protocol violation by the websocket client"""
+    pass
+
+
+def websocket_accept_key(key: str) -> str:
+    """The Sec-WebSocket-Accept value for the given Sec-WebSocket-Key"""
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+
+
+def websocket_frame(opcode: int, payload: bytes=b"") -> bytes:
+    """A single (final, unmasked) websocket frame, as sent by the server"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def websocket_unmask(mask: bytes, payload: bytes) -> bytes:
+    """Applies the 4-byte client mask to the payload (xor), which also undoes it"""
+    length = len(payload)
+    if not length:
+        return payload
+    mask = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(mask, "big")).to_bytes(length, "big")
+
+
+async def read_websocket_frame(reader: asyncio.StreamReader, max_size: int) -> Tuple[bool, int, bytes]:
+    """Reads a single websocket frame from a client, returns (final, opcode, payload)"""
+    byte1, byte2 = await reader.readexactly(2)
+    length = byte2 & 0x7f
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > max_size:
+        raise WebSocketError("frame too large")
+    if not byte2 & 0x80:
+        raise WebSocketError("client frames must be masked")
+    mask = await reader.readexactly(4)
+    payload = websocket_unmask(mask, await reader.readexactly(length))
+    return bool(byte1 & 0x80), byte1 & 0x0f, payload
+
+
+class AsyncEventStream:
+    """
+    The server-sent event stream for one player connection, as a coroutine driven iterable.
+    Returned instead of a blocking generator by the eventsource handler of the wsgi app, when
+    it runs in the asyncio server. The player connection's I/O adapter wakes it up when there's new output.
+    The actual data of the stream is produced by the given EventSourceStream.
+    It is created in the thread that runs the wsgi app, the server calls attach() in the event loop before using it.
+    """
+    def __init__(self, stream: Any, loop: asyncio.AbstractEventLoop) -> None:
+        self.stream = stream
+        self.app = stream.app
+        self.conn = stream.conn
+        self.loop = loop
+        self.started = False
+        self.html_available = None   # type: asyncio.Event
+
+    def attach(self) -> None:
+        self.html_available = asyncio.Event()
+        self.html_available.set()     # send any output that is already pending, right away
+        if self.conn.io:
+            self.conn.io.html_available_callback = self._wakeup
+
+    def _wakeup(self) -> None:
+        # called from the driver's thread when new output is available for the browser
+        try:
+            self.loop.call_soon_threadsafe(self.html_available.set)
+        except RuntimeError:
+            pass    # event loop has been closed
+
+    async def next_frame(self) -> Optional[bytes]:
+        """The next chunk of data to send to the browser, or None when the stream has ended."""
+        if not self.started:
+            self.started = True
+            return self.stream.start()
+        if not self.app.driver.is_running():
+            return None
+        conn = self.conn
+        if conn.io and conn.player:
+            try:
+                await asyncio.wait_for(self.html_available.wait(), self.stream.keepalive_interval)
+            except asyncio.TimeoutError:
+                pass
+            delay = self.stream.flush_delay()
+            if delay:
+                await asyncio.sleep(delay)
+            self.html_available.clear()
+        if not conn.io or not conn.player:
+            return None
+        return self.stream.next_chunk()
+
+    def close(self) -> None:
+        io = self.conn.io
+        if io and getattr(io, "html_available_callback", None) == self._wakeup:
+            io.html_available_callback = None
+
+
+class AsyncWebSocket:
+    """
+    Websocket connection for one player connection, carrying both directions.
+    The output is sent as json text messages with the same content as the events of the event stream.
+    The commands are received as json text messages with the same parameters as the input url ("cmd", "autocomplete").
+    Returned by the websocket handler of the wsgi app, when it runs in the asyncio server.
+    The activity callback (if given) is called for every message from the browser, to keep the web session alive.
+    It is created in the thread that runs the wsgi app, and starts in the event loop when the server calls run().
+    """
+    keepalive_interval = 15.0
+    max_message_size = 1000000
+
+    def __init__(self, app: Any, conn: Any, loop: asyncio.AbstractEventLoop, activity: Callable[[], None]=None) -> None:
+        self.app = app
+        self.conn = conn
+        self.loop = loop
+        self.activity = activity
+        self.closing = False
+        self.html_available = None   # type: asyncio.Event
+
+    def _wakeup(self) -> None:
+        # called from the driver's thread when new output is available for the browser
+        try:
+            self.loop.call_soon_threadsafe(self.html_available.set)
+        except RuntimeError:
+            pass    # event loop has been closed
+
+    async def run(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.html_available = asyncio.Event()
+        self.html_available.set()     # send any output that is already pending, right away
+        if self.conn.io:
+            self.conn.io.html_available_callback = self._wakeup
+        sender = self.loop.create_task(self.send_output(writer))
+        try:
+            await self.receive_input(reader, writer)
+        finally:
+            sender.cancel()
+            try:
+                await sender
+            except asyncio.CancelledError:
+                pass
+            io = self.conn.io
+            if io and getattr(io, "html_available_callback", None) == self._wakeup:
+                io.html_available_callback = None
+
+    async def send_output(self, writer: asyncio.StreamWriter) -> None:
+        conn = self.conn
+        try:
+            while self.app.driver.is_running():
+                if conn.io and conn.player:
+                    try:
+                        await asyncio.wait_for(self.html_available.wait(), self.keepalive_interval)
+                    except asyncio.TimeoutError:
+                        writer.write(websocket_frame(WS_PING))
+                    self.html_available.clear()
+                if not conn.io or not conn.player:
+                    break
+                for response in self.app.browser_output(conn):
+                    writer.write(websocket_frame(WS_TEXT, json.dumps(response).encode("utf-8")))
+                await writer.drain()
+            self.close(writer, 1001)
+        except ConnectionError:
+            pass    # the browser went away, the receiving side notices this as well
+
+    def close(self, writer: asyncio.StreamWriter, code: int) -> None:
+        if not self.closing:
+            self.closing = True
+            writer.write(websocket_frame(WS_CLOSE, struct.pack("!H", code)))
+
+    async def receive_input(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        message = []   # type: List[bytes]
+        message_size = 0
+        while True:
+            try:
+                final, opcode, payload = await read_websocket_frame(reader, self.max_message_size)
+            except WebSocketError:
+                self.close(writer, 1002)
+                return
+            if opcode == WS_CLOSE:
+                self.close(writer, 1000)
+                return
+            elif opcode == WS_PING:
+                writer.write(websocket_frame(WS_PONG, payload))
+            elif opcode in (WS_TEXT, WS_BINARY, WS_CONTINUATION):
+                message.append(payload)
+                message_size += len(payload)
+                if message_size > self.max_message_size:
+                    self.close(writer, 1009)
+                    return
+                if final:
+                    self.process_message(b"".join(message))
+                    message = []
+                    message_size = 0
+
+    def process_message(self, message: bytes) -> None:
+        if self.activity:
+            self.activity()
+        try:
+            parameters = json.loads(message.decode("utf-8"))
+        except ValueError:
+            return
+        if isinstance(parameters, dict) and self.conn.player and self.conn.io:
+            parameters = {str(key): str(value) for key, value in parameters.items()}
+            self.app.process_input(self.conn, parameters)
+
+
+class AsyncWsgiServer:
+    """
+    Minimal HTTP/1.1 server that runs a wsgi application in an asyncio event loop.
+    Supports keep-alive connections and streams AsyncEventStream responses.
+    The wsgi application is called in a pool of app_workers threads, the connections are all handled by the event loop.
+    It is meant as a drop-in for the wsgiref server classes: serve_forever() runs it
+    (in a thread of its own, it creates its own event loop) and shutdown() stops it.
+    Set use_ssl to True to enable HTTPS mode instead of unencrypted HTTP.
+    """
+    request_queue_size = 200
+    max_header_lines = 100
+    max_content_length = 1000000
+    keepalive_timeout = 60.0
+    app_workers = 4
+    use_ssl = False
+    ssl_cert_locations = ("./certs/localhost_cert.pem", "./certs/localhost_key.pem", "")    # certfile, keyfile, certpassword
+
+    def __init__(self, host: str, port: int, app: Callable) -> None:
+        self.app = app
+        self.address_family = socket.AF_INET
+        address = (host, port)     # type: Tuple
+        if host and host[0] == '[' and host[-1] == ']':
+            self.address_family = socket.AF_INET6
+            address = (host[1:-1], port, 0, 0)
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.loop = None   # type: Optional[asyncio.AbstractEventLoop]
+        self.stopped = None   # type: Optional[asyncio.Event]
+        self.stopping = False
+        self.connections = set()   # type: set  # the tasks handling the open connections
+        self.app_executor = ThreadPoolExecutor(max_workers=self.app_workers)
+        self.ssl_context = None
+        if self.use_ssl:
+            print("\n\nUsing SSL\n\n")
+            import ssl
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(self.ssl_cert_locations[0], self.ssl_cert_locations[1] or None,
+                                             self.ssl_cert_locations[2] or None)
+
+    def serve_forever(self) -> None:
+        """Run the server's event loop until shutdown() is called."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+            self.app_executor.shutdown(wait=False)
+
+    async def serve(self) -> None:
+        self.stopped = asyncio.Event()
+        if self.stopping:
+            return
+        server = await asyncio.start_server(self.connection_made, sock=self.socket, ssl=self.ssl_context)
+        try:
+            await self.stopped.wait()
+        finally:
+            server.close()
+            for task in self.connections:
+                task.cancel()
+            await asyncio.gather(server.wait_closed(), *self.connections, return_exceptions=True)
+
+    def shutdown(self) -> None:
+        self.stopping = True
+        if self.loop:
+            try:
+                self.loop.call_soon_threadsafe(self._stop)
+            except RuntimeError:
+                pass    # event loop has been closed already
+
+    def _stop(self) -> None:
+        if self.stopped:
+            self.stopped.set()
+
+    def connection_made(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = self.loop.create_task(self.handle_connection(reader, writer))
+        self.connections.add(task)
+        task.add_done_callback(self.connections.discard)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                if request_line in (b"\r\n", b"\n"):
+                    continue    # stray newline between requests
+                request = await self.read_request(request_line, reader)
+                if request is None:
+                    self.write_simple_response(writer, "400 Bad Request", b"Error 400: Bad Request")
+                    break
+                method, target, version, headers = request
+                try:
+                    content_length = int(headers.get("CONTENT_LENGTH") or 0)
+                except ValueError:
+                    content_length = -1
+                if content_length < 0:
+                    self.write_simple_response(writer, "400 Bad Request", b"Error 400: Bad Request")
+                    break
+                if content_length > self.max_content_length:
+                    self.write_simple_response(writer, "413 Payload Too Large", b"Error 413: Payload Too Large")
+                    break
+                body = await reader.readexactly(content_length) if content_length else b""
+                connection = headers.get("HTTP_CONNECTION", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                environ = self.make_environ(method, target, version, headers, body, peer)
+                keep_alive = await self.run_app(environ, reader, writer, version, keep_alive)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        except Exception:
+            print("\n* Exception in web server connection handler:", file=sys.stderr)
+            import traceback
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+    async def read_request(self, request_line: bytes, reader: asyncio.StreamReader) \
+            -> Optional[Tuple[str, str, str, Dict[str, str]]]:
+        try:
+            method, target, version = request_line.decode("iso-8859-1").split()
+        except ValueError:
+            return None
+        if not version.startswith("HTTP/1."):
+            return None
+        headers = {}   # type: Dict[str, str]
+        for _ in range(self.max_header_lines):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return method, target, version, headers
+            name, sep, value = line.decode("iso-8859-1").partition(":")
+            if not sep:
+                return None
+            name = name.strip().upper().replace("-", "_")
+            if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                name = "HTTP_" + name
+            value = value.strip()
+            if name in headers:
+                # repeated header lines are combined, the cookies have their own separator (RFC 6265)
+                value = headers[name] + ("; " if name == "HTTP_COOKIE" else ",") + value
+            headers[name] = value
+        return None
+
+    def make_environ(self, method: str, target: str, version: str, headers: Dict[str, str],
+                     body: bytes, peer: Tuple) -> Dict[str, Any]:
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, "iso-8859-1"),
+            "QUERY_STRING": query,
+            "CONTENT_TYPE": "",
+            "CONTENT_LENGTH": "",
+            "SERVER_NAME": self.server_name,
+            "SERVER_PORT": str(self.server_port),
+            "SERVER_PROTOCOL": version,
+            "SERVER_SOFTWARE": "Tale/%s asyncio" % tale_version_str,
+            "REMOTE_ADDR": peer[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "https" if self.ssl_context else "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "tale.async_eventstream": lambda stream: AsyncEventStream(stream, self.loop)
+        }   # type: Dict[str, Any]
+        environ.update(headers)
+        if headers.get("HTTP_UPGRADE", "").lower() == "websocket" and "upgrade" in headers.get("HTTP_CONNECTION", "").lower() \
+                and headers.get("HTTP_SEC_WEBSOCKET_KEY") and headers.get("HTTP_SEC_WEBSOCKET_VERSION") == "13":
+            environ["tale.websocket"] = lambda app, conn: AsyncWebSocket(app, conn, self.loop, environ.get("tale.session_activity"))
+        return environ
+
+    async def run_app(self, environ: Dict[str, Any], reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      version: str, keep_alive: bool) -> bool:
+        """Runs the wsgi app for a single request and writes the response. Returns if the connection can be kept alive."""
+        response = []   # type: List[Any]
+
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info: Any=None) -> Callable:
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+            return lambda data: None   # legacy write() callable isn't supported
+
+        def call_app() -> Any:
+            # runs in a worker thread, the app (and its session store) may block
+            result = self.app(environ, start_response)
+            if isinstance(result, (AsyncEventStream, AsyncWebSocket)):
+                return result
+            try:
+                return b"".join(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+
+        try:
+            result = await self.loop.run_in_executor(self.app_executor, call_app)
+            if isinstance(result, AsyncEventStream):
+                return await self.stream_events(result, response, writer, version)
+            if isinstance(result, AsyncWebSocket):
+                status, headers = response
+                headers.extend([("Upgrade", "websocket"), ("Connection", "Upgrade"),
+                                ("Sec-WebSocket-Accept", websocket_accept_key(environ["HTTP_SEC_WEBSOCKET_KEY"]))])
+                self.write_head(writer, version, status, headers)
+                await result.run(reader, writer)
+                return False
+            body = result
+        except (ConnectionError, asyncio.IncompleteReadError):
+            raise    # the client went away, that's handled by the connection handler
+        except Exception:
+            print("\n* Exception in web app:", file=sys.stderr)
+            import traceback
+            traceback.print_exc()
+            response[:] = ["500 Internal server error", [("Content-Type", "text/plain")]]
+            body = b"Error 500: Internal server error"
+            keep_alive = False
+        status, headers = response
+        header_names = {name.lower() for name, _ in headers}
+        if "content-length" not in header_names and not status.startswith(("204", "304")):
+            headers.append(("Content-Length", str(len(body))))
+        headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+        self.write_head(writer, version, status, headers)
+        if environ["REQUEST_METHOD"] != "HEAD":
+            writer.write(body)
+        return keep_alive
+
+    async def stream_events(self, stream: AsyncEventStream, response: List[Any],
+                            writer: asyncio.StreamWriter, version: str) -> bool:
+        status, headers = response
+        headers.append(("Connection", "close"))
+        self.write_head(writer, version, status, headers)
+        stream.attach()
+        try:
+            while True:
+                frame = await stream.next_frame()
+                if frame is None:
+                    break
+                writer.write(frame)
+                await writer.drain()
+        finally:
+            stream.close()
+        return False
+
+    def write_head(self, writer: asyncio.StreamWriter, version: str, status: str, headers: List[Tuple[str, str]]) -> None:
+        lines = ["%s %s" % (version, status)]
+        lines.extend("%s: %s" % header for header in headers)
+        lines.append("\r\n")
+        writer.write("\r\n".join(lines).encode("iso-8859-1"))
+
+    def write_simple_response(self, writer: asyncio.StreamWriter, status: str, body: bytes) -> None:
+        self.write_head(writer, "HTTP/1.1", status, [("Content-Type", "text/plain"), ("Content-Length", str(len(body))),
+                                                     ("Connection", "close")])
+        writer.write(body)
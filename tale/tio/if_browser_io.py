@@ -4,9 +4,12 @@ Webbrowser based I/O for a single player ('if') story.
 'Tale' mud driver, mudlib and interactive fiction framework
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
+import functools
 import json
 import time
 import socket
+import zlib
+from collections import deque
 from socketserver import ThreadingMixIn
 from email.utils import formatdate, parsedate
 from hashlib import md5
@@ -23,7 +26,7 @@ from .. import __version__ as tale_version_str
 from ..driver import Driver
 from ..player import PlayerConnection
 
-__all__ = ["HttpIo", "TaleWsgiApp", "TaleWsgiAppBase", "WsgiStartResponseType"]
+__all__ = ["HttpIo", "TaleWsgiApp", "TaleWsgiAppBase", "EventSourceStream", "OutputRing", "WsgiStartResponseType"]
 
 WsgiStartResponseType = Callable[..., None]
 
@@ -53,12 +56,88 @@ def squash_parameters(parameters: Dict[str, Any]) -> Dict[str, Any]:
     return parameters
 
 
+@functools.lru_cache(maxsize=4096)
+def convert_to_html(line: str, smartquotes: bool) -> Tuple[str, bool]:
+    """
+    Convert style tags to html, and apply smartquotes if enabled.
+    Returns the html and if the text contained a <clear> tag.
+    The results are cached: the same texts (room descriptions, for instance) are sent to many players.
+    """
+    chunks = tag_split_re.split(line)
+    if len(chunks) == 1:
+        # optimization in case there are no markup tags in the text at all
+        return html_escape(iobase.apply_smartquotes(line) if smartquotes else line, False), False
+    result = []
+    close_tags_stack = []
+    clear = False
+    chunks.append("</>")   # add a reset-all-styles sentinel
+    for chunk in chunks:
+        html_tags = style_tags_html.get(chunk)
+        if html_tags:
+            chunk = html_tags[0]
+            close_tags_stack.append(html_tags[1])
+        elif chunk == "</>":
+            while close_tags_stack:
+                result.append(close_tags_stack.pop())
+            continue
+        elif chunk == "<clear>":
+            clear = True
+        elif chunk:
+            if chunk.startswith("</"):
+                chunk = "<" + chunk[2:]
+                html_tags = style_tags_html.get(chunk)
+                if html_tags:
+                    chunk = html_tags[1]
+                    if close_tags_stack:
+                        close_tags_stack.pop()
+            else:
+                # normal text (not a tag)
+                chunk = html_escape(iobase.apply_smartquotes(chunk) if smartquotes else chunk, False)
+        result.append(chunk)
+    return "".join(result), clear
+
+
+class OutputRing:
+    """
+    The most recent frames that were sent to a player's browser, numbered with a sequence number,
+    so that they can be sent again to a browser that reconnects after losing its connection.
+    The total size is capped: the oldest frames are dropped when it exceeds max_bytes
+    (the newest frame is always kept). Thread safe.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.last_seq = 0
+        self.frames = deque()   # type: deque  # (seq, frame) tuples, oldest first
+        self.lock = Lock()
+
+    def add(self, make_frame: Callable[[int], bytes]) -> bytes:
+        """Creates a frame with the next sequence number (make_frame gets it as argument), and stores it."""
+        with self.lock:
+            self.last_seq += 1
+            frame = make_frame(self.last_seq)
+            self.frames.append((self.last_seq, frame))
+            self.size += len(frame)
+            while self.size > self.max_bytes and len(self.frames) > 1:
+                self.size -= len(self.frames.popleft()[1])
+            return frame
+
+    def since(self, seq: int) -> List[bytes]:
+        """The frames after the given sequence number (as far as they're still in the ring)"""
+        with self.lock:
+            if seq >= self.last_seq:
+                return []
+            return [frame for frame_seq, frame in self.frames if frame_seq > seq]
+
+
 class HttpIo(iobase.IoAdapterBase):
     """
     I/O adapter for a http/browser based interface.
     This doubles as a wsgi app and runs as a web server using wsgiref.
     This way it is a simple call for the driver, it starts everything that is needed.
     """
+    output_ring_size = 256 * 1024    # bytes of recent event stream frames that are kept for a reconnecting browser
+
     def __init__(self, player_connection: PlayerConnection, wsgi_server: WSGIServer) -> None:
         super().__init__(player_connection)
         self.wsgi_server = wsgi_server
@@ -66,19 +145,27 @@ class HttpIo(iobase.IoAdapterBase):
         self.__html_special = []       # type: List[str]   # special out of band commands (such as 'clear')
         self.__html_to_browser_lock = Lock()
         self.__new_html_available = Event()
+        self.html_available_callback = None   # type: Optional[Callable[[], None]]  # called as well when new html is available
+        self.output_ring = OutputRing(self.output_ring_size)
 
     def destroy(self) -> None:
+        self.__signal_html_available()
+
+    def __signal_html_available(self) -> None:
         self.__new_html_available.set()
+        callback = self.html_available_callback
+        if callback:
+            callback()
 
     def append_html_to_browser(self, text: str) -> None:
         with self.__html_to_browser_lock:
             self.__html_to_browser.append(text)
-            self.__new_html_available.set()
+            self.__signal_html_available()
 
     def append_html_special(self, text: str) -> None:
         with self.__html_to_browser_lock:
             self.__html_special.append(text)
-            self.__new_html_available.set()
+            self.__signal_html_available()
 
     def get_html_to_browser(self) -> List[str]:
         with self.__html_to_browser_lock:
@@ -142,7 +229,7 @@ class HttpIo(iobase.IoAdapterBase):
                     self.__html_to_browser.append("<p>" + text + "</p>\n")
                 else:
                     self.__html_to_browser.append("<pre>" + text + "</pre>\n")
-            self.__new_html_available.set()
+            self.__signal_html_available()
         return ""    # the output is pushed to the browser via a buffer, rather than printed to a screen
 
     def output(self, *lines: str) -> None:
@@ -150,7 +237,7 @@ class HttpIo(iobase.IoAdapterBase):
         with self.__html_to_browser_lock:
             for line in lines:
                 self.output_no_newline(line)
-            self.__new_html_available.set()
+            self.__signal_html_available()
 
     def output_no_newline(self, text: str) -> None:
         super().output_no_newline(text)
@@ -158,41 +245,68 @@ class HttpIo(iobase.IoAdapterBase):
         if text == "\n":
             text = "<br>"
         self.__html_to_browser.append("<p>" + text + "</p>\n")
-        self.__new_html_available.set()
+        self.__signal_html_available()
 
     def convert_to_html(self, line: str) -> str:
         """Convert style tags to html"""
-        chunks = tag_split_re.split(line)
-        if len(chunks) == 1:
-            # optimization in case there are no markup tags in the text at all
-            return html_escape(self.smartquotes(line), False)
-        result = []
-        close_tags_stack = []
-        chunks.append("</>")   # add a reset-all-styles sentinel
-        for chunk in chunks:
-            html_tags = style_tags_html.get(chunk)
-            if html_tags:
-                chunk = html_tags[0]
-                close_tags_stack.append(html_tags[1])
-            elif chunk == "</>":
-                while close_tags_stack:
-                    result.append(close_tags_stack.pop())
-                continue
-            elif chunk == "<clear>":
-                self.append_html_special("clear")
-            elif chunk:
-                if chunk.startswith("</"):
-                    chunk = "<" + chunk[2:]
-                    html_tags = style_tags_html.get(chunk)
-                    if html_tags:
-                        chunk = html_tags[1]
-                        if close_tags_stack:
-                            close_tags_stack.pop()
-                else:
-                    # normal text (not a tag)
-                    chunk = html_escape(self.smartquotes(chunk), False)
-            result.append(chunk)
-        return "".join(result)
+        html, clear = convert_to_html(line, self.supports_smartquotes and self.do_smartquotes)
+        if clear:
+            self.append_html_special("clear")
+        return html
+
+
+class EventSourceStream:
+    """
+    Produces the data of the server-sent event stream for one eventsource request of a player's browser.
+    Output that arrives shortly after a frame was sent, is coalesced into the next frame (see the flush window
+    of the wsgi app). Events get a sequential id, so a reconnecting browser (that sends the Last-Event-ID header)
+    gets the events it missed. The stream is compressed if an encoding is given ('gzip' or 'deflate').
+    The activity callback (if given) is called for every chunk that is sent, to keep the web session alive.
+    """
+    keepalive_interval = 15.0
+
+    def __init__(self, app: 'TaleWsgiAppBase', conn: PlayerConnection,
+                 last_event_id: Optional[int]=None, encoding: Optional[str]=None,
+                 activity: Optional[Callable[[], None]]=None) -> None:
+        self.app = app
+        self.conn = conn
+        self.activity = activity
+        self.last_event_id = last_event_id
+        self.encoding = encoding
+        self.last_frame_time = 0.0
+        if encoding == "gzip":
+            self.compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.compressor = zlib.compressobj()
+        elif encoding:
+            raise ValueError("invalid encoding")
+        else:
+            self.compressor = None
+
+    def start(self) -> bytes:
+        """The start of the stream: the padding for a new stream, or the missed events for a resumed stream"""
+        if self.last_event_id is None:
+            return self.encode((":" + ' ' * 2050 + "\n\n").encode("utf-8"))   # padding for older browsers
+        return self.encode(b"".join(self.conn.io.output_ring.since(self.last_event_id)))
+
+    def flush_delay(self) -> float:
+        """How long to wait still before the next frame, to collect more output into it"""
+        return max(0.0, self.last_frame_time + self.app.eventsource_flush_window - time.monotonic())
+
+    def next_chunk(self) -> bytes:
+        """The frames with the pending output for the browser, or a keepalive if there's nothing"""
+        if self.activity:
+            self.activity()
+        frames = self.app.eventsource_frames(self.conn)
+        if frames:
+            self.last_frame_time = time.monotonic()
+            return self.encode(b"".join(frames))
+        return self.encode(b"data: keepalive\n\n")
+
+    def encode(self, data: bytes) -> bytes:
+        if self.compressor:
+            return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data
 
 
 class TaleWsgiAppBase:
@@ -200,6 +314,10 @@ class TaleWsgiAppBase:
     Generic wsgi functionality that is not tied to a particular
     single or multiplayer web server.
     """
+    eventsource_flush_window = 0.05       # seconds, output that arrives this soon after a frame is coalesced into one frame
+    eventsource_max_frame_size = 65536    # characters of html per frame, more output is split over several frames
+    eventsource_compression = True        # compress the event stream if the browser accepts gzip or deflate encoding
+
     def __init__(self, driver: Driver) -> None:
         self.driver = driver
 
@@ -238,6 +356,8 @@ class TaleWsgiAppBase:
             return self.wsgi_handle_input(environ, parameters, start_response)
         elif path == "eventsource":
             return self.wsgi_handle_eventsource(environ, parameters, start_response)
+        elif path == "websocket":
+            return self.wsgi_handle_websocket(environ, parameters, start_response)
         elif path.startswith("static/"):
             return self.wsgi_handle_static(environ, path, start_response)
         elif path == "quit":
@@ -327,33 +447,116 @@ class TaleWsgiAppBase:
         conn = session.get("player_connection")
         if not conn:
             return self.wsgi_internal_server_error_json(start_response, "not logged in")
-        start_response('200 OK', [('Content-Type', 'text/event-stream; charset=utf-8'),
-                                  ('Cache-Control', 'no-cache'),
-                                  # ('Transfer-Encoding', 'chunked'),    not allowed by wsgi
-                                  ('X-Accel-Buffering', 'no')   # nginx
-                                  ])
-        yield (":" + ' ' * 2050 + "\n\n").encode("utf-8")   # padding for older browsers
+        try:
+            last_event_id = int(environ["HTTP_LAST_EVENT_ID"])    # type: Optional[int]
+        except (KeyError, ValueError):
+            last_event_id = None
+        encoding = self.eventsource_encoding(environ)
+        headers = [('Content-Type', 'text/event-stream; charset=utf-8'),
+                   ('Cache-Control', 'no-cache'),
+                   # ('Transfer-Encoding', 'chunked'),    not allowed by wsgi
+                   ('X-Accel-Buffering', 'no')   # nginx
+                   ]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        start_response('200 OK', headers)
+        stream = EventSourceStream(self, conn, last_event_id, encoding, environ.get("tale.session_activity"))
+        async_eventstream = environ.get("tale.async_eventstream")
+        if async_eventstream:
+            # running in the asyncio server, it drives the stream with a coroutine
+            return async_eventstream(stream)
+        return self.eventsource_stream(stream)
+
+    def eventsource_encoding(self, environ: Dict[str, Any]) -> Optional[str]:
+        """The content encoding to compress the event stream with, if the browser accepts one"""
+        if not self.eventsource_compression:
+            return None
+        accepted = set()
+        for part in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+            coding, _, params = part.partition(";")
+            params = params.replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    if float(params[2:]) <= 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(coding.strip().lower())
+        for encoding in ("gzip", "deflate"):
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def eventsource_stream(self, stream: EventSourceStream) -> Iterable[bytes]:
+        """The event stream to the browser, waiting (blocking the thread) for new output"""
+        conn = stream.conn
+        yield stream.start()
         while self.driver.is_running():
             if conn.io and conn.player:
-                conn.io.wait_html_available(timeout=15)   # keepalives every 15 sec
+                conn.io.wait_html_available(timeout=stream.keepalive_interval)
+                delay = stream.flush_delay()
+                if delay:
+                    time.sleep(delay)
             if not conn.io or not conn.player:
                 break
-            html = conn.io.get_html_to_browser()
-            special = conn.io.get_html_special()
-            if html or special:
-                if conn.io.dont_echo_next_cmd:
-                    special.append("noecho")
-                response = {
-                    "text": "\n".join(html),
-                    "special": special,
-                    "turns": conn.player.turns,
-                    "location": conn.player.location.title if conn.player.location else "???"
-                }
-                result = "event: text\nid: {event_id}\ndata: {data}\n\n"\
-                    .format(event_id=str(time.time()), data=json.dumps(response))
-                yield result.encode("utf-8")
-            else:
-                yield "data: keepalive\n\n".encode("utf-8")
+            yield stream.next_chunk()
+
+    def eventsource_frames(self, conn: PlayerConnection) -> List[bytes]:
+        """
+        The events with the pending output for the browser. They're numbered and stored in the output ring
+        of the player's I/O adapter, to be sent again as they are to a reconnecting browser.
+        """
+        frames = []
+        for response in self.browser_output(conn, self.eventsource_max_frame_size):
+            data = json.dumps(response)
+            frame = conn.io.output_ring.add(lambda event_id: ("event: text\nid: %d\ndata: %s\n\n" % (event_id, data)).encode("utf-8"))
+            frames.append(frame)
+        return frames
+
+    def browser_output(self, conn: PlayerConnection, max_size: int=0) -> List[Dict[str, Any]]:
+        """
+        Takes the pending output for the browser (to be sent as json), returns an empty list if there's nothing.
+        If max_size is given, the html is split over multiple responses of about that size.
+        """
+        html = conn.io.get_html_to_browser()
+        special = conn.io.get_html_special()
+        if not html and not special:
+            return []
+        if conn.io.dont_echo_next_cmd:
+            special.append("noecho")
+        location = conn.player.location.title if conn.player.location else "???"
+        parts = [[]]   # type: List[List[str]]
+        size = 0
+        for line in html:
+            if max_size and parts[-1] and size + len(line) > max_size:
+                parts.append([])
+                size = 0
+            parts[-1].append(line)
+            size += len(line) + 1
+        responses = []
+        for part in parts:
+            responses.append({
+                "text": "\n".join(part),
+                "special": special,
+                "turns": conn.player.turns,
+                "location": location
+            })
+            special = []    # the special commands are only needed once, before the text
+        return responses
+
+    def wsgi_handle_websocket(self, environ: Dict[str, Any], parameters: Dict[str, str],
+                              start_response: WsgiStartResponseType) -> Iterable[bytes]:
+        session = environ["wsgi.session"]
+        conn = session.get("player_connection")
+        if not conn:
+            return self.wsgi_internal_server_error_json(start_response, "not logged in")
+        websocket = environ.get("tale.websocket")
+        if not websocket:
+            # not a websocket request, or the web server doesn't support it. The browser falls back to the eventsource.
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [b'Error 400: websocket not supported']
+        start_response('101 Switching Protocols', [])
+        return websocket(self, conn)
 
     def wsgi_handle_tabcomplete(self, environ: Dict[str, Any], parameters: Dict[str, str],
                                 start_response: WsgiStartResponseType) -> Iterable[bytes]:
@@ -373,6 +576,12 @@ class TaleWsgiAppBase:
         conn = session.get("player_connection")
         if not conn:
             return self.wsgi_internal_server_error_json(start_response, "not logged in")
+        self.process_input(conn, parameters)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return []
+
+    def process_input(self, conn: PlayerConnection, parameters: Dict[str, Any]) -> None:
+        """Handle a line of input from the player's browser (or a tab completion request, if 'autocomplete' is given)"""
         cmd = parameters.get("cmd", "")
         if cmd and "autocomplete" in parameters:
             suggestions = conn.io.tab_complete(cmd, self.driver)
@@ -389,8 +598,6 @@ class TaleWsgiAppBase:
                 else:
                     conn.io.append_html_to_browser("<span class='txt-userinput'>%s</span>" % cmd)
             conn.player.store_input_line(cmd)
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return []
 
     def wsgi_handle_license(self, environ: Dict[str, Any], parameters: Dict[str, str],
                             start_response: WsgiStartResponseType) -> Iterable[bytes]:
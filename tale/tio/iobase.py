@@ -4,6 +4,7 @@ Basic Input/Output stuff not tied to a specific I/O implementation.
 'Tale' mud driver, mudlib and interactive fiction framework
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
+import re
 import sys
 from typing import Union, Sequence, Any, Tuple, Optional, List
 import smartypants
@@ -15,6 +16,22 @@ smartypants.process_escapes = lambda txt: txt  # disable the html escape process
 smartypants.tags_to_skip = ["abcdefghijklmnopqrstuvwxyz@"]   # setting it to empty list doesn't have the required effect
 
 ALL_STYLE_TAGS = {"dim", "normal", "bright", "ul", "it", "rev", "clear", "location", "monospaced", "/monospaced", "/"}
+smartquotes_needed = re.compile(r"[\"'`-]|\. ?\. ?\.").search   # finds the characters that smartypants would replace
+
+
+def apply_smartquotes(text: str) -> str:
+    """Replaces quotes and dashes in the text by nicer looking symbols (using smartypants)"""
+    if not smartquotes_needed(text):
+        return text     # optimization, smartypants is slow and most text contains no quotes or dashes at all
+    if hasattr(smartypants.Attr, "u"):
+        return smartypants.smartypants(text, smartypants.Attr.q | smartypants.Attr.B |
+                                       smartypants.Attr.D | smartypants.Attr.e | smartypants.Attr.u)
+    else:
+        # older smartypants lack attribute 'u' for avoiding html entity creation
+        txt = smartypants.smartypants(text, smartypants.Attr.q | smartypants.Attr.B |
+                                      smartypants.Attr.D | smartypants.Attr.e)
+        import html.parser
+        return html.parser.unescape(txt)    # type: ignore
 
 
 def strip_text_styles(text: Union[str, Sequence[str]]) -> Union[str, Sequence[str]]:
@@ -80,15 +97,7 @@ class IoAdapterBase:
     def smartquotes(self, text: str) -> str:
         """If enabled, apply 'smart quotes' to the text; replaces quotes and dashes by nicer looking symbols"""
         if self.supports_smartquotes and self.do_smartquotes:
-            if hasattr(smartypants.Attr, "u"):
-                return smartypants.smartypants(text, smartypants.Attr.q | smartypants.Attr.B |
-                                               smartypants.Attr.D | smartypants.Attr.e | smartypants.Attr.u)
-            else:
-                # older smartypants lack attribute 'u' for avoiding html entity creation
-                txt = smartypants.smartypants(text, smartypants.Attr.q | smartypants.Attr.B |
-                                              smartypants.Attr.D | smartypants.Attr.e)
-                import html.parser
-                return html.parser.unescape(txt)    # type: ignore
+            return apply_smartquotes(text)
         return text
 
     def output(self, *lines: str) -> None:
@@ -5,19 +5,17 @@ Webbrowser based I/O for a multi player ('mud') server.
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
-import hashlib
 import http.cookies
-import random
-import sys
-import time
 import socket
 from html import escape as html_escape
 from socketserver import ThreadingMixIn
-from typing import Dict, Iterable, Any, List, Tuple
+from typing import Dict, Iterable, Any, List, Tuple, Union
 from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 
 from .. import vfs
+from .asyncio_server import AsyncWsgiServer
 from .if_browser_io import HttpIo, TaleWsgiAppBase, WsgiStartResponseType
+from .sessions import SessionStore, MemorySessionStore
 from .. import __version__ as tale_version_str
 from ..driver import Driver
 from ..player import PlayerConnection
@@ -25,34 +23,6 @@ from ..player import PlayerConnection
 __all__ = ["MudHttpIo", "TaleMudWsgiApp"]
 
 
-class MemorySessionFactory:
-    def __init__(self):
-        self.storage = {}
-
-    def generate_id(self) -> str:
-        string = "%d%d%f" % (random.randint(0, sys.maxsize), id(self), time.time())
-        return hashlib.sha1(string.encode("ascii")).hexdigest()
-
-    def load(self, sid: str) -> Any:
-        sid = sid or self.generate_id()
-        if sid not in self.storage:
-            session = {
-                "id": sid,
-                "created": time.time()
-            }
-            self.storage[sid] = session
-        return self.storage[sid]
-
-    def save(self, session: Any) -> str:
-        session["id"] = sid = session["id"] or self.generate_id()
-        self.storage[sid] = session
-        return sid
-
-    def delete(self, sid: str) -> None:
-        if sid in self.storage:
-            del self.storage[sid]
-
-
 class MudHttpIo(HttpIo):
     """
     I/O adapter for a http/browser based interface.
@@ -77,15 +47,26 @@ class TaleMudWsgiApp(TaleWsgiAppBase):
     """
     def __init__(self, driver: Driver, use_ssl: bool, ssl_certs: Tuple[str, str, str]) -> None:
         super().__init__(driver)
-        CustomWsgiServer.use_ssl = use_ssl
+        CustomWsgiServer.use_ssl = AsyncWsgiServer.use_ssl = use_ssl
         if use_ssl and ssl_certs:
-            CustomWsgiServer.ssl_cert_locations = ssl_certs
+            CustomWsgiServer.ssl_cert_locations = AsyncWsgiServer.ssl_cert_locations = ssl_certs
 
     @classmethod
-    def create_app_server(cls, driver: Driver, *,
-                          use_ssl: bool=False, ssl_certs: Tuple[str, str, str]=None) -> WSGIServer:
-        wsgi_app = SessionMiddleware(cls(driver, use_ssl, ssl_certs), MemorySessionFactory())    # type: ignore
-        wsgi_server = make_server(driver.story.config.mud_host, driver.story.config.mud_port, app=wsgi_app,
+    def create_app_server(cls, driver: Driver, *, use_ssl: bool=False, ssl_certs: Tuple[str, str, str]=None,
+                          sessions: SessionStore=None) -> Union[WSGIServer, AsyncWsgiServer]:
+        """
+        Create the web server for the game. Depending on the mud_web_server config setting, this is
+        a wsgiref server with a thread per connection, or a single threaded asyncio server.
+        Either way, it is started with serve_forever() (usually in a background thread).
+        The web sessions are kept in the given session store (default: in memory).
+        """
+        wsgi_app = SessionMiddleware(cls(driver, use_ssl, ssl_certs), sessions or MemorySessionStore())    # type: ignore
+        config = driver.story.config
+        if config.mud_web_server == "asyncio":
+            return AsyncWsgiServer(config.mud_host, config.mud_port, wsgi_app)
+        elif config.mud_web_server != "threads":
+            raise ValueError("invalid mud_web_server config setting: " + str(config.mud_web_server))
+        wsgi_server = make_server(config.mud_host, config.mud_port, app=wsgi_app,
                                   handler_class=CustomRequestHandler, server_class=CustomWsgiServer)
         return wsgi_server
 
@@ -108,6 +89,16 @@ class TaleMudWsgiApp(TaleWsgiAppBase):
             raise SessionMiddleware.CloseSession("{\"error\": \"no longer a valid connection\"}", "application/json")
         return super().wsgi_handle_eventsource(environ, parameters, start_response)
 
+    def wsgi_handle_websocket(self, environ: Dict[str, Any], parameters: Dict[str, str],
+                              start_response: WsgiStartResponseType) -> Iterable[bytes]:
+        session = environ["wsgi.session"]
+        conn = session.get("player_connection")
+        if not conn:
+            return self.wsgi_internal_server_error_json(start_response, "not logged in")
+        if not conn.player or not conn.io:
+            raise SessionMiddleware.CloseSession("{\"error\": \"no longer a valid connection\"}", "application/json")
+        return super().wsgi_handle_websocket(environ, parameters, start_response)
+
     def wsgi_handle_quit(self, environ: Dict[str, Any], parameters: Dict[str, str],
                          start_response: WsgiStartResponseType) -> Iterable[bytes]:
         # Quit/logged out page. For multi player, get rid of the player connection.
@@ -189,9 +180,9 @@ class SessionMiddleware:
             super().__init__(message)
             self.content_type = content_type
 
-    def __init__(self, app: TaleWsgiAppBase, factory: MemorySessionFactory) -> None:
+    def __init__(self, app: TaleWsgiAppBase, store: SessionStore) -> None:
         self.app = app
-        self.factory = factory
+        self.store = store
 
     def __call__(self, environ: Dict[str, Any], start_response: WsgiStartResponseType) -> Iterable[bytes]:
         path = environ.get('PATH_INFO', '')
@@ -201,11 +192,12 @@ class SessionMiddleware:
 
         cookies = Cookies.from_env(environ)
         sid = ""
-        session_is_new = True
         if self.session_cookie_name in cookies:
             sid = cookies[self.session_cookie_name].value
-            session_is_new = False
-        environ["wsgi.session"] = self.factory.load(sid)
+        session = environ["wsgi.session"] = self.store.load(sid, environ.get("REMOTE_ADDR", ""))
+        session_is_new = session["id"] != sid     # also when the browser's session is unknown or has expired
+        # the event stream and the websocket are long lived requests, they report their activity to keep the session alive
+        environ["tale.session_activity"] = lambda: self.store.touch(session["id"])
 
         # If the server runs behind a reverse proxy, you can configure the proxy
         # to pass along the uri that it exposes (our internal uri can be different)
@@ -215,7 +207,7 @@ class SessionMiddleware:
         cookie_path = "/" + forwarded_uri.split("/", 2)[1]
 
         def wrapped_start_response(status: str, response_headers: List[Tuple[str, str]], exc_info: Any=None) -> Any:
-            sid = self.factory.save(environ["wsgi.session"])
+            sid = self.store.save(session)
             if session_is_new:
                 # add the new session cookie to response
                 cookies = Cookies()     # type: ignore
@@ -226,7 +218,7 @@ class SessionMiddleware:
         try:
             return self.app(environ, wrapped_start_response)
         except SessionMiddleware.CloseSession as x:
-            self.factory.delete(sid)
+            self.store.delete(session["id"])
             # clear the browser cookie
             cookies = Cookies()     # type: ignore
             cookies.delete_cookie(self.session_cookie_name, cookie_path)
@@ -0,0 +1,290 @@
+"""
+Session storage for the web browser interface in multi player ('mud') mode.
+Used by the SessionMiddleware to keep the sessions of the connected browsers.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import binascii
+import collections
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict
+
+__all__ = ["SessionStore", "MemorySessionStore", "SqliteSessionStore"]
+
+
+class SessionStore:
+    """
+    Base class (interface) for the storage of web sessions. A session is a dict with at least an "id" key.
+    New sessions are only stored when they are saved, so requests that never come back
+    (from bots and scanners for instance) don't fill up the storage.
+    Sessions expire when they haven't been used for ttl seconds (see expire()), the least recently used
+    sessions are removed when there are more than max_sessions, and the oldest sessions of a single
+    remote address are removed when it has more than max_per_address sessions (0 means no limit).
+    Sessions that are in use by a connected player are never removed this way.
+    """
+    expire_interval = 60.0
+
+    def __init__(self, ttl: float=24 * 60 * 60, max_sessions: int=100000, max_per_address: int=100) -> None:
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_per_address = max_per_address
+        self.last_expire = time.time()
+
+    @staticmethod
+    def in_use(session: Dict[str, Any]) -> bool:
+        """Does the session belong to a player that is still connected?"""
+        conn = session.get("player_connection")
+        return conn is not None and getattr(conn, "io", None) is not None
+
+    def generate_id(self) -> str:
+        return binascii.hexlify(os.urandom(20)).decode("ascii")
+
+    def new_session(self, address: str) -> Dict[str, Any]:
+        return {
+            "id": self.generate_id(),
+            "created": time.time(),
+            "address": address
+        }
+
+    def load(self, sid: str, address: str="") -> Dict[str, Any]:
+        """
+        Returns the session with the given id, or a new session (with a new id) if it's unknown or expired.
+        The address is the remote address of the browser.
+        """
+        raise NotImplementedError("implement this in subclass")
+
+    def save(self, session: Dict[str, Any]) -> str:
+        """Stores the session, returns its id"""
+        raise NotImplementedError("implement this in subclass")
+
+    def touch(self, sid: str) -> None:
+        """Marks the session as used, for activity that isn't a http request (event stream or websocket)"""
+        raise NotImplementedError("implement this in subclass")
+
+    def delete(self, sid: str) -> None:
+        raise NotImplementedError("implement this in subclass")
+
+    def expire_due(self, now: float=None) -> bool:
+        """Is it time to call expire() again?"""
+        return (now or time.time()) >= self.last_expire + self.expire_interval
+
+    def expire(self, now: float=None) -> int:
+        """
+        Removes the sessions that have been idle for too long, returns the number of removed sessions.
+        The sessions of players that are still connected are kept (and count as used).
+        """
+        raise NotImplementedError("implement this in subclass")
+
+    def __len__(self) -> int:
+        raise NotImplementedError("implement this in subclass")
+
+
+class MemorySessionStore(SessionStore):
+    """Keeps the sessions in memory, in least recently used order. Thread safe."""
+    def __init__(self, ttl: float=24 * 60 * 60, max_sessions: int=100000, max_per_address: int=100) -> None:
+        super().__init__(ttl, max_sessions, max_per_address)
+        self.storage = collections.OrderedDict()    # type: collections.OrderedDict  # sid -> session, least recently used first
+        self.last_access = {}   # type: Dict[str, float]
+        self.addresses = {}   # type: Dict[str, set]  # remote address -> sids
+        self.lock = threading.Lock()
+
+    def load(self, sid: str, address: str="") -> Dict[str, Any]:
+        with self.lock:
+            session = self.storage.get(sid) if sid else None
+            if session is not None:
+                if self.last_access[sid] + self.ttl >= time.time():
+                    self.storage.move_to_end(sid)
+                    self.last_access[sid] = time.time()
+                    return session
+                self._remove(sid)
+        return self.new_session(address)
+
+    def save(self, session: Dict[str, Any]) -> str:
+        sid = session["id"]
+        with self.lock:
+            if sid not in self.storage:
+                address = session.get("address", "")
+                sids = self.addresses.setdefault(address, set())
+                if self.max_per_address and len(sids) >= self.max_per_address:
+                    unused = [other for other in sids if not self.in_use(self.storage[other])]
+                    if unused:
+                        self._remove(min(unused, key=self.last_access.__getitem__))
+                if len(self.storage) >= self.max_sessions:
+                    unused = (other for other, stored in self.storage.items() if not self.in_use(stored))
+                    for other in list(itertools.islice(unused, len(self.storage) - self.max_sessions + 1)):
+                        self._remove(other)
+                sids.add(sid)
+            self.storage[sid] = session
+            self.storage.move_to_end(sid)
+            self.last_access[sid] = time.time()
+        return sid
+
+    def touch(self, sid: str) -> None:
+        with self.lock:
+            if sid in self.storage:
+                self.storage.move_to_end(sid)
+                self.last_access[sid] = time.time()
+
+    def delete(self, sid: str) -> None:
+        with self.lock:
+            if sid in self.storage:
+                self._remove(sid)
+
+    def expire(self, now: float=None) -> int:
+        now = now or time.time()
+        cutoff = now - self.ttl
+        count = 0
+        with self.lock:
+            self.last_expire = time.time()
+            while self.storage:
+                sid = next(iter(self.storage))
+                if self.last_access[sid] >= cutoff:
+                    break
+                if self.in_use(self.storage[sid]):
+                    self.storage.move_to_end(sid)
+                    self.last_access[sid] = now
+                else:
+                    self._remove(sid)
+                    count += 1
+        return count
+
+    def _remove(self, sid: str) -> None:
+        session = self.storage.pop(sid)
+        del self.last_access[sid]
+        address = session.get("address", "")
+        sids = self.addresses[address]
+        sids.discard(sid)
+        if not sids:
+            del self.addresses[address]
+
+    def __len__(self) -> int:
+        return len(self.storage)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Keeps the sessions in a sqlite database, so they survive a restart of the server and can be shared.
+    Only session values that can be stored as json are persisted, other values (such as the player's connection)
+    are only kept in memory, by this process. Thread safe.
+    Loading a session doesn't write to the database: the access times are kept in memory,
+    and written all at once by expire(). Saving a session that didn't change doesn't write either.
+    """
+    def __init__(self, databasefile: str, ttl: float=24 * 60 * 60, max_sessions: int=100000, max_per_address: int=100) -> None:
+        super().__init__(ttl, max_sessions, max_per_address)
+        self.sqlite_dbpath = databasefile
+        urimode = databasefile.startswith("file:")
+        self.conn = sqlite3.connect(databasefile, timeout=5, uri=urimode, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.live_values = {}   # type: Dict[str, Dict[str, Any]]  # sid -> session values that can't be stored in the database
+        self.accessed = {}   # type: Dict[str, float]  # sid -> last access time that hasn't been written to the database yet
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS Session(
+                    id varchar PRIMARY KEY,
+                    address varchar NOT NULL,
+                    last_access real NOT NULL,
+                    data varchar NOT NULL
+                );""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_session_last_access ON Session(last_access)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_session_address ON Session(address)")
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    def load(self, sid: str, address: str="") -> Dict[str, Any]:
+        if sid:
+            now = time.time()
+            with self.lock:
+                row = self.conn.execute("SELECT data, last_access FROM Session WHERE id=?", (sid,)).fetchone()
+                if row and max(row[1], self.accessed.get(sid, 0.0)) >= now - self.ttl:
+                    self.accessed[sid] = now
+                    session = json.loads(row[0])
+                    session.update(self.live_values.get(sid, {}))
+                    return session
+        return self.new_session(address)
+
+    def save(self, session: Dict[str, Any]) -> str:
+        sid = session["id"]
+        address = session.get("address", "")
+        data = {}
+        live = {}
+        for key, value in session.items():
+            if isinstance(value, (str, int, float, bool, type(None))):
+                data[key] = value
+            else:
+                live[key] = value
+        data_json = json.dumps(data)
+        with self.lock, self.conn:
+            if live:
+                self.live_values[sid] = live
+            else:
+                self.live_values.pop(sid, None)
+            row = self.conn.execute("SELECT address, data FROM Session WHERE id=?", (sid,)).fetchone()
+            if row == (address, data_json):
+                self.accessed[sid] = time.time()
+                return sid    # unchanged, no need to write it
+            if not row:
+                self._write_accessed()    # so that the least recently used sessions are found
+                if self.max_per_address:
+                    self._delete_oldest("WHERE address=?", (address,), self.max_per_address)
+                self._delete_oldest("", (), self.max_sessions)
+            self.conn.execute("INSERT OR REPLACE INTO Session(id, address, last_access, data) VALUES (?,?,?,?)",
+                              (sid, address, time.time(), data_json))
+            self.accessed.pop(sid, None)
+        return sid
+
+    def _delete_oldest(self, where: str, params: tuple, limit: int) -> None:
+        # make room for one more session: delete the least recently used sessions above the limit.
+        # sessions of players that are still connected are skipped.
+        count = self.conn.execute("SELECT COUNT(*) FROM Session " + where, params).fetchone()[0]
+        if count >= limit:
+            excess = count - limit + 1
+            for row in self.conn.execute("SELECT id FROM Session " + where + " ORDER BY last_access", params).fetchall():
+                if not self.in_use(self.live_values.get(row[0], {})):
+                    self.conn.execute("DELETE FROM Session WHERE id=?", (row[0],))
+                    self.live_values.pop(row[0], None)
+                    excess -= 1
+                    if not excess:
+                        break
+
+    def _write_accessed(self) -> None:
+        if self.accessed:
+            self.conn.executemany("UPDATE Session SET last_access=? WHERE id=? AND last_access<?",
+                                  [(when, sid, when) for sid, when in self.accessed.items()])
+            self.accessed.clear()
+
+    def touch(self, sid: str) -> None:
+        with self.lock:
+            self.accessed[sid] = time.time()
+
+    def delete(self, sid: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM Session WHERE id=?", (sid,))
+            self.live_values.pop(sid, None)
+            self.accessed.pop(sid, None)
+
+    def expire(self, now: float=None) -> int:
+        now = now or time.time()
+        cutoff = now - self.ttl
+        with self.lock, self.conn:
+            self.last_expire = time.time()
+            for sid, values in self.live_values.items():
+                if self.in_use(values):
+                    self.accessed[sid] = now
+            self._write_accessed()
+            if self.live_values:
+                for row in self.conn.execute("SELECT id FROM Session WHERE last_access<?", (cutoff,)).fetchall():
+                    self.live_values.pop(row[0], None)
+            return self.conn.execute("DELETE FROM Session WHERE last_access<?", (cutoff,)).rowcount
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM Session").fetchone()[0]
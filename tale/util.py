@@ -507,20 +507,27 @@ def excepthook(ex_type, ex_value, ex_tb):
     sys.stderr.write(traceback)
 
 
-def call_periodically(period: float, max_period: float=None):
+def call_periodically(period: float, max_period: float=None, *, grouped: bool=False):
     """
     Decorator to mark a method of a MudObject class to be invoked periodically by the driver.
     You can set a fixed period (in real-time seconds) or a period interval in which a random
     next occurrence is then chosen for every call.
     Setting the period to 0 or None will stop the periodical calls.
     The method is called with a 'ctx' keyword argument set to a Context object.
+    If grouped is True, the method is not scheduled as a separate deferred, but added to the driver's
+    periodic group for that period instead. That is much more efficient for large numbers of objects,
+    but requires a fixed period, and the calls are not stored in savegames.
     """
+    if grouped and max_period and max_period != period:
+        raise ValueError("grouped periodicals must have a fixed period")
+
     def mark(func):
         if not period:
             func._tale_periodically = None
         else:
             initial = random.uniform(0.1, period)  # scatter initial calls
             func._tale_periodically = (initial, period, max_period or period)
+        func._tale_periodic_grouped = grouped
         return func
 
     return mark
@@ -200,16 +200,18 @@ class VirtualFileSystem:
     def __setitem__(self, name: str, data: Union[Resource, str, bytes]) -> None:
         """
         Stores the data on the given resource name.
-        Overwrites an existing resource if any.
+        Overwrites an existing resource if any. This is atomic: the data is written to a temporary file first,
+        which then replaces the resource, so it never ends up half written (if the game crashes for instance).
         You can provide a resource object to save, or the data directly (str or bytes).
         """
         if self.readonly:
             raise VfsError("attempt to write a read-only vfs")
-        self.validate_path(name)
+        phys_path = self.validate_path(name)
         if isinstance(data, Resource):
             data = data.data
-        with self.open_write(name) as f:
+        with self.open_write(name + ".tmp", mimetypes.guess_type(name)[0] or "") as f:
             f.write(data)
+        os.replace(phys_path + ".tmp", phys_path)
 
     def __delitem__(self, name: str) -> None:
         """Deletes the given resource"""
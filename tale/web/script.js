@@ -17,6 +17,47 @@ function setup()
     document.smoothscrolling_busy = false;
     window.onbeforeunload = function(e) { return "Are you sure you want to abort the session and close the window?"; }
 
+    // prefer a websocket that carries both the output and the input, fall back to the eventsource otherwise
+    connect_websocket();
+}
+
+function connect_websocket()
+{
+    if(!window.WebSocket) {
+        connect_eventsource();
+        return;
+    }
+    var url = (window.location.protocol == "https:" ? "wss://" : "ws://") + window.location.host +
+        window.location.pathname.replace(/[^\/]*$/, "") + "websocket";
+    var opened = false;
+    var socket = new WebSocket(url);
+    socket.onopen = function(e) {
+        console.log("WS connected");
+        opened = true;
+        document.websocket = socket;
+    };
+    socket.onmessage = function(e) {
+        process_text(JSON.parse(e.data));
+    };
+    socket.onclose = function(e) {
+        document.websocket = null;
+        if(!opened) {
+            // the server doesn't support websockets, use server-side events instead
+            console.log("WS not available, using eventsource");
+            connect_eventsource();
+            return;
+        }
+        console.error("WS closed:", e.code, e.reason);
+        var txtdiv = document.getElementById("textframe");
+        txtdiv.innerHTML += "<p class='server-error'>Connection closed.<br><br>Refresh the page to restore it. If that doesn't work, quit or close your browser and try with a new window.</p>";
+        txtdiv.scrollTop = txtdiv.scrollHeight;
+        var cmd_input = document.getElementById("input-cmd");
+        cmd_input.disabled=true;
+    };
+}
+
+function connect_eventsource()
+{
     // use eventsource (server-side events) to update the text, rather than manual ajax polling
     var esource = new EventSource("eventsource");
     esource.addEventListener("text", function(e) {
@@ -93,11 +134,15 @@ function smoothscroll(div, previousTop)
 function submit_cmd()
 {
     var cmd_input = document.getElementById("input-cmd");
-    var ajax = new XMLHttpRequest();
-    ajax.open("POST", "input", true);
-    ajax.setRequestHeader("Content-type","application/x-www-form-urlencoded; charset=UTF-8");
-    var encoded_cmd = encodeURIComponent(cmd_input.value);
-    ajax.send("cmd=" + encoded_cmd);
+    if(document.websocket) {
+        document.websocket.send(JSON.stringify({cmd: cmd_input.value}));
+    } else {
+        var ajax = new XMLHttpRequest();
+        ajax.open("POST", "input", true);
+        ajax.setRequestHeader("Content-type","application/x-www-form-urlencoded; charset=UTF-8");
+        var encoded_cmd = encodeURIComponent(cmd_input.value);
+        ajax.send("cmd=" + encoded_cmd);
+    }
     cmd_input.value="";
     cmd_input.focus();
     cmd_input.type = "text";
@@ -108,7 +153,9 @@ function submit_cmd()
 function autocomplete_cmd()
 {
     var cmd_input = document.getElementById("input-cmd");
-    if(cmd_input.value) {
+    if(cmd_input.value && document.websocket) {
+        document.websocket.send(JSON.stringify({cmd: cmd_input.value, autocomplete: 1}));
+    } else if(cmd_input.value) {
         var ajax = new XMLHttpRequest();
         ajax.open("POST", "input", true);
         ajax.setRequestHeader("Content-type","application/x-www-form-urlencoded");
@@ -0,0 +1,537 @@
+"""
+Unittests for the web browser I/O and web servers
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import base64
+import http.client
+import io
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import wsgiref.handlers
+import wsgiref.util
+import zlib
+
+from tale.base import Location
+from tale.player import Player, PlayerConnection
+from tale.tio.asyncio_server import AsyncWsgiServer, websocket_accept_key, websocket_frame, websocket_unmask
+from tale.tio.if_browser_io import HttpIo, TaleWsgiAppBase, EventSourceStream, OutputRing, convert_to_html
+from tale.tio.mud_browser_io import SessionMiddleware
+from tale.tio.sessions import MemorySessionStore, SqliteSessionStore
+
+
+class DummyDriver:
+    def __init__(self):
+        self.running = True
+
+    def is_running(self):
+        return self.running
+
+
+class EventApp(TaleWsgiAppBase):
+    """minimal wsgi app with a single player connection, that also answers a few test urls"""
+    def __init__(self, conn):
+        super().__init__(DummyDriver())
+        self.conn = conn
+        self.unblock = threading.Event()
+
+    def __call__(self, environ, start_response):
+        environ["wsgi.session"] = {"player_connection": self.conn}
+        if environ["PATH_INFO"] == "/echo":
+            body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"] or 0))
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [environ["REQUEST_METHOD"].encode(), b" ", environ["QUERY_STRING"].encode(), b" ", body]
+        if environ["PATH_INFO"] == "/crash":
+            raise ValueError("crash")
+        if environ["PATH_INFO"] == "/cookie":
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [environ.get("HTTP_COOKIE", "").encode()]
+        if environ["PATH_INFO"] == "/block":
+            self.unblock.wait(10)
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [b"unblocked"]
+        return super().__call__(environ, start_response)
+
+
+class TestHtmlConversion(unittest.TestCase):
+    def test_convert(self):
+        io = HttpIo(None, None)
+        self.assertEqual("plain &lt;text&gt;", io.convert_to_html("plain <text>"))
+        self.assertEqual("a \u201cquote\u201d &amp; <span class='txt-bright'>bright\u2026</span>",
+                         io.convert_to_html("a \"quote\" & <bright>bright..."))
+        io.do_smartquotes = False
+        self.assertEqual("a \"quote\"", io.convert_to_html("a \"quote\""))
+        self.assertEqual([], io.get_html_special())
+        io.convert_to_html("<clear>cleared")
+        self.assertEqual(["clear"], io.get_html_special())
+        io.convert_to_html("<clear>cleared")
+        self.assertEqual(["clear"], io.get_html_special(), "cached result must still clear the screen")
+
+    def test_cached(self):
+        convert_to_html.cache_clear()
+        io1 = HttpIo(None, None)
+        io2 = HttpIo(None, None)
+        io1.convert_to_html("<location>The Attic</location>: it's dusty")
+        io2.convert_to_html("<location>The Attic</location>: it's dusty")
+        self.assertEqual(1, convert_to_html.cache_info().hits)
+        io2.do_smartquotes = False
+        self.assertEqual("<span class='txt-location'>The Attic</span>: it's dusty",
+                         io2.convert_to_html("<location>The Attic</location>: it's dusty"))
+        self.assertEqual(1, convert_to_html.cache_info().hits)
+
+
+class TestOutputRing(unittest.TestCase):
+    def test_sequence(self):
+        ring = OutputRing(1000)
+        self.assertEqual([], ring.since(0))
+        self.assertEqual(b"frame 1", ring.add(lambda seq: b"frame %d" % seq))
+        self.assertEqual(b"frame 2", ring.add(lambda seq: b"frame %d" % seq))
+        self.assertEqual([b"frame 1", b"frame 2"], ring.since(0))
+        self.assertEqual([b"frame 2"], ring.since(1))
+        self.assertEqual([], ring.since(2))
+        self.assertEqual([], ring.since(99))
+
+    def test_size_capped(self):
+        ring = OutputRing(100)
+        for _ in range(50):
+            ring.add(lambda seq: b"%010d" % seq)
+        self.assertEqual(100, ring.size)
+        self.assertEqual([b"%010d" % seq for seq in range(41, 51)], ring.since(0))
+        ring.add(lambda seq: b"x" * 500)
+        self.assertEqual(500, ring.size, "the newest frame is always kept")
+        self.assertEqual([b"x" * 500], ring.since(0))
+
+
+class TestEventSourceStream(unittest.TestCase):
+    def setUp(self):
+        self.player = Player("julie", "f")
+        self.player.move(Location("Attic"), silent=True)
+        self.conn = PlayerConnection(self.player)
+        self.conn.io = HttpIo(self.conn, None)
+        self.app = EventApp(self.conn)
+
+    def output(self, *messages):
+        for message in messages:
+            self.player.tell(message)
+        self.conn.write_output()
+
+    def events(self, data):
+        return [json.loads(line[6:]) for line in data.decode("utf-8").splitlines() if line.startswith("data: {")]
+
+    def test_ids_and_coalescing(self):
+        stream = EventSourceStream(self.app, self.conn)
+        self.assertTrue(stream.start().startswith(b":   "), "padding")
+        self.assertEqual(b"data: keepalive\n\n", stream.next_chunk())
+        self.assertEqual(0.0, stream.flush_delay())
+        self.output("one")
+        self.output("two")
+        data = stream.next_chunk()
+        self.assertTrue(data.startswith(b"event: text\nid: 1\n"))
+        self.assertEqual(["<p>one\n</p>\n\n<p>two\n</p>\n"], [event["text"] for event in self.events(data)])
+        self.assertGreater(stream.flush_delay(), 0.0)
+        self.output("three")
+        self.assertIn(b"\nid: 2\n", stream.next_chunk())
+
+    def test_max_frame_size(self):
+        self.app.eventsource_max_frame_size = 30
+        stream = EventSourceStream(self.app, self.conn)
+        self.conn.io.append_html_special("clear")
+        for message in ["one", "two", "three", "four"]:
+            self.output(message)
+        events = self.events(stream.next_chunk())
+        self.assertGreater(len(events), 1)
+        self.assertEqual(["clear"], events[0]["special"])
+        self.assertEqual([], events[1]["special"])
+        self.assertTrue(all(len(event["text"]) <= 30 for event in events))
+        self.assertEqual("<p>one\n</p>\n<p>two\n</p>\n<p>three\n</p>\n<p>four\n</p>\n",
+                         "".join(event["text"].replace("\n\n", "\n") for event in events))
+
+    def test_replay(self):
+        stream = EventSourceStream(self.app, self.conn)
+        stream.start()
+        sent = []
+        for message in ["one", "two", "three"]:
+            self.output(message)
+            sent.append(stream.next_chunk())
+        resumed = EventSourceStream(self.app, self.conn, last_event_id=1)
+        data = resumed.start()
+        self.assertEqual(sent[1] + sent[2], data, "exactly the missed frames, as they were sent")
+        self.assertFalse(data.startswith(b":"), "no padding when resuming")
+        self.assertEqual(["<p>two\n</p>\n", "<p>three\n</p>\n"], [event["text"] for event in self.events(data)])
+        self.assertEqual(b"", EventSourceStream(self.app, self.conn, last_event_id=3).start())
+
+    def test_compression(self):
+        self.assertEqual("gzip", self.app.eventsource_encoding({"HTTP_ACCEPT_ENCODING": "deflate, gzip;q=1.0, br"}))
+        self.assertEqual("deflate", self.app.eventsource_encoding({"HTTP_ACCEPT_ENCODING": "deflate, gzip;q=0"}))
+        self.assertIsNone(self.app.eventsource_encoding({"HTTP_ACCEPT_ENCODING": "identity"}))
+        self.assertIsNone(self.app.eventsource_encoding({}))
+        for encoding, wbits in [("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)]:
+            stream = EventSourceStream(self.app, self.conn, encoding=encoding)
+            decompressor = zlib.decompressobj(wbits)
+            self.assertTrue(decompressor.decompress(stream.start()).startswith(b":   "))
+            self.output("Hello there.")
+            # every chunk must be decodable on its own, the browser can't wait for more
+            data = decompressor.decompress(stream.next_chunk())
+            self.assertEqual("<p>Hello there.\n</p>\n", self.events(data)[0]["text"])
+
+    def test_wsgiref(self):
+        # wsgiref checks that start_response is called only once
+        self.app.driver.running = False
+        environ = {"PATH_INFO": "/tale/eventsource", "HTTP_ACCEPT_ENCODING": "gzip"}
+        wsgiref.util.setup_testing_defaults(environ)
+        output = io.BytesIO()
+        errors = io.StringIO()
+        wsgiref.handlers.SimpleHandler(io.BytesIO(), output, errors, environ).run(self.app)
+        self.assertEqual("", errors.getvalue())
+        headers, _, body = output.getvalue().partition(b"\r\n\r\n")
+        self.assertTrue(headers.startswith(b"HTTP/1.0 200 OK\r\n"))
+        self.assertIn(b"Content-Type: text/event-stream; charset=utf-8\r\n", headers)
+        self.assertIn(b"Content-Encoding: gzip", headers)
+        self.assertTrue(zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(body).startswith(b":   "))
+
+
+class TestAsyncWsgiServer(unittest.TestCase):
+    def setUp(self):
+        self.player = Player("julie", "f")
+        self.player.move(Location("Attic"), silent=True)
+        self.conn = PlayerConnection(self.player)
+        self.conn.io = HttpIo(self.conn, None)
+        self.app = EventApp(self.conn)
+        self.server = AsyncWsgiServer("127.0.0.1", 0, self.app)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.app.driver.running = False
+        self.app.unblock.set()
+        self.server.shutdown()
+        self.thread.join(timeout=5)
+
+    def connection(self):
+        return http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=5)
+
+    def test_requests_keepalive(self):
+        c = self.connection()
+        c.request("GET", "/echo?a=1")
+        r = c.getresponse()
+        self.assertEqual(200, r.status)
+        self.assertEqual(b"GET a=1 ", r.read())
+        c.request("POST", "/echo", body=b"cmd=look")
+        r = c.getresponse()
+        self.assertEqual(b"POST  cmd=look", r.read())
+        c.request("GET", "/tale/nonexisting")
+        r = c.getresponse()
+        self.assertEqual(404, r.status)
+        r.read()
+        c.request("GET", "/crash")
+        r = c.getresponse()
+        self.assertEqual(500, r.status)
+        c.close()
+
+    def test_bad_content_length(self):
+        for content_length in ["abc", "-1"]:
+            c = self.connection()
+            c.putrequest("POST", "/echo")
+            c.putheader("Content-Length", content_length)
+            c.endheaders()
+            r = c.getresponse()
+            self.assertEqual(400, r.status)
+            r.read()
+            c.close()
+
+    def test_cookie_headers(self):
+        sock = socket.create_connection(("127.0.0.1", self.server.server_address[1]), timeout=5)
+        sock.sendall(b"GET /cookie HTTP/1.1\r\nHost: localhost\r\nCookie: a=1\r\nCookie: b=2\r\nConnection: close\r\n\r\n")
+        response = b""
+        for data in iter(lambda: sock.recv(4096), b""):
+            response += data
+        sock.close()
+        self.assertTrue(response.endswith(b"\r\n\r\na=1; b=2"))
+
+    def test_blocking_app(self):
+        blocked = self.connection()
+        blocked.request("GET", "/block")
+        c = self.connection()
+        c.request("GET", "/echo?a=1")
+        self.assertEqual(b"GET a=1 ", c.getresponse().read(), "a blocking request must not stall the others")
+        self.app.unblock.set()
+        self.assertEqual(b"unblocked", blocked.getresponse().read())
+        c.close()
+        blocked.close()
+
+    def test_eventsource(self):
+        self.player.tell("Hello there.")
+        self.conn.write_output()
+        c = self.connection()
+        c.request("GET", "/tale/eventsource")
+        r = c.getresponse()
+        self.assertEqual(200, r.status)
+        self.assertEqual("text/event-stream; charset=utf-8", r.getheader("Content-Type"))
+        self.assertTrue(r.fp.readline().startswith(b":   "), "padding")
+        r.fp.readline()
+        self.assertEqual(b"event: text\n", r.fp.readline())
+        r.fp.readline()
+        data = json.loads(r.fp.readline().decode("utf-8")[6:])
+        self.assertEqual("<p>Hello there.\n</p>\n", data["text"])
+        self.assertEqual("Attic", data["location"])
+        r.fp.readline()
+        # new output must wake up the stream
+        self.player.tell("Bye.")
+        self.conn.write_output()
+        self.assertEqual(b"event: text\n", r.fp.readline())
+        r.fp.readline()
+        data = json.loads(r.fp.readline().decode("utf-8")[6:])
+        self.assertEqual("<p>Bye.\n</p>\n", data["text"])
+        c.close()
+
+    def test_eventsource_resume(self):
+        self.player.tell("Hello there.")
+        self.conn.write_output()
+        c = self.connection()
+        c.request("GET", "/tale/eventsource")
+        r = c.getresponse()
+        r.fp.readline()
+        r.fp.readline()
+        self.assertEqual(b"event: text\n", r.fp.readline())
+        self.assertEqual(b"id: 1\n", r.fp.readline())
+        c.close()
+        c = self.connection()
+        c.request("GET", "/tale/eventsource", headers={"Last-Event-ID": "0", "Accept-Encoding": "gzip"})
+        r = c.getresponse()
+        self.assertEqual("gzip", r.getheader("Content-Encoding"))
+        data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(r.read1(65536))
+        self.assertTrue(data.startswith(b"event: text\nid: 1\n"), "missed event is sent again, without padding")
+        c.close()
+
+    def test_many_eventsources_one_thread(self):
+        threads_before = threading.active_count()
+        connections = []
+        for _ in range(20):
+            c = self.connection()
+            c.request("GET", "/tale/eventsource")
+            self.assertEqual(200, c.getresponse().status)
+            connections.append(c)
+        self.assertLessEqual(threading.active_count(), threads_before + self.server.app_workers, "no thread per event stream")
+        for c in connections:
+            c.close()
+
+    def websocket_connect(self):
+        sock = socket.create_connection(("127.0.0.1", self.server.server_address[1]), timeout=5)
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        sock.sendall(("GET /tale/websocket HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      "Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n" % key).encode("ascii"))
+        stream = sock.makefile("rb")
+        self.assertEqual(b"HTTP/1.1 101 Switching Protocols\r\n", stream.readline())
+        headers = {}
+        for line in iter(stream.readline, b"\r\n"):
+            name, _, value = line.decode("ascii").partition(":")
+            headers[name.lower()] = value.strip()
+        self.assertEqual("websocket", headers["upgrade"])
+        self.assertEqual(websocket_accept_key(key), headers["sec-websocket-accept"])
+        return sock, stream
+
+    def websocket_send(self, sock, opcode, payload):
+        mask = os.urandom(4)
+        sock.sendall(struct.pack("!BB", 0x80 | opcode, 0x80 | len(payload)) + mask + websocket_unmask(mask, payload))
+
+    def websocket_receive(self, stream):
+        byte1, length = stream.read(2)
+        if length == 126:
+            length = struct.unpack("!H", stream.read(2))[0]
+        return byte1 & 0x0f, stream.read(length)
+
+    def test_websocket_frames(self):
+        self.assertEqual("s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", websocket_accept_key("dGhlIHNhbXBsZSBub25jZQ=="))
+        self.assertEqual(b"\x81\x05hello", websocket_frame(0x1, b"hello"))
+        self.assertEqual(b"\x82\x7e\x01\x00", websocket_frame(0x2, bytes(256))[:4])
+        self.assertEqual(b"hello", websocket_unmask(b"\x01\x02\x03\x04", websocket_unmask(b"\x01\x02\x03\x04", b"hello")))
+        self.assertEqual(b"", websocket_unmask(b"\x01\x02\x03\x04", b""))
+
+    def test_websocket(self):
+        self.player.tell("Hello there.")
+        self.conn.write_output()
+        sock, stream = self.websocket_connect()
+        opcode, payload = self.websocket_receive(stream)
+        self.assertEqual(0x1, opcode)
+        data = json.loads(payload.decode("utf-8"))
+        self.assertEqual("<p>Hello there.\n</p>\n", data["text"])
+        self.assertEqual("Attic", data["location"])
+        self.assertIn("turns", data)
+        self.assertIn("special", data)
+        # input travels over the same connection
+        self.websocket_send(sock, 0x1, json.dumps({"cmd": "look"}).encode("utf-8"))
+        opcode, payload = self.websocket_receive(stream)
+        self.assertEqual("<span class='txt-userinput'>look</span>", json.loads(payload.decode("utf-8"))["text"])
+        self.assertEqual(["look"], self.player.get_pending_input())
+        self.websocket_send(sock, 0x9, b"ping")
+        self.assertEqual((0xa, b"ping"), self.websocket_receive(stream))
+        self.websocket_send(sock, 0x8, struct.pack("!H", 1000))
+        self.assertEqual((0x8, struct.pack("!H", 1000)), self.websocket_receive(stream))
+        sock.close()
+
+    def test_websocket_unsupported(self):
+        c = self.connection()
+        c.request("GET", "/tale/websocket")
+        r = c.getresponse()
+        self.assertEqual(400, r.status)
+        r.read()
+        c.close()
+
+
+class SessionStoreTests:
+    def store(self, **kwargs):
+        raise NotImplementedError
+
+    def test_load_save(self):
+        store = self.store()
+        session = store.load("", "1.2.3.4")
+        self.assertTrue(session["id"])
+        self.assertEqual(0, len(store), "new sessions are only stored when saved")
+        self.assertNotEqual(session["id"], store.load("", "1.2.3.4")["id"])
+        unknown = store.load("unknown-session-id", "1.2.3.4")
+        self.assertNotEqual("unknown-session-id", unknown["id"])
+        session["name"] = "julie"
+        sid = store.save(session)
+        self.assertEqual(session["id"], sid)
+        self.assertEqual(1, len(store))
+        self.assertEqual("julie", store.load(sid, "1.2.3.4")["name"])
+        store.delete(sid)
+        self.assertEqual(0, len(store))
+        self.assertNotEqual(sid, store.load(sid, "1.2.3.4")["id"])
+
+    def test_live_values(self):
+        store = self.store()
+        session = store.load("", "1.2.3.4")
+        session["player_connection"] = conn = object()
+        sid = store.save(session)
+        self.assertIs(conn, store.load(sid)["player_connection"])
+
+    def test_expire(self):
+        store = self.store(ttl=100)
+        sids = [store.save(store.load("", "1.2.3.4")) for _ in range(5)]
+        self.assertEqual(0, store.expire())
+        self.assertEqual(5, len(store))
+        self.assertEqual(5, store.expire(time.time() + 101))
+        self.assertEqual(0, len(store))
+        self.assertNotEqual(sids[0], store.load(sids[0])["id"])
+
+    def test_limits(self):
+        store = self.store(max_sessions=10, max_per_address=3)
+        sids = [store.save(store.load("", "1.2.3.4")) for _ in range(5)]
+        self.assertEqual(3, len(store))
+        self.assertEqual(sids[2:], [store.load(sid)["id"] for sid in sids[2:]])
+        self.assertNotEqual(sids[1], store.load(sids[1])["id"])
+        for address in range(10):
+            store.save(store.load("", "10.0.0.%d" % address))
+        self.assertEqual(10, len(store))
+        self.assertNotEqual(sids[4], store.load(sids[4])["id"], "least recently used session is removed first")
+
+    def test_touch(self):
+        store = self.store(max_sessions=2)
+        sid1 = store.save(store.load("", "1.2.3.4"))
+        sid2 = store.save(store.load("", "1.2.3.4"))
+        store.touch(sid1)
+        store.save(store.load("", "1.2.3.4"))
+        self.assertEqual(sid1, store.load(sid1)["id"])
+        self.assertNotEqual(sid2, store.load(sid2)["id"], "touched session is no longer the least recently used")
+
+    def test_connected_players_are_kept(self):
+        class Connection:
+            io = "io"
+        conn = Connection()
+        store = self.store(ttl=100, max_sessions=10, max_per_address=2)
+        sids = []
+        for _ in range(2):
+            session = store.load("", "1.2.3.4")
+            session["player_connection"] = conn
+            sids.append(store.save(session))
+        store.save(store.load("", "1.2.3.4"))
+        self.assertEqual(3, len(store), "sessions of connected players are not evicted")
+        self.assertEqual(1, store.expire(time.time() + 101))
+        self.assertEqual(sids, [store.load(sid)["id"] for sid in sids], "sessions of connected players don't expire")
+        conn.io = None    # disconnected
+        self.assertEqual(2, store.expire(time.time() + 1000))
+        self.assertEqual(0, len(store))
+
+    def test_expire_due(self):
+        store = self.store()
+        self.assertFalse(store.expire_due())
+        self.assertTrue(store.expire_due(time.time() + store.expire_interval))
+        store.expire()
+        self.assertFalse(store.expire_due())
+
+
+class TestMemorySessionStore(SessionStoreTests, unittest.TestCase):
+    def store(self, **kwargs):
+        return MemorySessionStore(**kwargs)
+
+
+class TestSqliteSessionStore(SessionStoreTests, unittest.TestCase):
+    def store(self, **kwargs):
+        return SqliteSessionStore(":memory:", **kwargs)
+
+    def test_persistent(self):
+        with tempfile.TemporaryDirectory() as directory:
+            dbfile = os.path.join(directory, "sessions.sqlite")
+            store = SqliteSessionStore(dbfile)
+            session = store.load("", "1.2.3.4")
+            session["name"] = "julie"
+            session["player_connection"] = object()
+            sid = store.save(session)
+            store.close()
+            store = SqliteSessionStore(dbfile)
+            session = store.load(sid)
+            self.assertEqual("julie", session["name"])
+            self.assertNotIn("player_connection", session)
+            store.close()
+
+    def test_no_writes_for_unchanged_sessions(self):
+        store = self.store(ttl=100)
+        session = store.load("", "1.2.3.4")
+        sid = store.save(session)
+        changes = store.conn.total_changes
+        session = store.load(sid, "1.2.3.4")
+        store.save(session)
+        self.assertEqual(changes, store.conn.total_changes)
+        session["name"] = "julie"
+        store.save(session)
+        self.assertEqual(changes + 1, store.conn.total_changes)
+        store.load(sid, "1.2.3.4")
+        store.expire()
+        self.assertEqual(changes + 2, store.conn.total_changes, "the access times are written by expire")
+
+
+class TestSessionMiddleware(unittest.TestCase):
+    def request(self, middleware, cookie=None):
+        environ = {"PATH_INFO": "/tale/story", "REMOTE_ADDR": "1.2.3.4"}
+        if cookie:
+            environ["HTTP_COOKIE"] = cookie
+        response = []
+        middleware(environ, lambda status, headers, exc_info=None: response.extend(headers))
+        cookies = [value.split(";")[0] for name, value in response if name == "Set-Cookie"]
+        return environ["wsgi.session"], cookies
+
+    def test_cookies(self):
+        store = MemorySessionStore()
+        middleware = SessionMiddleware(lambda environ, start_response: start_response("200 OK", []) or [], store)
+        session, cookies = self.request(middleware)
+        self.assertEqual(["tale_session_id=" + session["id"]], cookies)
+        session2, cookies = self.request(middleware, cookies[0])
+        self.assertIs(session, session2)
+        self.assertEqual([], cookies)
+        session3, cookies = self.request(middleware, "tale_session_id=bogus")
+        self.assertEqual(["tale_session_id=" + session3["id"]], cookies, "unknown session gets a new cookie")
+        self.assertEqual(2, len(store))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,16 +6,31 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
 import datetime
+import gc
 import heapq
 import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import Future
 
 import tale.base
 import tale.demo
 import tale.driver
 import tale.driver_if
 import tale.driver_mud
+import tale.player
+import tale.scheduler
+import tale.story
+import tale.tio.iobase
 import tale.util
+from tale import pubsub
+from tale.savegames import TaleDeserializer
+from tale.story import StoryBase, StoryConfig
+from tale.vfs import VirtualFileSystem
 from tale.cmds import cmd, wizcmd, disabled_in_gamemode
 from tale.story import GameMode
 from tests.supportstuff import Thing, FakeDriver
@@ -62,6 +77,308 @@ class TestDriverCreation(unittest.TestCase):
         self.assertIsNone(d.user_resources)
 
 
+class TestMudMainLoopWait(unittest.TestCase):
+    def test_input_wakes_up_driver(self):
+        d = tale.driver_mud.MudDriver()
+        self.assertFalse(d.input_wakeup.is_set())
+        player = tale.player.Player("julie", "f")
+        player.store_input_line("look")
+        self.assertTrue(d.input_wakeup.is_set())
+        start = time.time()
+        d._wait_for_input_event(5.0)
+        self.assertLess(time.time() - start, 1.0, "pending input should not block the wait")
+        self.assertFalse(d.input_wakeup.is_set(), "wakeup should be cleared")
+
+    def test_wait_timeout(self):
+        d = tale.driver_mud.MudDriver()
+        start = time.time()
+        d._wait_for_input_event(0.05)
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        start = time.time()
+        d._wait_for_input_event(-1.0)   # tick overdue, don't wait at all
+        self.assertLess(time.time() - start, 0.04)
+
+
+class TestAwaitResult(unittest.TestCase):
+    def setUp(self):
+        gc.collect()   # get rid of the drivers of other tests, they also listen to the async dialogs topic
+        self.driver = tale.driver_mud.MudDriver()
+        self.conn = tale.player.PlayerConnection(tale.player.Player("julie", "f"), tale.tio.iobase.IoAdapterBase(None))
+
+    def dialog(self, future, results):
+        try:
+            results.append((yield "await-result", future))
+        except ValueError as x:
+            results.append(x)
+
+    def complete_in_thread(self, future, result=None, exception=None):
+        def work():
+            time.sleep(0.05)
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        thread = threading.Thread(target=work)
+        thread.start()
+        return thread
+
+    def test_result(self):
+        results = []
+        future = Future()
+        self.driver._continue_dialog(self.conn, self.dialog(future, results), "")
+        self.assertIn(self.conn, self.driver.waiting_for_result)
+        self.complete_in_thread(future, result=42).join()
+        self.assertTrue(self.driver.input_wakeup.is_set(), "completion should wake up the driver")
+        self.assertEqual([], results)
+        pubsub.sync("driver-async-dialogs")
+        self.assertEqual([42], results)
+        self.assertNotIn(self.conn, self.driver.waiting_for_result)
+
+    def test_exception(self):
+        results = []
+        future = Future()
+        self.driver._continue_dialog(self.conn, self.dialog(future, results), "")
+        error = ValueError("invalid password")
+        self.complete_in_thread(future, exception=error).join()
+        pubsub.sync("driver-async-dialogs")
+        self.assertEqual([error], results)
+        self.assertNotIn(self.conn, self.driver.waiting_for_result)
+
+    def test_disconnected(self):
+        results = []
+        future = Future()
+        dialog = self.dialog(future, results)
+        self.driver._continue_dialog(self.conn, dialog, "")
+        self.conn.player = None
+        self.complete_in_thread(future, result=42).join()
+        pubsub.sync("driver-async-dialogs")
+        self.assertEqual([], results)
+        self.assertIsNone(dialog.gi_frame, "dialog should have been closed")
+        self.assertNotIn(self.conn, self.driver.waiting_for_result)
+
+    def test_no_future(self):
+        def dialog():
+            yield "await-result", 42
+        with self.assertRaises(TypeError):
+            self.driver._continue_dialog(self.conn, dialog(), "")
+
+
+class TestBackgroundSave(unittest.TestCase):
+    def setUp(self):
+        gc.collect()   # get rid of the drivers of other tests, they also listen to the pending tells topic
+        self.driver = tale.driver_if.IFDriver()
+        self.driver.story = StoryBase()
+        self.driver.story.config = StoryConfig()
+        self.driver.story.config.name = "Background Save"
+        self.directory = tempfile.mkdtemp()
+        self.driver.user_resources = VirtualFileSystem(root_path=self.directory, readonly=False)
+        self.driver.game_clock = tale.util.GameDateTime(datetime.datetime.now())
+        self.room = tale.base.Location("room")
+        self.thing = tale.base.Item("thing")
+        self.room.init_inventory([self.thing])
+        self.player = tale.player.Player("julie", "f")
+        self.player.move(self.room, silent=True)
+
+    def tearDown(self):
+        self.driver.save_executor.shutdown()
+        shutil.rmtree(self.directory)
+
+    def block_save_thread(self):
+        release = threading.Event()
+        self.driver.save_executor.submit(release.wait, 5)
+        return release
+
+    def saved_state(self):
+        savegame = self.driver.user_resources["background_save.savegame"].data
+        deltas = []
+        for name in sorted(os.listdir(self.directory)):
+            if ".delta" in name:
+                deltas.append(self.driver.user_resources[name].data)
+        return TaleDeserializer().deserialize_incremental(savegame, deltas)
+
+    def saved_thing_title(self):
+        state = self.saved_state()[0]
+        return next(item["title"] for item in state["items"] if item["vnum"] == self.thing.vnum)
+
+    def test_save_in_background(self):
+        release = self.block_save_thread()
+        self.driver.do_save(self.player)
+        self.thing.title = "changed thing"
+        self.assertEqual([], self.player.test_get_output_paragraphs(), "saving should not be done yet")
+        release.set()
+        self.driver.wait_for_saves()
+        self.assertEqual(["Game saved.\n"], self.player.test_get_output_paragraphs())
+        self.assertEqual("thing", self.saved_thing_title(), "the save should contain the state at the time of the save command")
+        self.assertEqual(["background_save.savegame"], os.listdir(self.directory))
+
+    def test_coalesce(self):
+        self.driver.do_save(self.player)
+        self.driver.wait_for_saves()
+        self.player.test_get_output_paragraphs()
+        release = self.block_save_thread()
+        self.thing.title = "first change"
+        self.driver.do_save(self.player)
+        self.thing.title = "second change"
+        self.driver.do_save(self.player)
+        release.set()
+        self.driver.wait_for_saves()
+        self.assertEqual(["Game saved.\n"], self.player.test_get_output_paragraphs(), "the saves should have been combined")
+        self.assertEqual(["background_save.savegame", "background_save.savegame.delta1"], sorted(os.listdir(self.directory)))
+        self.assertEqual(1, self.saved_state()[2])
+        self.assertEqual("second change", self.saved_thing_title())
+        self.thing.title = "third change"
+        self.driver.do_save(self.player)
+        self.driver.wait_for_saves()
+        self.assertEqual(2, self.saved_state()[2])
+        self.assertEqual("third change", self.saved_thing_title())
+
+    def test_plain_attributes(self):
+        cellar = tale.base.Location("cellar")
+        door, _ = tale.base.Door.connect(self.room, "down", "trapdoor", None, cellar, "up", "trapdoor", None, locked=True)
+
+        def saved_door_locked():
+            state = self.saved_state()[0]
+            return next(e["locked"] for e in state["exits"] if e["vnum"] == door.vnum)
+        self.driver.do_save(self.player)
+        self.driver.wait_for_saves()
+        door.locked = False
+        self.thing.value = 42.0
+        self.driver.do_save(self.player)
+        self.driver.wait_for_saves()
+        self.assertEqual(1, self.saved_state()[2])
+        self.assertFalse(saved_door_locked())
+        self.assertEqual(42.0, next(i["value"] for i in self.saved_state()[0]["items"] if i["vnum"] == self.thing.vnum))
+        # a save that was waiting and is replaced, must not make the next one forget its changes
+        release = self.block_save_thread()
+        door.locked = True
+        self.driver.do_save(self.player)
+        self.driver.do_save(self.player)
+        release.set()
+        self.driver.wait_for_saves()
+        self.assertEqual(2, self.saved_state()[2])
+        self.assertTrue(saved_door_locked())
+        # full save
+        door.locked = False
+        self.driver.story.config.savegame_max_deltas = 2
+        self.driver.do_save(self.player)
+        self.driver.wait_for_saves()
+        self.assertEqual(["background_save.savegame"], os.listdir(self.directory))
+        self.assertFalse(saved_door_locked())
+
+    def test_error(self):
+        self.driver.do_save(self.player)
+        self.driver.wait_for_saves()
+        self.player.test_get_output_paragraphs()
+        shutil.rmtree(self.directory)
+        with open(self.directory, "w"):
+            pass    # a file where the directory should be, this makes the save fail
+        try:
+            self.driver.do_save(self.player)
+            self.driver.wait_for_saves()
+        finally:
+            os.remove(self.directory)
+            os.mkdir(self.directory)
+        output = self.player.test_get_output_paragraphs()
+        self.assertTrue(output[0].startswith("The game could not be saved: "))
+        self.assertEqual("", self.driver.savegame_id, "after a failed save, the next should be a full save")
+
+    def test_command_tick_woken_up(self):
+        # with the COMMAND tick method the main loop waits for player input, a finished save must wake it up
+        self.driver.story.config.server_tick_method = tale.story.TickMethod.COMMAND
+
+        def player_typed_something():
+            self.player.input_is_available.set()
+            self.driver.notify_input_available()
+        watchdog = threading.Timer(5, player_typed_something)
+        watchdog.start()
+        try:
+            self.driver.do_save(self.player)
+            self.assertFalse(self.driver._wait_for_command(self.player), "should be woken up by the save, not by input")
+        finally:
+            watchdog.cancel()
+        pubsub.sync("driver-pending-tells")
+        self.assertEqual(["Game saved.\n"], self.player.test_get_output_paragraphs())
+        self.player.store_input_line("look")
+        self.assertTrue(self.driver._wait_for_command(self.player))
+
+
+class TestWorldPersistence(unittest.TestCase):
+    def setUp(self):
+        gc.collect()
+        self.driver = tale.driver_mud.MudDriver()
+        self.driver.story = StoryBase()
+        self.driver.story.config = StoryConfig()
+        self.driver.story.config.mud_persistence_interval = 60
+        self.directory = tempfile.mkdtemp()
+        self.driver.user_resources = VirtualFileSystem(root_path=self.directory, readonly=False)
+        self.driver.game_clock = tale.util.GameDateTime(datetime.datetime(2017, 1, 2, 12, 0, 0))
+        self.room = tale.base.Location("room")
+        self.cellar = tale.base.Location("cellar")
+        self.thing = tale.base.Item("thing")
+        self.gem = tale.base.Item("gem")
+        self.room.init_inventory([self.thing])
+        self.rat = tale.base.Living("rat", "m")
+        self.rat.move(self.room, silent=True)
+        self.player = tale.player.Player("julie", "f")
+        self.player.move(self.room, silent=True)
+        self.player.insert(self.gem, self.player)
+
+    def tearDown(self):
+        self.driver.checkpoint_executor.shutdown()
+        shutil.rmtree(self.directory)
+
+    def test_checkpoint(self):
+        self.driver.checkpoint_world().result()
+        state = TaleDeserializer().deserialize(self.driver.user_resources["world.savegame"].data)
+        self.assertNotIn("player", state)
+        self.assertEqual([self.rat.vnum], [living["vnum"] for living in state["livings"]])
+        item_vnums = {item["vnum"] for item in state["items"]}
+        self.assertIn(self.thing.vnum, item_vnums)
+        self.assertNotIn(self.gem.vnum, item_vnums, "the things the players carry are not part of the world")
+        self.assertIn(self.thing.vnum, self.driver.world_states)
+
+    def test_restore(self):
+        self.driver.checkpoint_world().result()
+        self.rat.title = "big rat"
+        self.rat.move(self.cellar, silent=True)
+        self.rat.insert(self.thing, self.rat)
+        junk = tale.base.Item("junk")
+        self.room.insert(junk, None)
+        self.driver.game_clock.add_realtime(datetime.timedelta(hours=1))
+        self.driver._restore_world()
+        self.assertEqual("rat", self.rat.title)
+        self.assertIs(self.room, self.rat.location)
+        self.assertIs(self.room, self.thing.contained_in)
+        self.assertEqual(0, self.rat.inventory_size)
+        self.assertIsNone(junk.contained_in, "things that weren't in the saved world should be gone")
+        self.assertIs(self.player, self.gem.contained_in)
+        self.assertIn(self.player, self.room.livings)
+        self.assertEqual(datetime.datetime(2017, 1, 2, 12, 0, 0), self.driver.game_clock.clock)
+
+    def test_restore_plain_attributes(self):
+        door, _ = tale.base.Door.connect(self.room, "down", "trapdoor", None, self.cellar, "up", "trapdoor", None, locked=True)
+        self.driver.checkpoint_world().result()
+        door.locked = False
+        self.thing.value = 42.0
+        self.driver.checkpoint_world().result()
+        door.locked = True
+        self.thing.value = 0.0
+        self.driver._restore_world()
+        self.assertFalse(door.locked, "the restarted world should have the door unlocked")
+        self.assertEqual(42.0, self.thing.value)
+
+    def test_periodic(self):
+        self.driver.world_checkpoint_time = time.time()
+        self.driver._server_tick()
+        self.assertIsNone(self.driver.world_checkpoint)
+        self.driver.world_checkpoint_time = time.time() - 61
+        self.driver._server_tick()
+        self.driver.world_checkpoint.result()
+        self.driver._server_tick()
+        self.assertIsNone(self.driver.world_checkpoint)
+        self.assertIn("world.savegame", os.listdir(self.directory))
+
+
 class TestDeferreds(unittest.TestCase):
     def testSortable(self):
         t1 = datetime.datetime(1995, 1, 1)
@@ -137,6 +454,45 @@ class TestDeferreds(unittest.TestCase):
         with self.assertRaises(ValueError):
             d = tale.driver.Deferred(due, lambda a, ctx=None: 1, [42], None)
 
+    def testResolveCache(self):
+        ctx = tale.util.Context(driver=FakeDriver(), clock=None, config=None, player_connection=None)
+        due = datetime.datetime.now()
+        t1 = Thing()
+        t2 = Thing()
+        d = tale.driver.Deferred(due, t1.append, [42], None)
+        self.assertIsNone(d._resolved)
+        func, wants_ctx = d._resolve_action()
+        self.assertTrue(wants_ctx)
+        self.assertIs(t1, d._resolved[0])
+        self.assertEqual((func, wants_ctx), d._resolve_action())
+        d.owner = t2     # as done when restoring a savegame
+        d(ctx=ctx)
+        self.assertEqual([], t1.x)
+        self.assertEqual([42], t2.x)
+        d = tale.driver.Deferred(due, module_level_func_without_ctx, [], None)
+        self.assertFalse(d._resolve_action()[1])
+        d(ctx=ctx)
+
+    def testPeriodicalDeactivated(self):
+        class Ticker(tale.base.Item):
+            @tale.util.call_periodically(10)
+            def tick(self, ctx):
+                self.ticks = getattr(self, "ticks", 0) + 1
+        driver = FakeDriver()
+        ticker = Ticker("ticker")
+        self.assertEqual(1, len(driver.deferreds))
+        deferred = driver.deferreds[0]
+        driver.deferreds.clear()
+        ctx = tale.util.Context(driver=driver, clock=driver.game_clock, config=None, player_connection=None)
+        deferred(ctx=ctx)
+        self.assertEqual(1, ticker.ticks)
+        self.assertEqual(1, len(driver.deferreds), "should have been rescheduled")
+        driver.deferreds.clear()
+        tale.util.call_periodically(0)(Ticker.tick)
+        deferred(ctx=ctx)
+        self.assertEqual(1, ticker.ticks, "deactivated periodical must not be called anymore")
+        self.assertEqual(0, len(driver.deferreds))
+
     def testDue_realtime(self):
         # test due timings where the gameclock == realtime clock
         game_clock = tale.util.GameDateTime(datetime.datetime(2013, 7, 18, 15, 29, 59, 123))
@@ -192,6 +548,146 @@ class TestDeferreds(unittest.TestCase):
         self.assertEqual((2, 3), d.periodical)
 
 
+class TestSchedulers(unittest.TestCase):
+    def fill(self, sched, start, owners):
+        rnd = random.Random(42)
+        deferreds = []
+        for i in range(2000):
+            due = start + datetime.timedelta(seconds=rnd.uniform(0, 20000))
+            d = tale.driver.Deferred(due, owners[i % len(owners)].move, [], None)
+            sched.push(d)
+            deferreds.append(d)
+        return deferreds
+
+    def test_wheel_same_as_heap(self):
+        start = datetime.datetime(2017, 1, 1)
+        owners = [tale.base.Item("thing%d" % i) for i in range(10)]
+        heap = tale.scheduler.HeapScheduler()
+        wheel = tale.scheduler.TimingWheelScheduler(5.0, slots=8, levels=2)
+        self.fill(heap, start, owners)
+        self.fill(wheel, start, owners)
+        self.assertEqual(2000, len(wheel))
+        self.assertEqual(sorted(heap)[0].due_gametime, wheel[0].due_gametime)
+        heap.remove_owner(owners[3])
+        wheel.remove_owner(owners[3])
+        self.assertEqual(1800, len(wheel))
+        self.assertEqual(len(heap), len(wheel))
+        self.assertTrue(all(d.owner is not owners[3] for d in wheel))
+        now = start
+        for step in [0.5, 1, 7, 30, 3, 2000, 0, 12000, 1, 6000]:
+            now += datetime.timedelta(seconds=step)
+            from_heap = heap.pop_due(now)
+            from_wheel = wheel.pop_due(now)
+            self.assertEqual([d.due_gametime for d in from_heap], [d.due_gametime for d in from_wheel])
+            self.assertTrue(all(d.due_gametime <= now for d in from_wheel))
+            self.assertEqual(len(heap), len(wheel))
+        self.assertEqual(0, len(wheel))
+        self.assertFalse(wheel)
+
+    def test_create(self):
+        self.assertIsInstance(tale.scheduler.create_scheduler("heap", 1.0), tale.scheduler.HeapScheduler)
+        wheel = tale.scheduler.create_scheduler("wheel", 5.0)
+        self.assertIsInstance(wheel, tale.scheduler.TimingWheelScheduler)
+        self.assertEqual(5.0, wheel.resolution)
+        with self.assertRaises(ValueError):
+            tale.scheduler.create_scheduler("foo", 1.0)
+
+    def test_driver_wheel(self):
+        thing = tale.base.Item("thing")
+        driver = tale.driver.Driver()
+        driver.game_clock = tale.util.GameDateTime(datetime.datetime.now(), 1)
+        driver.deferreds = tale.scheduler.TimingWheelScheduler(1.0)
+        driver.defer(10, thing.move)
+        driver.defer((5, 10, 10), thing.move)
+        self.assertEqual(2, len(driver.deferreds))
+        driver.remove_deferreds(thing)
+        self.assertEqual(0, len(driver.deferreds))
+
+
+class Pulser(tale.base.Item):
+    @tale.util.call_periodically(10, grouped=True)
+    def pulse(self, ctx):
+        self.pulses = getattr(self, "pulses", 0) + 1
+
+
+class DoublePulser(tale.base.Item):
+    @tale.util.call_periodically(10, grouped=True)
+    def pulse(self, ctx):
+        self.pulses = getattr(self, "pulses", 0) + 1
+
+    @tale.util.call_periodically(10, grouped=True)
+    def beat(self, ctx):
+        self.beats = getattr(self, "beats", 0) + 1
+
+
+class TestPeriodicGroups(unittest.TestCase):
+    def test_group_buckets(self):
+        group = tale.scheduler.PeriodicGroup(10.0, 2.0)
+        self.assertEqual(5, len(group.buckets))
+        things = [Thing() for _ in range(12)]
+        for t in things:
+            group.add(t.append)
+        group.add(things[0].append)
+        self.assertEqual(12, len(group))
+        sizes = sorted(len(bucket) for bucket in group.buckets)
+        self.assertEqual([2, 2, 2, 3, 3], sizes)
+        called = [group.next_bucket() for _ in range(5)]
+        self.assertEqual(12, sum(len(methods) for methods in called))
+        self.assertEqual(called[0], group.next_bucket(), "should wrap around")
+        group.remove(things[0])
+        self.assertEqual(11, len(group))
+        del things, called, t
+        gc.collect()
+        self.assertEqual(0, len(group), "objects must be weakly referenced")
+        group.remove("not weakly referencable")
+
+    def test_grouped_decorator(self):
+        with self.assertRaises(ValueError):
+            tale.util.call_periodically(10, 20, grouped=True)
+        driver = FakeDriver()
+        pulsers = [Pulser("pulser") for _ in range(20)]
+        self.assertEqual(0, len(driver.deferreds))
+        group = driver.periodic_groups[10]
+        self.assertEqual(20, len(group))
+        self.assertEqual(10, len(group.buckets))
+        ctx = tale.util.Context(driver=driver, clock=driver.game_clock, config=None, player_connection=None)
+        for _ in range(10):
+            driver._call_periodic_groups(ctx)
+        self.assertTrue(all(p.pulses == 1 for p in pulsers))
+        pulsers[0].destroy(ctx)
+        self.assertEqual(19, len(group))
+        tale.util.call_periodically(0)(Pulser.pulse)
+        try:
+            for _ in range(10):
+                driver._call_periodic_groups(ctx)
+            self.assertTrue(all(p.pulses == 1 for p in pulsers))
+            self.assertEqual(0, len(group))
+        finally:
+            tale.util.call_periodically(10, grouped=True)(Pulser.pulse)
+
+    def test_deactivate_one_of_several(self):
+        driver = FakeDriver()
+        pulsers = [DoublePulser("pulser") for _ in range(5)]
+        group = driver.periodic_groups[10]
+        self.assertEqual(5, len(group))
+        ctx = tale.util.Context(driver=driver, clock=driver.game_clock, config=None, player_connection=None)
+        tale.util.call_periodically(0)(DoublePulser.beat)
+        try:
+            for _ in range(20):
+                driver._call_periodic_groups(ctx)
+            self.assertEqual(5, len(group), "the objects still have another grouped method")
+            self.assertTrue(all(p.pulses == 2 for p in pulsers))
+            self.assertFalse(any(hasattr(p, "beats") for p in pulsers))
+        finally:
+            tale.util.call_periodically(10, grouped=True)(DoublePulser.beat)
+        tale.util.call_periodically(0)(DoublePulser.pulse)
+        try:
+            driver._call_periodic_groups(ctx)
+            self.assertEqual(4, len(group), "an object without grouped methods is removed")
+        finally:
+            tale.util.call_periodically(10, grouped=True)(DoublePulser.pulse)
+
+
 @cmd("test1")
 @disabled_in_gamemode(GameMode.IF)
 def func1(player, parsed, ctx):
@@ -232,6 +728,16 @@ class TestCommands(unittest.TestCase):
     def testCommandsOverride(self):
         self.cmds.override("verb4", func2, "noob")
 
+    def testCommandsCached(self):
+        wiz1 = self.cmds.get(["wizard"])
+        wiz2 = self.cmds.get({"wizard"})
+        self.assertIs(wiz1, wiz2)
+        self.assertNotIn("verb5", wiz1)
+        self.cmds.add("verb5", func3, "wizard")
+        wiz3 = self.cmds.get(["wizard"])
+        self.assertIsNot(wiz1, wiz3)
+        self.assertIn("verb5", wiz3)
+
     def testCommandsAdjust(self):
         wiz = self.cmds.get(["wizard"])
         self.assertEqual({"verb1", "verb2", "verb3"}, set(wiz.keys()))
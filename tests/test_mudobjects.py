@@ -141,6 +141,35 @@ class TestLocations(unittest.TestCase):
         self.assertEqual([], rat.messages)
         self.assertEqual(["juliemsg"], julie.messages)
 
+    def test_tell_broadcast(self):
+        hall = Location("hall")
+        rat = MsgTraceNPC("rat", "n", race="rodent")
+        cat = Living("cat", "f", race="cat")
+        julie = Player("julie", "f")
+        hall.init_inventory([rat, cat, julie])
+        hall.tell("roommsg")
+        self.assertEqual(["roommsg"], rat.messages, "overridden tell must still be called")
+        self.assertEqual(["roommsg\n"], julie.test_get_output_paragraphs())
+        pending = pubsub.pending()
+        self.assertNotIn(("wiretap-living", "cat#%d" % cat.vnum), pending, "no wiretap topic needed without subscribers")
+        self.assertNotIn(("wiretap-location", "hall#%d" % hall.vnum), pending, "no wiretap topic needed without subscribers")
+        collector = PubsubCollector()
+        cat.get_wiretap().subscribe(collector)
+        room_collector = PubsubCollector()
+        hall.get_wiretap().subscribe(room_collector)
+        hall.tell("hello", exclude_living=rat)
+        pubsub.sync()
+        self.assertEqual(["roommsg"], rat.messages)
+        self.assertEqual(["hello"], collector.messages)
+        self.assertEqual(["hello"], room_collector.messages)
+        self.assertEqual(["hello\n"], julie.test_get_output_paragraphs())
+        # renaming gives a different wiretap topic
+        cat.name = "kitty"
+        hall.tell("meow")
+        pubsub.sync()
+        self.assertEqual(["hello"], collector.messages)
+        self.assertEqual(["hello", "meow"], room_collector.messages)
+
     def test_message_nearby_location(self):
         plaza = Location("plaza")
         road = Location("road")
@@ -240,6 +269,65 @@ class TestLocations(unittest.TestCase):
         self.assertEqual({"xywobble", "snakeverb", "frobnitz", "kowabooga", "boxverb", "exitverb"}, set(custom_verbs))
         self.assertEqual(set(), set(custom_verbs) - set(all_verbs))
 
+    def test_custom_verbs_index(self):
+        player = Player("julie", "f")
+        room = Location("room")
+        room2 = Location("room2")
+        chair = Item("chair")
+        chair.verbs["sit"] = "sit down"
+        box = Item("box")
+        monster = Living("snake", "f")
+        room.init_inventory([player, chair, box, monster])
+        self.assertEqual({"sit"}, set(mud_context.driver.current_custom_verbs(player)))
+        box.verbs["open"] = "open the box"      # changed after it was put in the room
+        monster.verbs = {"pet": "pet the snake"}
+        self.assertEqual({"sit", "open", "pet"}, set(mud_context.driver.current_custom_verbs(player)))
+        lookup = mud_context.driver.custom_verbs_lookup(player)
+        self.assertIn("open", lookup)
+        self.assertNotIn("dance", lookup)
+        box.move(player, player)
+        self.assertEqual("open the box", mud_context.driver.current_custom_verbs(player)["open"])
+        del box.verbs["open"]
+        chair.move(room2, player)
+        monster.move(room2)
+        self.assertEqual({}, mud_context.driver.current_custom_verbs(player))
+        exit = Exit("north", room2, "a door to the north")
+        exit.verbs["knock"] = "knock on the door"
+        room.add_exits([exit])
+        self.assertEqual({"knock"}, set(mud_context.driver.current_custom_verbs(player)))
+        exit.verbs.clear()
+        self.assertFalse(mud_context.driver.custom_verbs_lookup(player))
+        monster.destroy(Context(mud_context.driver, None, None, None))
+        self.assertNotIn("pet", room2._verb_index.verbs)
+
+    def test_names_index(self):
+        room = Location("room")
+        gem = Item("gem")
+        gem.aliases = {"red gem", "red ruby gem"}
+        cat = Living("cat", "f")
+        room.init_inventory([gem, cat])
+        livings, items = room._name_indexes()
+        self.assertEqual({"gem", "red gem", "red ruby gem"}, set(items))
+        self.assertIs(gem, items.get("red gem"))
+        self.assertEqual(2, items.match(["red", "gem", "here"], 0))
+        self.assertEqual(3, items.match(["the", "red", "ruby", "gem"], 1))
+        self.assertEqual(0, items.match(["the", "red", "ruby", "gem"], 1, maxwords=2))
+        self.assertEqual(0, items.match(["red", "ruby"], 0))
+        gem.aliases -= {"red gem"}
+        self.assertEqual(3, items.match(["red", "ruby", "gem"], 0))
+        self.assertEqual(0, items.match(["red", "gem"], 0))
+        cat.name = "tiger"
+        self.assertEqual({"tiger"}, set(livings))
+        gem.move(cat, cat)
+        self.assertFalse(items)
+        self.assertEqual({}, items.trie)
+        self.assertIs(gem, cat._item_names.get("red ruby gem"))
+        room.items = {Item("pebble")}
+        self.assertEqual({"pebble"}, set(room._name_indexes()[1]))
+        cat.destroy(Context(mud_context.driver, None, None, None))
+        self.assertFalse(room._name_indexes()[0])
+        self.assertFalse(cat._item_names)
+
     def test_notify(self):
         room = Location("room")
         room2 = Location("room2")
@@ -1265,6 +1353,45 @@ class TestMudObject(unittest.TestCase):
         p.story_data["test"] = 42
         self.assertEqual({"test": 42}, p.story_data)
 
+    def test_dirty(self):
+        loc = Location("hall")
+        thing = Item("thing")
+        box = Container("box")
+        self.assertTrue(loc._dirty and thing._dirty and box._dirty, "new objects should be dirty")
+        loc._dirty = thing._dirty = box._dirty = False
+        self.assertFalse(loc._dirty or thing._dirty or box._dirty, "private attributes shouldn't make it dirty")
+        thing.title = "other thing"
+        self.assertTrue(thing._dirty)
+        thing._dirty = False
+        loc.insert(thing, None)
+        self.assertTrue(loc._dirty)
+        self.assertTrue(thing._dirty)
+        loc._dirty = thing._dirty = False
+        loc.remove(thing, None)
+        box.insert(thing, None)
+        self.assertTrue(loc._dirty and thing._dirty and box._dirty)
+        box._dirty = False
+        box.aliases.add("crate")
+        self.assertTrue(box._dirty)
+        box._dirty = False
+        box.verbs["open"] = "open it"
+        self.assertTrue(box._dirty)
+        box._dirty = False
+        box.story_data["opened"] = True
+        self.assertFalse(box._dirty, "in-place changes aren't tracked")
+        box.value = 42
+        self.assertFalse(box._dirty, "plain attributes aren't tracked")
+        box.mark_dirty()
+        self.assertTrue(box._dirty)
+        other = Location("other")
+        loc._dirty = False
+        Exit.connect(loc, "north", "", None, other, "south", "", None)
+        self.assertTrue(loc._dirty)
+        door1, door2 = Door.connect(loc, "east", "", None, other, "west", "", None, opened=False)
+        door1._dirty = door2._dirty = False
+        door1.open(Living("julie", "f"))
+        self.assertTrue(door1._dirty and door2._dirty)
+
 
 if __name__ == '__main__':
     unittest.main()
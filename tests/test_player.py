@@ -8,13 +8,14 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 import pathlib
 import sys
 import tempfile
+import threading
 import time
 import unittest
 from io import StringIO
 
 import tale
 from tale import races, pubsub, mud_context
-from tale.accounts import MudAccounts
+from tale.accounts import MudAccounts, AccountService, LegacySha1Hasher, Pbkdf2Hasher, ScryptHasher, hasher_for
 from tale.base import Location, Exit, Item, Stats, Living, ParseResult
 from tale.charbuilder import IFCharacterBuilder, MudCharacterBuilder, ValidRaceValidator, PlayerNaming
 from tale.demo.story import Story as DemoStory
@@ -752,6 +753,97 @@ class TestMudAccounts(unittest.TestCase):
         self.assertEqual(pw, pw2)
         self.assertEqual(salt, salt2)
 
+    def test_hashers(self):
+        hasher = Pbkdf2Hasher(1000)
+        pwhash = hasher.hash("secret", "salt")
+        self.assertTrue(pwhash.startswith("pbkdf2_sha256$1000$"))
+        self.assertTrue(hasher.verify("secret", "salt", pwhash))
+        self.assertFalse(hasher.verify("secret2", "salt", pwhash))
+        self.assertFalse(hasher.verify("secret", "salt2", pwhash))
+        self.assertFalse(hasher.needs_rehash(pwhash))
+        self.assertTrue(Pbkdf2Hasher(2000).needs_rehash(pwhash))
+        self.assertEqual(1000, hasher_for(pwhash).iterations)
+        legacy = LegacySha1Hasher().hash("secret", "salt")
+        self.assertEqual(40, len(legacy))
+        self.assertIsInstance(hasher_for(legacy), LegacySha1Hasher)
+        self.assertTrue(hasher.needs_rehash(legacy))
+        self.assertNotEqual(hasher.make_salt(), hasher.make_salt())
+        with self.assertRaises(ValueError):
+            hasher_for("md5$$0123456789")
+        try:
+            hasher = ScryptHasher(n=2**10)
+        except RuntimeError:
+            pass    # scrypt not available
+        else:
+            pwhash = hasher.hash("secret", "salt")
+            self.assertTrue(pwhash.startswith("scrypt$1024,8,1$"))
+            self.assertTrue(hasher_for(pwhash).verify("secret", "salt", pwhash))
+            self.assertTrue(Pbkdf2Hasher().needs_rehash(pwhash))
+
+    def test_rehash_on_login(self):
+        dbfile = pathlib.Path(tempfile.gettempdir()) / "tale_test_accdb_{0:f}.sqlite".format(time.time())
+        try:
+            accounts = MudAccounts(str(dbfile), LegacySha1Hasher())
+            account = accounts.create("testname", "s3cr3t", "test@invalid", Stats.from_race("elf", gender='f'), set())
+            self.assertEqual(40, len(account.pw_hash))
+            accounts.close()
+            accounts = MudAccounts(str(dbfile), Pbkdf2Hasher(1000))
+            accounts.valid_password("testname", "s3cr3t")
+            self.assertTrue(accounts.get("testname").pw_hash.startswith("pbkdf2_sha256$1000$"), "legacy hash should be migrated")
+            with self.assertRaises(ValueError):
+                accounts.valid_password("testname", "wrong")
+            accounts.valid_password("testname", "s3cr3t")
+            accounts.hasher = Pbkdf2Hasher(1001)
+            accounts.valid_password("testname", "s3cr3t")
+            self.assertTrue(accounts.get("testname").pw_hash.startswith("pbkdf2_sha256$1001$"), "changed cost should be migrated")
+            with self.assertRaises(ValueError):
+                accounts.valid_password("unknown", "s3cr3t")
+        finally:
+            accounts.close()
+            dbfile.unlink()
+
+    def test_write_behind(self):
+        dbfile = pathlib.Path(tempfile.gettempdir()) / "tale_test_accdb_{0:f}.sqlite".format(time.time())
+        journal = pathlib.Path(str(dbfile) + ".writebehind")
+        try:
+            accounts = MudAccounts(str(dbfile), Pbkdf2Hasher(1000), flush_interval=60)
+            accounts.create("testname", "s3cr3t", "test@invalid", Stats.from_race("elf", gender='f'), set())
+            self.assertFalse(accounts.flush_due())
+            accounts.save_story_data("testname", {"score": 1})
+            accounts.save_story_data("testname", {"score": 2})
+            accounts.logged_in("testname")
+            with self.assertRaises(LookupError):
+                accounts.save_story_data("unknown", {})
+            metrics = accounts.write_metrics()
+            self.assertEqual(1, metrics["dirty"])
+            self.assertEqual(3, metrics["writes"])
+            self.assertEqual(1, metrics["coalesced"])
+            self.assertGreater(metrics["journal_size"], 0)
+            self.assertTrue(journal.exists())
+            account = accounts.get("testname")
+            self.assertEqual({"score": 2}, account.story_data, "pending writes should be visible")
+            self.assertIsNotNone(account.logged_in)
+            self.assertFalse(accounts.flush_due())
+            self.assertTrue(accounts.flush_due(time.time() + 61))
+            self.assertEqual(1, accounts.flush())
+            metrics = accounts.write_metrics()
+            self.assertEqual(0, metrics["dirty"])
+            self.assertEqual(1, metrics["flushes"])
+            self.assertEqual(0, metrics["journal_size"])
+            self.assertEqual(0, accounts.flush())
+            # the server 'crashes' with a pending write, the journal is replayed when the accounts are opened again
+            accounts.save_story_data("testname", {"score": 3})
+            accounts2 = MudAccounts(str(dbfile), Pbkdf2Hasher(1000))
+            self.assertFalse(journal.exists())
+            self.assertEqual(0, accounts2.write_metrics()["dirty"])
+            self.assertEqual({"score": 3}, accounts2.get("testname").story_data)
+            self.assertEqual(account.logged_in, accounts2.get("testname").logged_in)
+            accounts2.close()
+        finally:
+            accounts.close()
+            self.assertFalse(journal.exists())
+            dbfile.unlink()
+
     def test_accountcreate_fail(self):
         stats = Stats()  # uninitialized stats
         accounts = MudAccounts(":memory:")
@@ -782,6 +874,7 @@ class TestMudAccounts(unittest.TestCase):
             account = accounts.get("testname")
             self.assertFalse(account.banned)
         finally:
+            accounts.close()
             dbfile.unlink()
 
     def test_dbcreate(self):
@@ -803,6 +896,7 @@ class TestMudAccounts(unittest.TestCase):
             self.assertEqual(races.BodySize.HUMAN_SIZED, account.stats.size)
             self.assertEqual("Edhellen", account.stats.language)
         finally:
+            accounts.close()
             dbfile.unlink()
 
     def test_storydata(self):
@@ -820,6 +914,58 @@ class TestMudAccounts(unittest.TestCase):
             account = accounts.get("testname")
             self.assertEqual({"test": 42, "thing": [1.2, 3.4]}, account.story_data)
         finally:
+            accounts.close()
+            dbfile.unlink()
+
+    def test_privileges_and_wizard(self):
+        dbfile = pathlib.Path(tempfile.gettempdir()) / "tale_test_accdb_{0:f}.sqlite".format(time.time())
+        wizard = Living("wizz", gender="f")
+        wizard.privileges.add("wizard")
+        try:
+            accounts = MudAccounts(str(dbfile))
+            self.assertFalse(accounts.has_wizard())
+            accounts.create("testname", "s3cr3t", "test@invalid", Stats.from_race("elf", gender='f'), set())
+            accounts.create("othername", "s3cr3t", "test@invalid", Stats.from_race("human", gender='m'), set())
+            self.assertFalse(accounts.has_wizard())
+            self.assertEqual([], accounts.all_accounts(having_privilege="wizard"))
+            accounts.update_privileges("testname", {"wizard"}, wizard)
+            self.assertTrue(accounts.has_wizard(), "cached flag must be invalidated")
+            self.assertEqual(["testname"], [account.name for account in accounts.all_accounts(having_privilege="wizard")])
+            all_accounts = accounts.all_accounts()
+            self.assertEqual(["othername", "testname"], [account.name for account in all_accounts])
+            self.assertEqual([set(), {"wizard"}], [account.privileges for account in all_accounts])
+            self.assertEqual(["m", "f"], [account.stats.gender for account in all_accounts])
+            accounts.update_privileges("testname", set(), wizard)
+            self.assertFalse(accounts.has_wizard())
+            # every thread gets its own connection to the database
+            result = []
+            thread = threading.Thread(target=lambda: result.append(accounts.get("testname").name))
+            thread.start()
+            thread.join()
+            self.assertEqual(["testname"], result)
+        finally:
+            accounts.close()
+            dbfile.unlink()
+
+    def test_account_service(self):
+        dbfile = pathlib.Path(tempfile.gettempdir()) / "tale_test_accdb_{0:f}.sqlite".format(time.time())
+        try:
+            accounts = MudAccounts(str(dbfile))
+            service = AccountService(accounts)
+            service.create("testname", "s3cr3t", "test@invalid", Stats.from_race("elf", gender='f'), set()).result()
+            story_data = {"score": 42}
+            future = service.save_story_data("testname", story_data)
+            story_data["score"] = 99   # the data that is saved is a copy
+            future.result()
+            self.assertEqual({"score": 42}, service.get("testname").result().story_data)
+            service.valid_password("testname", "s3cr3t").result()
+            with self.assertRaises(ValueError):
+                service.valid_password("testname", "wrong").result()
+            with self.assertRaises(LookupError):
+                service.get("unknown").result()
+            service.shutdown()
+        finally:
+            accounts.close()
             dbfile.unlink()
 
 
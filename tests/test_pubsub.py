@@ -6,9 +6,11 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
 import gc
+import json
 import time
 import unittest
 
+from tale import pubsub
 from tale.pubsub import topic, unsubscribe_all, Listener, sync, pending
 
 
@@ -180,11 +182,105 @@ class TestPubsub(unittest.TestCase):
     def test_idletime(self):
         sync()
         s = topic("testA")
+        subber = Subber("sub1")
+        s.subscribe(subber)
         self.assertLess(s.idle_time, 0.1)
         time.sleep(0.2)
         self.assertGreater(s.idle_time, 0.1)
         s.send("event")
         self.assertLess(s.idle_time, 0.1)
+        time.sleep(0.2)
+        sync()
+        self.assertLess(s.idle_time, 0.1)
+
+    def test_lazy_registration(self):
+        s = topic("lazy")
+        self.assertNotIn("lazy", pubsub.all_topics)
+        self.assertIsNone(s.send("nobody listens"))
+        self.assertEqual([], s.send("nobody listens", True))
+        self.assertEqual([], s.events, "sending without subscribers is a no-op")
+        subber = Subber("sub1")
+        s.subscribe(subber)
+        self.assertIs(s, pubsub.all_topics["lazy"])
+        s.send("event")
+        self.assertEqual(["sub1"], sync("lazy"))
+        self.assertEqual([("lazy", "event")], subber.messages)
+        s.unsubscribe(subber)
+        self.assertEqual([], sync("no-such-topic"))
+
+    def test_expire_idle(self):
+        old_expiry = pubsub.IDLE_EXPIRY
+        pubsub.IDLE_EXPIRY = -1
+        try:
+            s = topic("expiring")
+            subber = Subber("sub1")
+            s.subscribe(subber)
+            s2 = topic("expiring-gc")
+            subber2 = Subber("sub2")
+            s2.subscribe(subber2)
+            pubsub.expire_idle()
+            self.assertIs(s, pubsub.all_topics["expiring"])
+            self.assertIs(s2, pubsub.all_topics["expiring-gc"])
+            s.unsubscribe(subber)
+            del subber2
+            gc.collect()
+            self.assertEqual(set(), s2.subscribers)
+            pubsub.expire_idle()
+            self.assertNotIn("expiring", pubsub.all_topics)
+            self.assertNotIn("expiring-gc", pubsub.all_topics)
+            self.assertIs(s, topic("expiring"), "topic object remains valid after expiry")
+            s.subscribe(subber)
+            s.send("again", True)
+            self.assertEqual([("expiring", "again")], subber.messages)
+            self.assertIs(s, pubsub.all_topics["expiring"])
+        finally:
+            pubsub.IDLE_EXPIRY = old_expiry
+
+
+class TestMetrics(unittest.TestCase):
+    def tearDown(self):
+        pubsub.enable_metrics(False)
+
+    def test_histogram(self):
+        h = pubsub.Histogram([1, 2, 4, 8])
+        self.assertEqual(0.0, h.mean)
+        self.assertEqual(0.0, h.percentile(50))
+        for value in [1, 1, 1, 3, 100]:
+            h.add(value)
+        self.assertEqual([3, 0, 1, 0, 1], h.counts)
+        self.assertEqual(5, h.count)
+        self.assertEqual(106, h.total)
+        self.assertEqual(100, h.maximum)
+        self.assertEqual(1, h.percentile(50))
+        self.assertEqual(4, h.percentile(80))
+        self.assertEqual(100, h.percentile(99))
+        d = h.as_dict()
+        self.assertEqual([[1, 3], [2, 0], [4, 1], [8, 0], [None, 1]], d["buckets"])
+        self.assertEqual(21.2, d["mean"])
+
+    def test_metrics(self):
+        self.assertEqual({"enabled": False}, pubsub.metrics_dump())
+        s = topic(("metrics", 42))
+        s.send("not recorded")
+        pubsub.enable_metrics()
+        subber = Subber("sub1")
+        s.send("dropped")
+        s.subscribe(subber)
+        s.send("one")
+        s.send("two")
+        sync()
+        s.send("three", True)
+        dump = pubsub.metrics_dump()
+        self.assertTrue(dump["enabled"])
+        info = dump["topics"]["metrics:42"]
+        self.assertEqual(4, info["published"])
+        self.assertEqual(1, info["dropped"])
+        self.assertEqual(2, info["batch_sizes"]["count"])
+        self.assertEqual(2, info["batch_sizes"]["max"])
+        self.assertEqual(3, info["listeners"]["tests.test_pubsub.Subber"]["count"])
+        json.dumps(dump)
+        pubsub.enable_metrics()
+        self.assertEqual({}, pubsub.metrics_dump()["topics"], "enabling again starts fresh")
 
 
 if __name__ == '__main__':
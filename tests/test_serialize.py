@@ -4,20 +4,24 @@ Unit tests for serialization
 'Tale' mud driver, mudlib and interactive fiction framework
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
+import gzip
 import os
 import unittest
 import datetime
 
+import serpent
+
 from tale import mud_context, races, base, player, util, driver
+from tale.errors import TaleError
 from tale.items import basic, bank, board
 from tale.story import *
-from tale.savegames import TaleSerializer, TaleDeserializer
+from tale.savegames import TaleSerializer, TaleDeserializer, BinaryEncoder, BinaryDecoder
 
 from tests.supportstuff import FakeDriver, Thing
 
 
-def serializecycle(obj):
-    ser = TaleSerializer()
+def serializecycle(obj, format="serpent"):
+    ser = TaleSerializer(format)
     deser = TaleDeserializer()
     p = player.Player("julie", "f")
     data = ser.serialize(None, p, [obj], [], [], [], [], None)
@@ -32,13 +36,18 @@ def module_level_func(ctx):
 
 
 class TestSerializing(unittest.TestCase):
+    savegame_format = "serpent"
+
     def setUp(self):
         mud_context.driver = FakeDriver()
         mud_context.config = StoryConfig()
         mud_context.resources = mud_context.driver.resources
 
+    def serializecycle(self, obj):
+        return serializecycle(obj, self.savegame_format)
+
     def test_fundamentals(self):
-        o = serializecycle(races.races)
+        o = self.serializecycle(races.races)
         assert len(races.races) == len(o)
         assert "golem" in o
         o = base.Item("name", "title", descr="description", short_descr="short description")
@@ -51,7 +60,7 @@ class TestSerializing(unittest.TestCase):
         o.weight = 123.0
         loc = base.Location("location")
         loc.insert(o, None)
-        x = serializecycle(o)
+        x = self.serializecycle(o)
         assert isinstance(x, dict)
         assert x["__base_class__"] == "tale.base.Item"
         assert x["__class__"] == "tale.base.Item"
@@ -76,7 +85,7 @@ class TestSerializing(unittest.TestCase):
         o.aliases = ["alias1"]
         bag = base.Container("name2", "title2", descr="description2")
         bag.insert(o, None)
-        x = serializecycle(bag)
+        x = self.serializecycle(bag)
         x_inv = x["inventory"]
         assert isinstance(x_inv, set)
         assert len(x_inv) == 1
@@ -86,11 +95,11 @@ class TestSerializing(unittest.TestCase):
         assert x_contained[1] == 'name1'
         assert x_contained[2] == 'tale.base.Item'
         assert x_contained[3] == 'tale.base.Item'
-        x = serializecycle(o)
+        x = self.serializecycle(o)
         assert "inventory" not in x
         assert "location" not in x and "contained_in" not in x, "item is referenced from its location instead"
         o = base.Armour("a")
-        x = serializecycle(o)
+        x = self.serializecycle(o)
         assert x["__class__"] == "tale.base.Armour"
         assert x["__base_class__"] == "tale.base.Item"
 
@@ -100,7 +109,7 @@ class TestSerializing(unittest.TestCase):
         room.insert(thing, None)
         npc = base.Living("dog", "m")
         room.insert(npc, None)
-        x = serializecycle(room)
+        x = self.serializecycle(room)
         assert x["__class__"] == "tale.base.Location"
         assert x["name"] == "room"
         assert x["descr"] == "description"
@@ -123,7 +132,7 @@ class TestSerializing(unittest.TestCase):
         exit2 = base.Exit("room", room, "back to room")
         room.add_exits([exit1])
         room2.add_exits([exit2])
-        x1, x2 = serializecycle([room, room2])
+        x1, x2 = self.serializecycle([room, room2])
         assert len(x1["exits"]) == 1
         assert isinstance(x1["exits"], set)
         assert len(x2["exits"]) == 1
@@ -142,7 +151,7 @@ class TestSerializing(unittest.TestCase):
     def test_exits_and_doors(self):
         o = base.Exit("east", "target", "somewhere")
         o.enter_msg = "you enter a dark hallway"
-        x = serializecycle(o)
+        x = self.serializecycle(o)
         assert x["__class__"] == "tale.base.Exit"
         assert x["_target_str"] == "target"
         assert x["target"] is None or x["target"][1] == "Limbo"
@@ -154,7 +163,7 @@ class TestSerializing(unittest.TestCase):
         o = base.Door("east", "target", "somewhere", locked=True, opened=False, key_code="123")
         o.enter_msg = "going through"
         assert o.description == "somewhere It is closed and locked."
-        x = serializecycle(o)
+        x = self.serializecycle(o)
         assert x["__class__"] == "tale.base.Door"
         assert x["_target_str"] == "target"
         assert x["target"] is None or x["target"][1] == "Limbo"
@@ -173,13 +182,13 @@ class TestSerializing(unittest.TestCase):
         room1 = base.Location("room1")
         room2 = base.Location("room2")
         e1, e2 = base.Exit.connect(room1, "room2", "to room 2", None, room2, "room1", "to room 1", None)
-        x = serializecycle(e1)
+        x = self.serializecycle(e1)
         assert x["_target_str"] == ""
         assert len(x["target"]) == 4
         assert x["target"][0] > 1
         assert x["target"][1] == "room2"
         assert x["target"][2] == x["target"][3] == "tale.base.Location"
-        x = serializecycle(e2)
+        x = self.serializecycle(e2)
         assert x["_target_str"] == ""
         assert len(x["target"]) == 4
         assert x["target"][0] > 1
@@ -190,7 +199,7 @@ class TestSerializing(unittest.TestCase):
         room1 = base.Location("room1")
         room2 = base.Location("room2")
         d1, d2 = base.Door.connect(room1, "room2", "to room 2", None, room2, "room1", "to room 1", None)
-        x = serializecycle(d1)
+        x = self.serializecycle(d1)
         assert x["_target_str"] == ""
         assert len(x["target"]) == 4
         assert x["target"][0] > 1
@@ -201,7 +210,7 @@ class TestSerializing(unittest.TestCase):
         assert x["linked_door"][1] == "room1"
         assert x["linked_door"][2] == "tale.base.Door"
         assert x["linked_door"][3] == "tale.base.Exit"
-        x = serializecycle(d2)
+        x = self.serializecycle(d2)
         assert x["_target_str"] == ""
         assert len(x["target"]) == 4
         assert x["target"][0] > 1
@@ -229,7 +238,7 @@ class TestSerializing(unittest.TestCase):
         o.stats.attack_dice = "2d8"
         o.stats.level = 12
         o.stats.hp = 100
-        x = serializecycle(o)
+        x = self.serializecycle(o)
         assert x["__class__"] == "tale.base.Living"
         assert x["aggressive"] == True
         assert len(x["following"]) == 4
@@ -246,7 +255,7 @@ class TestSerializing(unittest.TestCase):
         assert s["attack_dice"] == "2d8"
         assert s["level"] == 12
         assert s["hp"] == 100
-        x = serializecycle(p)
+        x = self.serializecycle(p)
         assert x["__class__"] == x["__base_class__"] == "tale.player.Player"
         assert x["brief"] == True
         assert x["location"][1] == "Limbo"
@@ -266,7 +275,7 @@ class TestSerializing(unittest.TestCase):
         s.server_mode = GameMode.IF
         s.display_gametime = True
         s.name = "test"
-        x = serializecycle(s)
+        x = self.serializecycle(s)
         assert x["__class__"] == "tale.story.StoryConfig"
         assert x["gametime_to_realtime"] == 1
         assert x["display_gametime"] == True
@@ -277,7 +286,7 @@ class TestSerializing(unittest.TestCase):
     def test_context(self):
         c = util.Context.from_global(player_connection=42)
         with self.assertRaises(RuntimeError) as x:
-            serializecycle(c)
+            self.serializecycle(c)
         self.assertTrue(str(x.exception).startswith("cannot serialize context"))
 
     def test_deferreds(self):
@@ -288,8 +297,9 @@ class TestSerializing(unittest.TestCase):
                      driver.Deferred(now, os.getcwd, [], None),
                      driver.Deferred(now, module_level_func, [], None),
                      driver.Deferred(now, item.init, [], None, periodical=(11.1, 22.2))]
-        x1, x2, x3, x4 = serializecycle(deferreds)
+        x1, x2, x3, x4 = self.serializecycle(deferreds)
         assert x1["__class__"] == "tale.driver.Deferred"
+        assert "_resolved" not in x1
         assert x1["action"] == "append"
         assert x1["vargs"] == [1, 2, 3]
         assert x1["kwargs"] == {"kwarg": 42}
@@ -309,7 +319,7 @@ class TestSerializing(unittest.TestCase):
         b = bank.Bank("atm")
         b.accounts["test"] = 55
         b.transaction_log.append("transaction: $10")
-        x = serializecycle(b)
+        x = self.serializecycle(b)
         assert x["__class__"] == "tale.items.bank.Bank"
         assert x["__base_class__"] == "tale.base.Item"
         assert x["accounts"] == {"test": 55}
@@ -322,7 +332,7 @@ class TestSerializing(unittest.TestCase):
 
     def test_money(self):
         m = basic.Money("cash", 987.65)
-        x = serializecycle(m)
+        x = self.serializecycle(m)
         assert x["__class__"] == "tale.items.basic.Money"
         assert x["__base_class__"] == "tale.base.Item"
         assert x["title"] == "pile of money"
@@ -335,7 +345,7 @@ class TestSerializing(unittest.TestCase):
         c.aliases = {"weapon"}
         c.story_data = {"force": 99}
         c.verbs = {"shoot": "fire the weapon"}
-        x = serializecycle(c)
+        x = self.serializecycle(c)
         assert x["__class__"] == "tale.items.basic.Catapult"
         assert x["__base_class__"] == "tale.base.Item"
         assert x["aliases"] == {"weapon"}
@@ -349,7 +359,7 @@ class TestSerializing(unittest.TestCase):
         c = board.BulletinBoard("board")
         c.posts = {"post1": "hey there"}
         c.dummy = "dummyvalue"
-        x = serializecycle(c)
+        x = self.serializecycle(c)
         assert x["__class__"] == "tale.items.board.BulletinBoard"
         assert x["__base_class__"] == "tale.base.Item"
         assert x["descr"].startswith("\nThere's a message on it")
@@ -363,6 +373,207 @@ class TestSerializing(unittest.TestCase):
         assert "posts" not in x, "default serpent doesn't serialize properties"
         assert x["dummy"] == "dummyvalue"
 
+    def test_incremental(self):
+        room1 = base.Location("room1")
+        room2 = base.Location("room2")
+        exits = list(base.Exit.connect(room1, "room2", "to room 2", None, room2, "room1", "to room 1", None))
+        bag = base.Container("bag")
+        thing = base.Item("thing")
+        coin = base.Item("coin")
+        bag.init_inventory([thing])
+        room1.init_inventory([bag, coin])
+        p = player.Player("playername", "n", descr="description")
+        p.move(room1, silent=True)
+        rat = base.Living("rat", "m")
+        rat.move(room2, silent=True)
+        clock = util.GameDateTime(datetime.datetime.now())
+
+        def world():
+            items = [i for i in [bag, thing, coin] if i.contained_in]
+            return StoryConfig(), p, items, [rat], [room1, room2], exits, [], clock
+
+        serializer = TaleSerializer(self.savegame_format)
+        states = {}
+        full = serializer.serialize(*world(), savegame_id="abc", states=states)
+        for obj in [bag, thing, coin, room1, room2, base._limbo] + exits:
+            obj._dirty = False
+        thing.title = "shiny thing"
+        self.assertTrue(thing._dirty)
+        self.assertFalse(coin._dirty)
+        rat.aggressive = True
+        delta1 = serializer.serialize_delta(*world(), savegame_id="abc", number=1, states=states)
+        for obj in [bag, thing, coin, room1, room2, base._limbo] + exits:
+            obj._dirty = False
+        bag.remove(thing, None)
+        room2.insert(thing, None)
+        room1.remove(coin, None)
+        delta2 = serializer.serialize_delta(*world(), savegame_id="abc", number=2, states=states)
+        delta_state = TaleDeserializer().deserialize(delta2)
+        self.assertEqual(["bag", "thing"], sorted(i["name"] for i in delta_state["items"]), "only changed items should be in the delta")
+        self.assertEqual([], delta_state["exits"])
+        expected = TaleDeserializer().deserialize(serializer.serialize(*world()))
+        state, savegame_id, applied = TaleDeserializer().deserialize_incremental(full, [delta1, delta2])
+        self.assertEqual("abc", savegame_id)
+        self.assertEqual(2, applied)
+        self.assertEqual(set(expected), set(state))
+        for key in expected:
+            if isinstance(expected[key], list):
+                self.assertEqual(sorted(expected[key], key=lambda d: d["vnum"]), sorted(state[key], key=lambda d: d["vnum"]), key)
+            else:
+                self.assertEqual(expected[key], state[key], key)
+        # a delta from another save is ignored, and so are the deltas after it
+        other = serializer.serialize_delta(*world(), savegame_id="xyz", number=2, states={})
+        state, savegame_id, applied = TaleDeserializer().deserialize_incremental(full, [delta1, other, delta2])
+        self.assertEqual(1, applied)
+        state, savegame_id, applied = TaleDeserializer().deserialize_incremental(full, [delta2])
+        self.assertEqual(0, applied)
+
+    def test_incremental_plain_attributes(self):
+        room1 = base.Location("room1")
+        room2 = base.Location("room2")
+        d1, d2 = base.Door.connect(room1, "room2", "door to room 2", None, room2, "room1", "door to room 1", None, locked=True)
+        thing = base.Item("thing")
+        room1.init_inventory([thing])
+        p = player.Player("playername", "n")
+        p.move(room1, silent=True)
+        clock = util.GameDateTime(datetime.datetime.now())
+        world = (StoryConfig(), p, [thing], [], [room1, room2], [d1, d2], [], clock)
+        serializer = TaleSerializer(self.savegame_format)
+        states = {}
+        full = serializer.serialize(*world, savegame_id="abc", states=states)
+        for obj in [thing, room1, room2, base._limbo, d1, d2]:
+            obj._dirty = False
+        # plain attribute assignments, nothing marks these objects as changed
+        thing.value = 42.0
+        d1.locked = False
+        delta = serializer.serialize_delta(*world, savegame_id="abc", number=1, states=states)
+        delta_state = TaleDeserializer().deserialize(delta)
+        self.assertEqual(["thing"], [i["name"] for i in delta_state["items"]])
+        self.assertEqual([d1.vnum], [e["vnum"] for e in delta_state["exits"]])
+        state, savegame_id, applied = TaleDeserializer().deserialize_incremental(full, [delta])
+        self.assertEqual(1, applied)
+        self.assertEqual(42.0, state["items"][0]["value"])
+        self.assertFalse(next(e for e in state["exits"] if e["vnum"] == d1.vnum)["locked"])
+        self.assertTrue(next(e for e in state["exits"] if e["vnum"] == d2.vnum)["locked"])
+
+    def test_snapshot(self):
+        room = base.Location("room")
+        thing = base.Item("thing")
+        thing.story_data = {"list": [1, 2], "when": datetime.date(2017, 1, 2)}
+        room.init_inventory([thing])
+        p = player.Player("playername", "n")
+        p.move(room, silent=True)
+        clock = util.GameDateTime(datetime.datetime.now())
+        serializer = TaleSerializer(self.savegame_format)
+        world = (StoryConfig(), p, [thing], [], [room], [], [], clock)
+        expected = TaleDeserializer().deserialize(serializer.serialize(*world))
+        previous = {}
+        snapshot = serializer.snapshot(serializer.savegame_state(*world), previous)
+        self.assertIn(thing.vnum, previous)
+        thing.story_data["list"].append(3)
+        thing.title = "changed"
+        self.assertEqual(expected, TaleDeserializer().deserialize(serializer.encode(snapshot)), "snapshot must not share the data")
+        thing._dirty = False
+        changed = []
+        snapshot = serializer.snapshot(serializer.savegame_state(*world), previous, changed)
+        self.assertEqual("changed", snapshot["items"][0]["title"], "the state must be computed again, also for clean objects")
+        self.assertEqual([1, 2, 3], snapshot["items"][0]["story_data"]["list"])
+        self.assertEqual([thing], changed)
+        changed = []
+        snapshot2 = serializer.snapshot(serializer.savegame_state(*world), previous, changed)
+        self.assertIs(snapshot["items"][0], snapshot2["items"][0], "unchanged objects should reuse their previous state")
+        self.assertEqual([], changed)
+
+    def test_obfuscate(self):
+        data = bytes(range(256)) * 4
+        obfuscated = TaleSerializer(self.savegame_format).obfuscate(data)
+        self.assertTrue(obfuscated.startswith(b"TALESAVE1"))
+        self.assertEqual(data, gzip.decompress(bytes(b ^ 0x5c for b in obfuscated[9:])), "existing save files must still load")
+        self.assertEqual(data, TaleDeserializer().deobfuscate(obfuscated))
+
+    def test_world_state(self):
+        room = base.Location("room")
+        thing = base.Item("thing")
+        gem = base.Item("gem")
+        room.init_inventory([thing])
+        p = player.Player("playername", "n")
+        p.move(room, silent=True)
+        p.insert(gem, p)
+        dog = base.Living("dog", "m")
+        dog.move(room, silent=True)
+        dog.following = p
+        clock = util.GameDateTime(datetime.datetime.now())
+        with self.assertRaises(TaleError):
+            TaleSerializer(self.savegame_format).world_state(StoryConfig(), [thing], [dog], [room], [], [], clock)
+        serializer = TaleSerializer(self.savegame_format, exclude_players=True)
+        state = TaleDeserializer().deserialize(serializer.encode(serializer.world_state(StoryConfig(), [thing], [dog, p], [room], [],
+                                                                                        [], clock)))
+        self.assertNotIn("player", state)
+        self.assertEqual(["dog"], [living["name"] for living in state["livings"]])
+        self.assertIsNone(state["livings"][0]["following"])
+        self.assertEqual(["thing"], [item["name"] for item in state["items"]])
+        room_state = next(loc for loc in state["locations"] if loc["vnum"] == room.vnum)
+        self.assertEqual([dog.vnum], [ref[0] for ref in room_state["livings"]])
+
 
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestBinarySerializing(TestSerializing):
+    savegame_format = "binary"
+
+    def test_same_as_serpent(self):
+        room1 = base.Location("room1")
+        room2 = base.Location("room2")
+        exits = list(base.Door.connect(room1, "room2", "to room 2", None, room2, "room1", "to room 1", None))
+        p = player.Player("playername", "n", descr="description")
+        p.move(room1, silent=True)
+        p.insert(basic.Money("money", 12.5), None)
+        bag = base.Container("bag")
+        bag.insert(base.Item("thing"), None)
+        room1.insert(bag, None)
+        dragon = base.Living("dragon", "f", race="dragon")
+        dragon.following = p
+        dragon.story_data = {"numbers": [1, -2, 300, 2**70, -2**40, 1.5, float("inf")], "empty": set(), "nested": {(1, 2): "é"}}
+        dragon.move(room2, silent=True)
+        now = datetime.datetime.now()
+        deferreds = [driver.Deferred(now, dragon.init, [], {"kwarg": 42}, periodical=(11.1, 22.2))]
+        clock = util.GameDateTime(now, 5)
+        items = list(p.inventory) + [bag] + list(bag.inventory)
+        data = []
+        for format in ("serpent", "binary"):
+            saved = TaleSerializer(format).serialize(StoryConfig(), p, items, [dragon], [room1, room2], exits, deferreds, clock)
+            data.append(TaleDeserializer().deserialize(saved))
+        self.assertEqual(data[0], data[1])
+        self.assertEqual((), data[1]["livings"][0]["story_data"]["empty"], "empty set should be stored as empty tuple, like serpent does")
+
+    def test_values(self):
+        from decimal import Decimal
+        from collections import OrderedDict
+        encoder = BinaryEncoder([])
+        values = [None, True, False, 0, 255, 256, -1, 2**63, -2**63 - 1, 12345678901234567890123, 1.5, -0.0, float("-inf"),
+                  "", "text", "unicode \u20ac \U0001F600", ["repeated", "repeated", ("repeated",)], {"set", "of", "strings"},
+                  frozenset([1, 2]), (), [], {}, {1: "one", "two": 2.0, (3, 4): [5]}, GameMode.MUD, datetime.date(2017, 1, 2),
+                  datetime.datetime(2017, 1, 2, 3, 4, 5, 6), Decimal("1.25"), OrderedDict([("a", 1)]), b"bytes",
+                  datetime.timedelta(seconds=10), StoryConfig()]
+        for value in values:
+            expected = serpent.loads(serpent.dumps(value, module_in_classname=True))
+            self.assertEqual(expected, BinaryDecoder().decode(encoder.encode(value)), value)
+        encoded = encoder.encode(["same string"] * 100)
+        self.assertLess(len(encoded), 300, "repeated strings should be stored only once")
+
+    def test_corrupt(self):
+        encoded = BinaryEncoder([]).encode({"key": [1, 2, 3]})
+        with self.assertRaises(ValueError):
+            BinaryDecoder().decode(encoded[:-1])
+        with self.assertRaises(ValueError):
+            BinaryDecoder().decode(encoded + b"N")
+        with self.assertRaises(ValueError):
+            BinaryDecoder().decode(b"\xff" + encoded[1:])
+        with self.assertRaises(ValueError):
+            BinaryDecoder().decode(encoded[:1] + b"?" + encoded[2:])
+        a = {}
+        a["a"] = a
+        with self.assertRaises(ValueError):
+            BinaryEncoder([]).encode(a)
@@ -524,6 +524,45 @@ class TestSoul(unittest.TestCase):
         self.assertEqual("door two", parsed.verb)
         self.assertEqual([door2], list(parsed.who_info))
 
+    def testParseNamesTrackChanges(self):
+        soul = tale.base.Soul()
+        player = tale.player.Player("julie", "f")
+        room = tale.base.Location("somewhere")
+        bird = tale.base.Living("bird", "f")
+        gem = tale.base.Item("gem")
+        gem2 = tale.base.Item("gem")
+        player.move(room)
+        bird.move(room)
+        room.insert(gem, None)
+        player.insert(gem2, player)
+        parsed = soul.parse(player, "hug bird")
+        self.assertEqual([bird], list(parsed.who_info))
+        parsed = soul.parse(player, "examine gem", external_verbs={"examine"})
+        self.assertEqual([gem2], list(parsed.who_info), "inventory item has precedence")
+        bird.aliases.add("tweety")
+        parsed = soul.parse(player, "hug tweety")
+        self.assertEqual([bird], list(parsed.who_info))
+        bird.aliases = {"big yellow bird"}
+        parsed = soul.parse(player, "hug big yellow bird warmly")
+        self.assertEqual([bird], list(parsed.who_info))
+        self.assertEqual("warmly", parsed.adverb)
+        with self.assertRaises(tale.errors.ParseError):
+            soul.parse(player, "hug tweety")
+        bird.init_names("canary", "canary", "", "")
+        parsed = soul.parse(player, "hug canary")
+        self.assertEqual([bird], list(parsed.who_info))
+        with self.assertRaises(tale.errors.ParseError):
+            soul.parse(player, "hug bird")
+        gem2.aliases = {"red gem"}
+        parsed = soul.parse(player, "examine red gem", external_verbs={"examine"})
+        self.assertEqual([gem2], list(parsed.who_info))
+        player.remove(gem2, player)
+        parsed = soul.parse(player, "examine gem", external_verbs={"examine"})
+        self.assertEqual([gem], list(parsed.who_info))
+        bird.move(tale.base.Location("elsewhere"))
+        with self.assertRaises(tale.errors.ParseError):
+            soul.parse(player, "hug canary")
+
     def testEnterExits(self):
         soul = tale.base.Soul()
         player = tale.player.Player("julie", "f")
@@ -945,6 +984,24 @@ class TestSoul(unittest.TestCase):
             tale.verbdefs.NONLIVING_OK_VERBS = ORIG_NONLIVING_OK_VERBS
             tale.verbdefs.MOVEMENT_VERBS = ORIG_MOVEMENT_VERBS
 
+    def test_verb_templates_recompiled(self):
+        soul = tale.base.Soul()
+        player = tale.player.Player("julie", "f")
+        tale.base.Soul.compile_verbs()
+        self.assertIs(tale.verbdefs.VERBS["smile"], tale.base.Soul._verb_templates["smile"].verbdata)
+        ORIG_VERBS = tale.verbdefs.VERBS.copy()
+        try:
+            cough_templates = tale.base.Soul._verb_templates["cough"]
+            tale.verbdefs.adjust_available_verbs(add_verbs={"smile": (tale.verbdefs.SIMP, None, "grin$ \nHOW \nAT", "at")})
+            who, player_msg, room_msg, target_msg = soul.process_verb_parsed(player, tale.base.ParseResult("smile", adverb="slyly"))
+            self.assertEqual("You grin slyly.", player_msg)
+            self.assertEqual("Julie grins slyly.", room_msg)
+            self.assertIs(cough_templates, tale.base.Soul._verb_templates["cough"], "unaffected verbs must not be recompiled")
+        finally:
+            tale.verbdefs.VERBS = ORIG_VERBS
+        who, player_msg, room_msg, target_msg = soul.process_verb_parsed(player, tale.base.ParseResult("smile"))
+        self.assertEqual("You smile happily.", player_msg)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']